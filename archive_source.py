@@ -0,0 +1,334 @@
+import json
+import mmap
+import os
+import struct
+import tarfile
+import threading
+import zipfile
+import zlib
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import cv2
+
+from image_cache import ImageCache, ImagePrefetcher
+
+from image_scanner import ImageScanner
+
+import numpy as np
+
+
+ARCHIVE_EXTENSIONS = ['.zip', '.tar']
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+
+class ArchiveReader:
+    """
+    Class to read image files from a zip or uncompressed tar archive without unpacking it.
+
+    The offset and size of every image member is indexed once and the index is cached in
+    `index_path`, keyed by the size and mtime of the archive. Members are read by slicing a memory
+    map of the archive, stored zip members and tar members need no copying beyond the slice and
+    deflated zip members are inflated with zlib. Reading is safe from several threads.
+    """
+
+    index_version = 1
+
+    def __init__(self, archive_path: str, index_path: str):
+        self.archive_path = archive_path
+        self.index_path = index_path
+        self.is_zip = zipfile.is_zipfile(archive_path)
+        self.entries = self.load_index()
+        if self.entries is None:
+            self.entries = self.build_index()
+            self.save_index()
+        self.names = sorted(self.entries.keys())
+
+        self._file = open(archive_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(archive_path) > 0 else b''
+        # Members compressed with anything but deflate are read through zipfile, which is not thread safe
+        self._zip = None
+        self._lock = threading.Lock()
+
+    def build_index(self) -> Dict[str, Tuple[int, int, int, int]]:
+        """List the image members as name: (offset, stored size, size, compression)."""
+        entries = {}
+        if self.is_zip:
+            with zipfile.ZipFile(self.archive_path) as archive:
+                for info in archive.infolist():
+                    if self._is_image(info.filename) and not info.is_dir():
+                        # The offset is of the local header, its length is only known when the member is read
+                        entries[info.filename] = (info.header_offset, info.compress_size, info.file_size, info.compress_type)
+            return entries
+        try:
+            with tarfile.open(self.archive_path, 'r:') as archive:
+                for info in archive:
+                    if info.isfile() and self._is_image(info.name):
+                        entries[info.name] = (info.offset_data, info.size, info.size, zipfile.ZIP_STORED)
+        except tarfile.ReadError as error:
+            raise ValueError(f'{self.archive_path}: not a zip or uncompressed tar archive, compressed tar files have to be unpacked: {error}')
+        return entries
+
+    def load_index(self) -> Optional[Dict[str, Tuple[int, int, int, int]]]:
+        """Load the cached index, None if there is none or the archive changed since."""
+        stat = os.stat(self.archive_path)
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if index.get('version') != self.index_version or index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime:
+            return None
+        return {name: tuple(entry) for name, entry in index['entries'].items()}
+
+    def save_index(self):
+        """Write the index through a temporary file."""
+        stat = os.stat(self.archive_path)
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.index_version, 'size': stat.st_size, 'mtime': stat.st_mtime, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def read(self, name: str) -> bytes:
+        """Return the content of a member."""
+        offset, stored_size, size, compression = self.entries[name]
+        if self.is_zip:
+            signature, name_length, extra_length = ZIP_LOCAL_HEADER.unpack_from(self._map, offset)
+            if signature != b'PK\x03\x04':
+                raise ValueError(f'{self.archive_path}: bad local header for {name}')
+            offset += ZIP_LOCAL_HEADER.size + name_length + extra_length
+        if compression == zipfile.ZIP_STORED:
+            return self._map[offset:offset + size]
+        if compression == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(self._map[offset:offset + stored_size], -zlib.MAX_WBITS)
+        with self._lock:
+            if self._zip is None:
+                self._zip = zipfile.ZipFile(self.archive_path)
+            return self._zip.read(name)
+
+    def close(self):
+        """Close the archive."""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+        if self._zip is not None:
+            self._zip.close()
+
+    @staticmethod
+    def _is_image(name: str) -> bool:
+        base_name = os.path.basename(name)
+        return os.path.splitext(base_name)[1].lower() in IMAGE_EXTENSIONS and not base_name.startswith('.') and '__MACOSX' not in name
+
+
+class ArchiveManager:
+    """
+    Class to manage unlabelled images inside zip and tar archives, in place of ImageManager.
+
+    The archives are never changed. Labelled members are recorded in a progress log instead of
+    being removed, one line per labelled or unlabelled member, so a move only appends a line. The
+    log is compacted when the archives are opened.
+    """
+
+    def __init__(self,
+                 folder_path: str,
+                 prefetch_count: int = 3,
+                 cache_size: int = 1024 * 1024 * 1024,
+                 n_workers: int = 2
+                 ):
+        self.folder_path = folder_path
+        if os.path.isfile(folder_path):
+            self.root_folder = os.path.dirname(folder_path)
+            archive_paths = [folder_path]
+        else:
+            self.root_folder = folder_path
+            archive_paths = sorted(ImageScanner(folder_path, ARCHIVE_EXTENSIONS).scan())
+        label_dir = os.path.join(self.root_folder, '.label')
+        self.progress_path = os.path.join(label_dir, 'archive_progress.log')
+        self.readers = [
+            ArchiveReader(archive_path, os.path.join(label_dir, 'archives', quote(self.relative_path(archive_path), safe='') + '.json'))
+            for archive_path in archive_paths
+        ]
+
+        # Members are identified by a key that looks like a path, used where images are identified by their path
+        labelled = self.load_progress()
+        self.members: Dict[str, Tuple[ArchiveReader, str]] = {}
+        self.image_paths = []
+        for reader in self.readers:
+            archive_name = self.relative_path(reader.archive_path)
+            for name in reader.names:
+                key = f'{reader.archive_path}!{name}'
+                self.members[key] = (reader, name)
+                if (archive_name, name) not in labelled:
+                    self.image_paths.append(key)
+        self.save_progress(labelled)
+        self._progress_file = open(self.progress_path, 'a')
+        # Keys of the members labelled in this session, the last one is restored by previous_image
+        self.history = []
+        self.current_image_index = 0
+        print(f'{len(self.members)} images in {len(self.readers)} archives, {len(self.image_paths)} unlabelled')
+
+        self.current = ('', None)
+        self.prefetch_count = prefetch_count
+        self.cache = ImageCache(cache_size)
+        self.prefetcher = ImagePrefetcher(self.cache, self.decode, n_workers)
+        # Set once every member is labelled, the last member then stays on screen until it is gone back to
+        self.finished = not self.skip_undecodable(0)
+
+    def relative_path(self, archive_path: str) -> str:
+        """Return the path of an archive as stored in the progress log."""
+        return os.path.relpath(archive_path, self.root_folder)
+
+    def load_progress(self) -> set:
+        """Replay the progress log, return the (archive, member) pairs that are labelled."""
+        labelled = set()
+        if not os.path.exists(self.progress_path):
+            return labelled
+        with open(self.progress_path) as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) != 3:
+                    # A line cut short by a crash
+                    continue
+                if parts[0] == '+':
+                    labelled.add((parts[1], parts[2]))
+                else:
+                    labelled.discard((parts[1], parts[2]))
+        return labelled
+
+    def save_progress(self, labelled: set):
+        """Write a compacted progress log through a temporary file."""
+        os.makedirs(os.path.dirname(self.progress_path), exist_ok=True)
+        tmp_path = self.progress_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for archive_name, name in sorted(labelled):
+                f.write(f'+\t{archive_name}\t{name}\n')
+        os.replace(tmp_path, self.progress_path)
+
+    def record(self, key: str, labelled: bool):
+        """Append a labelled or unlabelled member to the progress log."""
+        reader, name = self.members[key]
+        self._progress_file.write(f'{"+" if labelled else "-"}\t{self.relative_path(reader.archive_path)}\t{name}\n')
+        self._progress_file.flush()
+
+    def decode(self, key: str) -> Optional[np.ndarray]:
+        """Decode a member straight from the archive, None if it cannot be read."""
+        reader, name = self.members[key]
+        try:
+            data = reader.read(name)
+        except (OSError, RuntimeError, ValueError, NotImplementedError, zlib.error, zipfile.BadZipFile) as error:
+            # zipfile raises RuntimeError for encrypted members and NotImplementedError for unknown compression
+            print(f'{key}: could not be read: {error}')
+            return None
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            print(f'{key}: could not be decoded')
+        return image
+
+    def skip_undecodable(self, index: int) -> bool:
+        """Drop the members from `index` on that cannot be decoded, return False if no member is left there."""
+        while index < len(self.image_paths):
+            if self.read_image(self.image_paths[index]) is not None:
+                return True
+            # Not recorded, so it is tried again in the next session
+            self.image_paths.pop(index)
+        return False
+
+    def load_image(self) -> np.ndarray:
+        """Load the current image from its archive."""
+        image_path = self.current_image_path()
+        if image_path == self.current[0]:
+            return self.current[1]
+        image = self.read_image(image_path)
+        self.current = (image_path, image)
+        self.prefetch()
+        return image
+
+    def load_preview(self, scale: float) -> Optional[np.ndarray]:
+        """Archive members are decoded in full right away."""
+        return None
+
+    def full_image_ready(self) -> bool:
+        """Return True, the current image is decoded on demand."""
+        return True
+
+    def current_image_size(self) -> Tuple[int, int]:
+        """Return the width and height of the current image."""
+        image = self.load_image()
+        return image.shape[1], image.shape[0]
+
+    def read_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Return any image from the cache, decoding and caching it if needed, safe to call from other threads."""
+        image = self.cache.peek(image_path)
+        if image is None:
+            image = self.prefetcher.wait(image_path)
+        if image is None:
+            image = self.decode(image_path)
+            self.cache.put(image_path, image)
+        return image
+
+    def upcoming_image_paths(self, count: int) -> List[str]:
+        """Return the keys of the current image and the images following it."""
+        start = self.current_image_index
+        return self.image_paths[start:start + count]
+
+    def current_image_path(self) -> str:
+        """Return the key of the current image."""
+        return self.image_paths[self.current_image_index]
+
+    def current_source_path(self) -> Optional[str]:
+        """Members have no file of their own, so saved images are always encoded."""
+        return None
+
+    def prefetch(self):
+        """Start decoding the current image and the images following it."""
+        self.prefetcher.prefetch(self.upcoming_image_paths(self.prefetch_count + 1))
+
+    def cache_stats(self) -> dict:
+        """Return the hit and miss counters of the image cache."""
+        return self.cache.stats()
+
+    def close(self):
+        """Stop the prefetch workers and close the archives."""
+        self.prefetcher.close()
+        self._progress_file.close()
+        for reader in self.readers:
+            reader.close()
+
+    def next_image(self):
+        """Record the current image as labelled and move on."""
+        labelled_path = self.current_image_path()
+        self.record(labelled_path, True)
+        if not self.skip_undecodable(self.current_image_index + 1):
+            # The last image stays on screen, it is recorded so it is not shown again in the next session
+            self.finished = True
+            print('No more images')
+            return
+        self.image_paths.pop(self.current_image_index)
+        self.history.append(labelled_path)
+        self.cache.discard(labelled_path)
+        self.current = ('', None)
+        self.prefetch()
+
+    def all_labelled(self) -> bool:
+        """Return True once the last member has been labelled."""
+        return self.finished
+
+    def can_go_back(self) -> bool:
+        """Return True if an image was labelled in this session."""
+        return self.finished or len(self.history) > 0
+
+    def previous_image(self):
+        """Go back to the image labelled last and record it as unlabelled."""
+        if self.finished:
+            # The last image is still on screen, it only has to be labelled again
+            self.finished = False
+            self.record(self.current_image_path(), False)
+            return
+        if len(self.history) == 0:
+            print('No images to recover')
+            return
+        recovered_path = self.history.pop()
+        self.record(recovered_path, False)
+        self.image_paths.insert(self.current_image_index, recovered_path)
@@ -0,0 +1,325 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import cv2
+
+from dataset_manager import BoundingBox, ClassDescription, DatasetManager, ImageManager
+
+import numpy as np
+
+
+QUICK = {
+    'render_sizes': [(1920, 1080)],
+    'box_counts': [0, 200],
+    'menu_classes': [2000],
+    'decode_sizes': [(1280, 720), (1920, 1080)],
+    'tree': (10, 50),
+    'save_count': 50,
+}
+FULL = {
+    'render_sizes': [(1920, 1080), (8000, 6000)],
+    'box_counts': [0, 200, 2000],
+    'menu_classes': [10, 2000],
+    'decode_sizes': [(640, 480), (1920, 1080), (4000, 3000)],
+    'tree': (50, 200),
+    'save_count': 200,
+}
+
+
+def make_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """Create a reproducible BGR image with smooth gradients and some noise, so it compresses like a photo."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[..., 0] = x[None, :]
+    image[..., 1] = y[:, None]
+    image[..., 2] = (x[None, :] + y[:, None]) / 2
+    image += rng.normal(0, 8, size=(height, width, 1)).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def make_boxes(count: int, width: int, height: int, n_classes: int, seed: int = 0) -> List[BoundingBox]:
+    """Create reproducible random boxes inside an image."""
+    rng = np.random.default_rng(seed)
+    x_min = rng.uniform(0, width * 0.9, count)
+    y_min = rng.uniform(0, height * 0.9, count)
+    box_width = rng.uniform(8, width * 0.1, count)
+    box_height = rng.uniform(8, height * 0.1, count)
+    class_ids = rng.integers(0, n_classes, count)
+    return [
+        BoundingBox(x, y, x + w, y + h, int(class_id))
+        for x, y, w, h, class_id in zip(x_min, y_min, box_width, box_height, class_ids)
+    ]
+
+
+def make_image_tree(root: str, n_folders: int, per_folder: int):
+    """Fill a folder tree with small images, every file is a copy of the same encoded image."""
+    _, encoded = cv2.imencode('.jpg', make_image(64, 48))
+    data = encoded.tobytes()
+    for folder_index in range(n_folders):
+        folder = os.path.join(root, f'folder{folder_index // 10}', f'sub{folder_index}')
+        os.makedirs(folder, exist_ok=True)
+        for image_index in range(per_folder):
+            with open(os.path.join(folder, f'image{image_index}.jpg'), 'wb') as f:
+                f.write(data)
+
+
+def summarize(times: List[float]) -> Dict[str, float]:
+    """Summarize durations in seconds as milliseconds."""
+    milliseconds = np.array(times) * 1000
+    return {
+        'median_ms': float(np.median(milliseconds)),
+        'mean_ms': float(milliseconds.mean()),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'min_ms': float(milliseconds.min()),
+        'count': len(times),
+    }
+
+
+def time_calls(function: Callable[[], None], repeat: int, setup: Optional[Callable[[], None]] = None, warmup: int = 1) -> Dict[str, float]:
+    """Time a function, calling the untimed setup before every call."""
+    times = []
+    for index in range(warmup + repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if index >= warmup:
+            times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def bench_render(work_dir: str, config: dict, repeat: int) -> Dict[str, dict]:
+    """Time full redraws and drag frames of the labeler with the SDL dummy video driver."""
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import gui
+    import pygame as pg
+
+    results = {}
+    class_description = ClassDescription([f'class{index}' for index in range(10)])
+    for width, height in config['render_sizes']:
+        image_dir = os.path.join(work_dir, f'render_{width}x{height}')
+        os.makedirs(image_dir)
+        cv2.imwrite(os.path.join(image_dir, 'image.jpg'), make_image(width, height))
+        image_manager = ImageManager(image_dir, use_manifest=False)
+        dataset_manager = DatasetManager(os.path.join(image_dir, '.dataset'), class_description)
+        dataset_manager.create_folder_structure()
+
+        labeler = gui.ImageLabeler(image_manager, dataset_manager, (1200, 800), 1.0)
+        labeler.initialize_image_pos()
+        # Fit the image to the canvas like a labelling session on a large image would
+        labeler.scale = min(900 / width, 600 / height)
+        labeler.draw()
+        labeler.get_pyramid().ready.wait()
+
+        for box_count in config['box_counts']:
+            labeler.bounding_boxes.clear()
+            for box in make_boxes(box_count, width, height, len(class_description.class_names)):
+                labeler.bounding_boxes.add(box)
+
+            for view, scale in [('fit', labeler.scale), ('zoom', 4.0)]:
+                labeler.scale = scale
+                labeler.offset = [0, 0]
+                name = f'{width}x{height}/{box_count}_boxes/{view}'
+
+                def redraw():
+                    labeler.mark_dirty(canvas=True, menu=True)
+                    labeler.draw()
+                results[f'render/draw/{name}'] = time_calls(redraw, repeat, warmup=3)
+
+                # A frame while a box is dragged: one motion event, then the redraw it causes
+                labeler.drawing = True
+                labeler.start_pos = (0.0, 0.0)
+                positions = iter(range(10 ** 6))
+
+                def post_motion():
+                    position = 100 + next(positions) % 400
+                    pg.event.post(pg.event.Event(pg.MOUSEMOTION, pos=(position, position), rel=(1, 1), buttons=(1, 0, 0)))
+
+                def drag_frame():
+                    labeler.event()
+                    labeler.draw()
+                results[f'render/drag/{name}'] = time_calls(drag_frame, repeat, setup=post_motion, warmup=3)
+                labeler.drawing = False
+                labeler.start_pos = None
+                labeler.current_box = None
+
+        image_manager.close()
+        dataset_manager.close()
+
+    # Redrawing the class list and filtering it, with as many classes as a product taxonomy
+    image_dir = os.path.join(work_dir, 'render_menu')
+    os.makedirs(image_dir)
+    cv2.imwrite(os.path.join(image_dir, 'image.jpg'), make_image(640, 480))
+    for class_count in config['menu_classes']:
+        image_manager = ImageManager(image_dir, use_manifest=False)
+        menu_description = ClassDescription([f'product {index} {("shelf", "bottle", "box")[index % 3]}' for index in range(class_count)])
+        dataset_manager = DatasetManager(os.path.join(image_dir, f'.dataset_{class_count}'), menu_description)
+        dataset_manager.create_folder_structure()
+        labeler = gui.ImageLabeler(image_manager, dataset_manager, (1200, 800), 1.0)
+
+        def redraw_menu():
+            labeler.mark_dirty(canvas=False, menu=True)
+            labeler.draw()
+        results[f'render/menu/{class_count}_classes'] = time_calls(redraw_menu, repeat, warmup=3)
+
+        queries = iter(range(10 ** 6))
+
+        def filter_menu():
+            # Type a query one character at a time, as the filter runs on every key
+            query = f'product {next(queries) % class_count}'
+            for end in range(1, len(query) + 1):
+                labeler.set_search_text(query[:end])
+        results[f'render/filter/{class_count}_classes'] = time_calls(filter_menu, repeat)
+        image_manager.close()
+        dataset_manager.close()
+    pg.quit()
+    return results
+
+
+def bench_scan(work_dir: str, config: dict, repeat: int) -> Dict[str, dict]:
+    """Time scanning a synthetic folder tree without a manifest and with an up-to-date manifest."""
+    n_folders, per_folder = config['tree']
+    image_dir = os.path.join(work_dir, 'tree')
+    make_image_tree(image_dir, n_folders, per_folder)
+    image_manager = ImageManager(image_dir, use_manifest=False)
+    image_manager.scanner.done.wait()
+
+    results = {}
+    name = f'{n_folders * per_folder}_images'
+    image_manager.manifest_path = None
+    results[f'scan/no_manifest/{name}'] = time_calls(lambda: image_manager.load_images(image_dir), repeat)
+    image_manager.manifest_path = os.path.join(image_dir, '.label', 'manifest.sqlite')
+    results[f'scan/manifest/{name}'] = time_calls(lambda: image_manager.load_images(image_dir), repeat)
+    image_manager.close()
+    return results
+
+
+def bench_decode(work_dir: str, config: dict, repeat: int) -> Dict[str, dict]:
+    """Time loading an image that is not cached yet for several resolutions and formats, and the preview of JPEG images."""
+    results = {}
+    for width, height in config['decode_sizes']:
+        for extension in ['.jpg', '.png']:
+            image_dir = os.path.join(work_dir, f'decode_{width}x{height}{extension}')
+            os.makedirs(image_dir)
+            image_path = os.path.join(image_dir, 'image' + extension)
+            cv2.imwrite(image_path, make_image(width, height))
+            image_manager = ImageManager(image_dir, prefetch_count=0, use_manifest=False)
+
+            def forget():
+                image_manager.current = ('', None)
+                image_manager.cache.discard(image_path)
+            results[f'decode/{extension[1:]}/{width}x{height}'] = time_calls(image_manager.load_image, repeat, setup=forget)
+            if extension == '.jpg' and width * height >= image_manager.preview_min_pixels:
+                def settle():
+                    # Let the full decode started by the previous preview finish before forgetting it
+                    image_manager.prefetcher.wait(image_path)
+                    forget()
+                # The preview shown first when the image is fitted to a 900 pixel wide canvas
+                results[f'decode/preview/{width}x{height}'] = time_calls(
+                    lambda: image_manager.load_preview(900 / width), repeat, setup=settle
+                )
+            image_manager.close()
+    return results
+
+
+def bench_save(work_dir: str, config: dict, repeat: int) -> Dict[str, dict]:
+    """Time saving labelled images until they are on disk, copying the source file and encoding it again."""
+    count = config['save_count']
+    image = make_image(1920, 1080)
+    source_path = os.path.join(work_dir, 'source.jpg')
+    cv2.imwrite(source_path, image)
+    class_description = ClassDescription(['class0', 'class1', 'class2'])
+    boxes = make_boxes(20, 1920, 1080, 3)
+
+    results = {}
+    for mode, passthrough in [('copy', True), ('encode', False)]:
+        times = []
+        for run in range(repeat):
+            dataset_dir = os.path.join(work_dir, f'save_{mode}_{run}')
+            dataset_manager = DatasetManager(dataset_dir, class_description, passthrough=passthrough)
+            dataset_manager.create_folder_structure()
+            start = time.perf_counter()
+            for _ in range(count):
+                dataset_manager.save_image(image, boxes, source_path)
+            dataset_manager.flush()
+            times.append((time.perf_counter() - start) / count)
+            dataset_manager.close()
+            shutil.rmtree(dataset_dir)
+        results[f'save/{mode}/1920x1080'] = summarize(times)
+    return results
+
+
+BENCHMARKS = {
+    'render': bench_render,
+    'scan': bench_scan,
+    'decode': bench_decode,
+    'save': bench_save,
+}
+
+
+def environment() -> dict:
+    """Describe the machine and library versions the results were measured with."""
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+    }
+    try:
+        import pygame as pg
+        info['pygame'] = pg.version.ver
+    except ImportError:
+        pass
+    return info
+
+
+def compare_results(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> int:
+    """Print the change of every median against the baseline, return the number of regressions."""
+    regressions = 0
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            print(f'{name:55} not in baseline')
+            continue
+        current, previous = results[name]['median_ms'], baseline[name]['median_ms']
+        ratio = current / previous if previous > 0 else 1.0
+        regressed = ratio > 1 + tolerance
+        regressions += regressed
+        print(f'{name:55} {previous:9.3f} -> {current:9.3f} ms {ratio - 1:+7.1%}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def run_benchmarks(args) -> int:
+    """Run the benchmarks, write the results as JSON and return the number of regressions against the baseline."""
+    config = QUICK if args.quick else FULL
+    names = args.only or list(BENCHMARKS.keys())
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='label_bench_') as work_dir:
+        for name in names:
+            print(f'Running {name} benchmarks')
+            bench_dir = os.path.join(work_dir, name)
+            os.makedirs(bench_dir)
+            results.update(BENCHMARKS[name](bench_dir, config, args.repeat))
+
+    report = {'environment': environment(), 'quick': args.quick, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.baseline is None:
+        for name, summary in results.items():
+            print(f'{name:55} {summary["median_ms"]:9.3f} ms (p95 {summary["p95_ms"]:.3f} ms)')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('quick') != args.quick:
+        print('Warning: the baseline was measured with a different --quick setting')
+    return compare_results(results, baseline['results'], args.tolerance)
@@ -0,0 +1,117 @@
+from collections import defaultdict
+from typing import Iterator, List, Optional, Set, Tuple
+
+from dataset_manager import BoundingBox
+
+
+class BoxIndex:
+    """
+    Class to hold the bounding boxes of an image in a uniform grid for fast lookups by position.
+
+    Boxes are stored in every grid cell they overlap. Boxes that would cover more than `max_cells`
+    cells are kept in a separate set that every query checks, so a few huge boxes cannot blow up
+    the grid.
+    """
+
+    def __init__(self, boxes: Optional[List[BoundingBox]] = None, cell_size: float = 128, max_cells: int = 64):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+
+        # Boxes in insertion order, removal swaps the last box into the freed position
+        self.boxes: List[BoundingBox] = []
+        self.positions = {}
+        self.cells = defaultdict(set)
+        self.large_boxes: Set[BoundingBox] = set()
+
+        for box in boxes or []:
+            self.add(box)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def __iter__(self) -> Iterator[BoundingBox]:
+        return iter(self.boxes)
+
+    def __contains__(self, box: BoundingBox) -> bool:
+        return box in self.positions
+
+    def add(self, box: BoundingBox):
+        """Add a box to the index."""
+        self.positions[box] = len(self.boxes)
+        self.boxes.append(box)
+        cells = self._cell_range(box.x_min, box.y_min, box.x_max, box.y_max)
+        if self._cell_count(cells) > self.max_cells:
+            self.large_boxes.add(box)
+            return
+        for cell in self._cells(cells):
+            self.cells[cell].add(box)
+
+    def remove(self, box: BoundingBox):
+        """Remove a box from the index."""
+        position = self.positions.pop(box)
+        last_box = self.boxes.pop()
+        if last_box is not box:
+            self.boxes[position] = last_box
+            self.positions[last_box] = position
+
+        if box in self.large_boxes:
+            self.large_boxes.discard(box)
+            return
+        for cell in self._cells(self._cell_range(box.x_min, box.y_min, box.x_max, box.y_max)):
+            boxes = self.cells[cell]
+            boxes.discard(box)
+            if len(boxes) == 0:
+                del self.cells[cell]
+
+    def clear(self):
+        """Remove all boxes."""
+        self.boxes.clear()
+        self.positions.clear()
+        self.cells.clear()
+        self.large_boxes.clear()
+
+    def query_point(self, pos: Tuple[float, float]) -> Optional[BoundingBox]:
+        """Return the smallest box containing the point, or None if no box contains it."""
+        x, y = pos
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        candidates = self.large_boxes.union(self.cells.get(cell, ()))
+        containing = [box for box in candidates if box.x_min <= x <= box.x_max and box.y_min <= y <= box.y_max]
+        if len(containing) == 0:
+            return None
+        return min(containing, key=lambda box: (box.area(), self.positions[box]))
+
+    def query_rect(self, x_min: float, y_min: float, x_max: float, y_max: float) -> List[BoundingBox]:
+        """Return the boxes overlapping the rectangle in the order of `boxes`."""
+        cells = self._cell_range(x_min, y_min, x_max, y_max)
+        if self._cell_count(cells) > len(self.cells):
+            candidates = set(self.large_boxes)
+            for boxes in self.cells.values():
+                candidates.update(boxes)
+        else:
+            candidates = set(self.large_boxes)
+            for cell in self._cells(cells):
+                candidates.update(self.cells.get(cell, ()))
+        overlapping = [
+            box for box in candidates
+            if box.x_min <= x_max and box.x_max >= x_min and box.y_min <= y_max and box.y_max >= y_min
+        ]
+        overlapping.sort(key=self.positions.__getitem__)
+        return overlapping
+
+    def _cell_range(self, x_min: float, y_min: float, x_max: float, y_max: float) -> Tuple[int, int, int, int]:
+        return (
+            int(x_min // self.cell_size), int(y_min // self.cell_size),
+            int(x_max // self.cell_size), int(y_max // self.cell_size),
+        )
+
+    @staticmethod
+    def _cell_count(cells: Tuple[int, int, int, int]) -> int:
+        cell_x_min, cell_y_min, cell_x_max, cell_y_max = cells
+        return (cell_x_max - cell_x_min + 1) * (cell_y_max - cell_y_min + 1)
+
+    @staticmethod
+    def _cells(cells: Tuple[int, int, int, int]) -> Iterator[Tuple[int, int]]:
+        cell_x_min, cell_y_min, cell_x_max, cell_y_max = cells
+        for cell_x in range(cell_x_min, cell_x_max + 1):
+            for cell_y in range(cell_y_min, cell_y_max + 1):
+                yield cell_x, cell_y
@@ -0,0 +1,131 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+
+from dataset_manager import BoundingBox, BoxSet
+
+import numpy as np
+
+
+def _gray(image: np.ndarray, scale: float) -> np.ndarray:
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def track_boxes(previous_image: np.ndarray,
+                next_image: np.ndarray,
+                boxes: BoxSet,
+                grid_size: int = 6,
+                max_side: int = 1024,
+                max_error: float = 1.0
+                ) -> Tuple[BoxSet, np.ndarray]:
+    """
+    Move boxes from one frame to the next with pyramidal Lucas-Kanade optical flow.
+
+    A grid of points inside every box is tracked forwards and back again. Points that do not return
+    to where they started are rejected, the box is moved by the median motion of the remaining points
+    and scaled by the median change of their spread.
+
+    Returns:
+        The moved boxes and the fraction of points of every box that were tracked reliably.
+    """
+    if len(boxes) == 0 or previous_image.shape[:2] != next_image.shape[:2]:
+        return BoxSet(), np.zeros(0)
+    # Optical flow on a reduced image is much faster and precise enough for box corners
+    scale = min(1.0, max_side / max(previous_image.shape[:2]))
+    previous_gray = _gray(previous_image, scale)
+    next_gray = _gray(next_image, scale)
+
+    coordinates = boxes.coordinates * scale
+    steps = (np.arange(grid_size) + 0.5) / grid_size
+    grid_x, grid_y = [grid.ravel() for grid in np.meshgrid(steps, steps)]
+    x_min, y_min, x_max, y_max = coordinates.T
+    points = np.stack([
+        x_min[:, None] + grid_x[None, :] * (x_max - x_min)[:, None],
+        y_min[:, None] + grid_y[None, :] * (y_max - y_min)[:, None],
+    ], axis=2).astype(np.float32)
+
+    # All points of all boxes go through a single pair of optical flow calls
+    flat_points = points.reshape(-1, 1, 2)
+    lk_params = {'winSize': (21, 21), 'maxLevel': 3}
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, next_gray, flat_points, None, **lk_params)
+    returned, back_status, _ = cv2.calcOpticalFlowPyrLK(next_gray, previous_gray, moved, None, **lk_params)
+    error = np.linalg.norm(returned - flat_points, axis=2).reshape(len(boxes), -1)
+    valid = (status.reshape(len(boxes), -1) == 1) & (back_status.reshape(len(boxes), -1) == 1) & (error < max_error)
+    confidences = valid.mean(axis=1)
+    moved = moved.reshape(points.shape)
+
+    new_coordinates = coordinates.copy()
+    for index in np.flatnonzero(valid.sum(axis=1) >= 2):
+        before = points[index][valid[index]]
+        after = moved[index][valid[index]]
+        dx, dy = np.median(after - before, axis=0)
+        spread_before = np.linalg.norm(before - before.mean(axis=0), axis=1)
+        spread_after = np.linalg.norm(after - after.mean(axis=0), axis=1)
+        growth = float(np.median(spread_after / np.maximum(spread_before, 1e-6)))
+        x_center = (x_min[index] + x_max[index]) / 2 + dx
+        y_center = (y_min[index] + y_max[index]) / 2 + dy
+        half_width = (x_max[index] - x_min[index]) / 2 * growth
+        half_height = (y_max[index] - y_min[index]) / 2 * growth
+        new_coordinates[index] = (x_center - half_width, y_center - half_height, x_center + half_width, y_center + half_height)
+
+    height, width = next_image.shape[:2]
+    tracked = BoxSet(new_coordinates / scale, boxes.class_ids.copy()).clip(width, height)
+    return tracked, confidences
+
+
+class BoxPropagator:
+    """Class to carry the boxes of a labelled image over to the next image on a background thread."""
+
+    def __init__(self,
+                 read_image: Callable[[str], Optional[np.ndarray]],
+                 min_confidence: float = 0.5,
+                 min_size: float = 2.0
+                 ):
+        self.read_image = read_image
+        # Tracked boxes below this confidence are flagged for review
+        self.min_confidence = min_confidence
+        self.min_size = min_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tracker')
+        self._pending: Dict[str, Future] = {}
+
+    def submit(self, previous_image: np.ndarray, next_path: str, boxes: BoxSet):
+        """Start tracking the boxes of the previous image into the image at next_path."""
+        self._pending = {next_path: self.executor.submit(self._track, previous_image, next_path, boxes)}
+
+    def get(self, path: str) -> Optional[List[BoundingBox]]:
+        """Return the tracked boxes for an image once they are ready, only once."""
+        future = self._pending.get(path)
+        if future is None or not future.done():
+            return None
+        del self._pending[path]
+        try:
+            return future.result()
+        except cv2.error as error:
+            print(f'Tracking failed: {error}')
+            return []
+
+    def cancel(self):
+        """Forget the running job, for example when going back to an earlier image."""
+        self._pending.clear()
+
+    def close(self):
+        """Stop the background thread."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _track(self, previous_image: np.ndarray, next_path: str, boxes: BoxSet) -> List[BoundingBox]:
+        next_image = self.read_image(next_path)
+        if next_image is None:
+            return []
+        tracked, confidences = track_boxes(previous_image, next_image, boxes)
+        result = []
+        for box, confidence in zip(tracked, confidences.tolist()):
+            if box.x_max - box.x_min < self.min_size or box.y_max - box.y_min < self.min_size:
+                # The object left the image
+                continue
+            box.review = confidence < self.min_confidence
+            result.append(box)
+        return result
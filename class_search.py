@@ -0,0 +1,51 @@
+import bisect
+import re
+from typing import List
+
+
+class ClassIndex:
+    """
+    Class to find class names by what the user has typed so far.
+
+    Every word of every name is indexed in a sorted list of (rest of the name from that word on,
+    class id), so the classes with a word starting with the query are one bisect range. Names
+    that only contain the query inside a word come after them. The result of the last query is
+    kept, and a query that extends it only searches within that result.
+    """
+
+    def __init__(self, class_names: List[str]):
+        self.names = [name.lower() for name in class_names]
+        self.word_keys = []
+        for class_id, name in enumerate(self.names):
+            for match in re.finditer(r'[^\W_]+', name):
+                self.word_keys.append((name[match.start():], class_id))
+        self.word_keys.sort()
+        self.last_query = ''
+        self.last_result = list(range(len(self.names)))
+
+    def search(self, query: str) -> List[int]:
+        """Return the ids of the classes matching the query, names starting with it first, then word starts, then the rest."""
+        query = query.lower().strip()
+        if query == '':
+            result = list(range(len(self.names)))
+        elif query.startswith(self.last_query) and self.last_query != '':
+            # Typing one more character can only remove matches
+            result = self._rank(query, [class_id for class_id in self.last_result if query in self.names[class_id]])
+        else:
+            start = bisect.bisect_left(self.word_keys, (query,))
+            end = bisect.bisect_left(self.word_keys, (query + '\U0010ffff',))
+            word_matches = {class_id for _, class_id in self.word_keys[start:end]}
+            other_matches = [class_id for class_id, name in enumerate(self.names) if class_id not in word_matches and query in name]
+            result = self._rank(query, sorted(word_matches) + other_matches)
+        self.last_query = query
+        self.last_result = result
+        return result
+
+    def _rank(self, query: str, class_ids: List[int]) -> List[int]:
+        def rank(class_id: int) -> int:
+            name = self.names[class_id]
+            if name.startswith(query):
+                return 0
+            return 1 if re.search(r'(?<![^\W_])' + re.escape(query), name) else 2
+        # The sort is stable, so class ids stay in order within a rank
+        return sorted(class_ids, key=rank)
@@ -0,0 +1,199 @@
+import io
+import json
+import os
+import re
+import tarfile
+from typing import List, Optional, Tuple
+
+import cv2
+
+from dataset_manager import BoxSet
+
+from dataset_tools import find_samples, imap_parallel, read_class_names, read_yolo_labels, run_parallel
+
+from image_header import read_image_size
+
+from image_writer import temporary_path
+
+import numpy as np
+
+
+def sample_id(image_path: str) -> int:
+    """Return the id of a sample from the name of its image, imageN has the id N."""
+    match = re.fullmatch(r'image(\d+)', os.path.splitext(os.path.basename(image_path))[0])
+    if match is None:
+        raise ValueError(f'{image_path}: name does not contain a sample id')
+    return int(match.group(1))
+
+
+def read_annotation(image_path: str, label_path: Optional[str]) -> dict:
+    """Read the size of an image and its boxes in pixels, raises ValueError if either cannot be read."""
+    size = read_image_size(image_path)
+    if size is None:
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f'{image_path}: could not be read')
+        size = image.shape[1], image.shape[0]
+    try:
+        labels = read_yolo_labels(label_path) if label_path is not None else np.zeros((0, 5))
+    except (OSError, ValueError) as error:
+        raise ValueError(f'{label_path}: could not be parsed: {error}')
+    boxes = BoxSet.from_yolo(labels, *size)
+    return {
+        'id': sample_id(image_path),
+        'width': size[0],
+        'height': size[1],
+        'boxes': np.round(boxes.to_coco(), 2).tolist(),
+        'class_ids': boxes.class_ids.tolist(),
+    }
+
+
+def _read_annotation(sample: tuple):
+    split, image_path, label_path = sample
+    try:
+        return read_annotation(image_path, label_path)
+    except ValueError as error:
+        return str(error)
+
+
+def _write_shard(shard: tuple) -> Tuple[List[list], List[str]]:
+    """Write one tar shard, return its index rows and the problems found."""
+    shard_path, shard_name, split, samples = shard
+    rows = []
+    problems = []
+    tmp_path = temporary_path(shard_path)
+    with tarfile.open(tmp_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for image_path, label_path in samples:
+            try:
+                annotation = read_annotation(image_path, label_path)
+                with open(image_path, 'rb') as f:
+                    image_bytes = f.read()
+            except (OSError, ValueError) as error:
+                problems.append(str(error))
+                continue
+            annotation['split'] = split
+            key = f'image{annotation["id"]}'
+            row = [annotation['id'], split, shard_name]
+            extension = os.path.splitext(image_path)[1].lower()
+            for name, data in ((key + extension, image_bytes), (key + '.json', json.dumps(annotation).encode())):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                # Members are padded to whole blocks, the data starts that many blocks before the end
+                blocks = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+                data_offset = tar.offset - blocks * tarfile.BLOCKSIZE
+                row += [data_offset, len(data)]
+            rows.append(row)
+    os.replace(tmp_path, shard_path)
+    return rows, problems
+
+
+def export_webdataset(samples: List[tuple], output_dir: str, shard_size: int, workers: Optional[int]) -> int:
+    """
+    Write the samples to tar shards in the WebDataset layout, return the number of problems.
+
+    Every split gets its own shards of up to `shard_size` samples, `train-000000.tar` and so on. A
+    sample is an image and a JSON file with its size, boxes and class ids, both named after the
+    sample. The shards are written in parallel, each by one process that streams the files into
+    it. `index.tsv` lists the shard of every sample and the byte ranges of its image and JSON
+    inside the shard, so single samples can be read without unpacking a shard.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards = []
+    for split in sorted({split for split, _, _ in samples}):
+        split_samples = [(image_path, label_path) for sample_split, image_path, label_path in samples if sample_split == split]
+        for start in range(0, len(split_samples), shard_size):
+            shard_name = f'{split}-{start // shard_size:06d}.tar'
+            shards.append((os.path.join(output_dir, shard_name), shard_name, split, split_samples[start:start + shard_size]))
+
+    print(f'Writing {len(samples)} samples to {len(shards)} shards')
+    results = run_parallel(_write_shard, shards, workers, 'shards')
+    problems = [problem for _, shard_problems in results for problem in shard_problems]
+    for problem in problems:
+        print(problem)
+
+    index_path = os.path.join(output_dir, 'index.tsv')
+    tmp_path = temporary_path(index_path)
+    with open(tmp_path, 'w') as f:
+        f.write('id\tsplit\tshard\timage_offset\timage_size\tlabel_offset\tlabel_size\n')
+        for rows, _ in results:
+            for row in rows:
+                f.write('\t'.join(str(value) for value in row) + '\n')
+    os.replace(tmp_path, index_path)
+    print(f'{sum(len(rows) for rows, _ in results)} samples written to {output_dir}')
+    return len(problems)
+
+
+def export_coco(samples: List[tuple], dataset_dir: str, output_path: str, class_names: List[str], workers: Optional[int]) -> int:
+    """
+    Write the samples to one COCO JSON file, return the number of problems.
+
+    Image paths are relative to the dataset folder. Images are numbered in the order they are
+    written, the sample ids come from the file names and repeat across splits. The file is written
+    while one process pool reads the samples, with the annotations going to a second temporary
+    file that is appended at the end, so the annotations are never held in memory.
+    """
+    problems = 0
+    image_id = 0
+    annotation_id = 0
+    tmp_path = temporary_path(output_path)
+    annotations_path = tmp_path + '.annotations'
+    with open(tmp_path, 'w') as f, open(annotations_path, 'w+') as annotations:
+        categories = [{'id': class_id, 'name': name} for class_id, name in enumerate(class_names)]
+        f.write(f'{{"categories": {json.dumps(categories)},\n"images": [')
+        separator = '\n'
+        for result, (split, image_path, _) in zip(imap_parallel(_read_annotation, samples, workers), samples):
+            if isinstance(result, str):
+                print(result)
+                problems += 1
+                continue
+            image = {
+                'id': image_id,
+                'file_name': os.path.relpath(image_path, dataset_dir),
+                'width': result['width'],
+                'height': result['height'],
+                'split': split,
+            }
+            f.write(separator + json.dumps(image))
+            for box, class_id in zip(result['boxes'], result['class_ids']):
+                annotation = {
+                    'id': annotation_id,
+                    'image_id': image_id,
+                    'category_id': class_id,
+                    'bbox': box,
+                    'area': round(box[2] * box[3], 2),
+                    'iscrowd': 0,
+                }
+                annotations.write((',\n' if annotation_id > 0 else '\n') + json.dumps(annotation))
+                annotation_id += 1
+            image_id += 1
+            separator = ',\n'
+        f.write('\n],\n"annotations": [')
+        annotations.seek(0)
+        for chunk in iter(lambda: annotations.read(1024 * 1024), ''):
+            f.write(chunk)
+        f.write('\n]}\n')
+    os.remove(annotations_path)
+    os.replace(tmp_path, output_path)
+    print(f'{annotation_id} boxes written to {output_path}')
+    return problems
+
+
+def export_dataset(args) -> int:
+    """Export a dataset to tar shards, a COCO file or both, return the number of problems."""
+    samples = []
+    problems = 0
+    for split, image_path, label_path in find_samples(args.dataset_dir):
+        if image_path is None:
+            print(f'{label_path}: has no image, skipped')
+            problems += 1
+            continue
+        samples.append((split, image_path, label_path))
+
+    if 'webdataset' in args.format:
+        problems += export_webdataset(samples, os.path.join(args.output_dir, 'shards'), args.shard_size, args.workers)
+    if 'coco' in args.format:
+        os.makedirs(args.output_dir, exist_ok=True)
+        class_names = read_class_names(args.dataset_dir) or []
+        problems += export_coco(samples, args.dataset_dir, os.path.join(args.output_dir, 'coco.json'), class_names, args.workers)
+    return problems
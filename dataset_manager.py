@@ -1,20 +1,41 @@
 import os
-from typing import List
+import re
+import threading
+from collections import deque
+from typing import Iterator, List, Optional, Tuple, Union
 
 import cv2
 
+from image_cache import ImageCache, ImagePrefetcher
+
+from image_header import read_exif_thumbnail, read_image_size
+
+from image_scanner import ImageScanner
+
+from image_writer import AsyncWriter, WriteJob, temporary_path
+
+from session_store import SessionStore
+
+from undo_journal import UndoJournal
+
+from work_claims import ClaimManager
+
 import numpy as np
 
 
 class BoundingBox:
     """Class to manage bounding boxes."""
 
-    def __init__(self, x_min: float, y_min: float, x_max: float, y_max: float, class_id: int):
+    __slots__ = ('x_min', 'y_min', 'x_max', 'y_max', 'class_id', 'review')
+
+    def __init__(self, x_min: float, y_min: float, x_max: float, y_max: float, class_id: int, review: bool = False):
         self.x_min = x_min
         self.y_min = y_min
         self.x_max = x_max
         self.y_max = y_max
         self.class_id = class_id
+        # Set on boxes that were not drawn by hand and should be checked
+        self.review = review
 
     def to_yolo_format(self, image_width: int, image_height: int) -> tuple:
         """Convert bounding box to YOLO format."""
@@ -35,6 +56,100 @@ class BoundingBox:
         return (self.x_max - self.x_min) * (self.y_max - self.y_min)
 
 
+class BoxSet:
+    """
+    Class to manage many bounding boxes as arrays.
+
+    The corners are stored as an (N, 4) float array of x_min, y_min, x_max, y_max and the classes as an
+    (N,) int array, so conversions work on all boxes at once. Indexing and iterating return copies of
+    the boxes.
+    """
+
+    def __init__(self, coordinates: Optional[np.ndarray] = None, class_ids: Optional[np.ndarray] = None):
+        self.coordinates = np.zeros((0, 4)) if coordinates is None else np.asarray(coordinates, dtype=np.float64).reshape(-1, 4)
+        self.class_ids = np.zeros(0, dtype=np.int64) if class_ids is None else np.asarray(class_ids, dtype=np.int64).reshape(-1)
+
+    @classmethod
+    def from_boxes(cls, boxes: List[BoundingBox]) -> 'BoxSet':
+        """Create a box set from bounding boxes."""
+        boxes = list(boxes)
+        coordinates = np.array([(box.x_min, box.y_min, box.x_max, box.y_max) for box in boxes], dtype=np.float64)
+        class_ids = np.array([box.class_id for box in boxes], dtype=np.int64)
+        return cls(coordinates, class_ids)
+
+    @classmethod
+    def from_yolo(cls, labels: np.ndarray, image_width: int, image_height: int) -> 'BoxSet':
+        """Create a box set from an (N, 5) array of YOLO rows: class, x center, y center, width, height."""
+        labels = np.asarray(labels, dtype=np.float64).reshape(-1, 5)
+        half_width = labels[:, 3] * image_width / 2
+        half_height = labels[:, 4] * image_height / 2
+        x_center = labels[:, 1] * image_width
+        y_center = labels[:, 2] * image_height
+        coordinates = np.stack([x_center - half_width, y_center - half_height, x_center + half_width, y_center + half_height], axis=1)
+        return cls(coordinates, labels[:, 0].astype(np.int64))
+
+    def __len__(self) -> int:
+        return len(self.class_ids)
+
+    def __getitem__(self, index: int) -> BoundingBox:
+        """
+        Return a box as a new BoundingBox.
+
+        The box is a copy and not a view into the arrays, changing it does not change the set. Boxes
+        are edited one by one in the labeler, so they are plain objects there, and a set is built
+        from them again with `from_boxes` when they are saved.
+        """
+        x_min, y_min, x_max, y_max = self.coordinates[index].tolist()
+        return BoundingBox(x_min, y_min, x_max, y_max, int(self.class_ids[index]))
+
+    def __iter__(self) -> Iterator[BoundingBox]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def areas(self) -> np.ndarray:
+        """Calculate the area of every box."""
+        return (self.coordinates[:, 2] - self.coordinates[:, 0]) * (self.coordinates[:, 3] - self.coordinates[:, 1])
+
+    def clip(self, image_width: int, image_height: int) -> 'BoxSet':
+        """Return the boxes clamped to the image bounds."""
+        coordinates = self.coordinates.copy()
+        np.clip(coordinates[:, 0::2], 0, image_width, out=coordinates[:, 0::2])
+        np.clip(coordinates[:, 1::2], 0, image_height, out=coordinates[:, 1::2])
+        return BoxSet(coordinates, self.class_ids.copy())
+
+    def to_yolo(self, image_width: int, image_height: int) -> np.ndarray:
+        """Convert the boxes to an (N, 4) array of normalized x center, y center, width and height."""
+        x_min, y_min, x_max, y_max = self.coordinates.T
+        return np.stack([
+            (x_min + x_max) / 2 / image_width,
+            (y_min + y_max) / 2 / image_height,
+            (x_max - x_min) / image_width,
+            (y_max - y_min) / image_height,
+        ], axis=1)
+
+    def to_coco(self) -> np.ndarray:
+        """Convert the boxes to an (N, 4) array of x, y, width and height in pixels."""
+        x_min, y_min, x_max, y_max = self.coordinates.T
+        return np.stack([x_min, y_min, x_max - x_min, y_max - y_min], axis=1)
+
+    def to_voc(self) -> np.ndarray:
+        """Convert the boxes to an (N, 4) int array of the corners rounded to whole pixels."""
+        return np.rint(self.coordinates).astype(np.int64)
+
+    def to_yolo_text(self, image_width: int, image_height: int) -> str:
+        """Format the boxes as the lines of a YOLO label file."""
+        if len(self) == 0:
+            return ''
+        table = np.column_stack([self.class_ids, self.to_yolo(image_width, image_height)])
+        # A single format call for all rows instead of one per box
+        return ('%d %.6f %.6f %.6f %.6f\n' * len(self)) % tuple(table.ravel().tolist())
+
+    def write_yolo(self, path: str, image_width: int, image_height: int):
+        """Write the boxes to a YOLO label file in one write."""
+        with open(path, 'w') as f:
+            f.write(self.to_yolo_text(image_width, image_height))
+
+
 class ClassDescription:
     """Class to manage class names."""
 
@@ -50,6 +165,17 @@ class ClassDescription:
         self.n_classes = len(class_names)
         return self.n_classes
 
+    def class_map(self, other_names: Optional[List[str]] = None) -> dict:
+        """
+        Map the class indices of another list of names to the indices of these classes.
+
+        Names are matched case-insensitively. Without other names, indices map to themselves.
+        """
+        if other_names is None:
+            return {i: i for i in range(self.n_classes)}
+        indices = {name.lower(): i for i, name in enumerate(self.class_names)}
+        return {i: indices[name.lower()] for i, name in enumerate(other_names) if name.lower() in indices}
+
 
 class DatasetManager:
     """Class to manage the dataset."""
@@ -62,7 +188,11 @@ class DatasetManager:
                  include_test=False,
                  train_split=0.6,
                  validation_split=0.2,
-                 test_split=0.2
+                 test_split=0.2,
+                 write_queue_size=8,
+                 passthrough=True,
+                 undo_depth=100,
+                 read_only=False
                  ) -> None:
 
         self.dataset_name = dataset_name
@@ -76,10 +206,40 @@ class DatasetManager:
         self.validation_split = 0.2 if include_validation else 0
         self.test_split = 0.2 if include_test else 0
 
-        self.image_number = 0
-
-        self.last_image_paths = []
-        self.last_lable_paths = []
+        # Copy source files into the dataset instead of encoding the decoded pixels again
+        self.passthrough = passthrough
+
+        # Only as many saves are kept as the image managers keep labelled images, so every undo has an image to go back to
+        self.last_image_paths: deque = deque(maxlen=undo_depth)
+        self.last_lable_paths: deque = deque(maxlen=undo_depth)
+        self.last_jobs: deque = deque(maxlen=undo_depth)
+        self.last_sample_ids: deque = deque(maxlen=undo_depth)
+
+        # A read only dataset gets no samples, only its existing label files are rewritten, so nothing is created for saving
+        self.read_only = read_only
+        self.writer = None if read_only else AsyncWriter(write_queue_size, on_written=self._on_written)
+        # Removed samples are staged here until they are restored or a new image is saved
+        self.journal = None if read_only else UndoJournal(os.path.join(dataset_name, '.trash'), undo_depth)
+
+        index_path = os.path.join(dataset_name, 'index.sqlite')
+        new_index = not os.path.exists(index_path)
+        # An existing index is kept up to date with edited labels
+        self.store: Optional[SessionStore] = None if read_only and new_index else SessionStore(index_path)
+        if new_index and self.store is not None:
+            self.store.reserve_ids(self.find_next_image_number())
+
+    def find_next_image_number(self) -> int:
+        """Find the number after the highest image number in the label folders, used once for datasets without an index."""
+        next_number = 1
+        for split in ('train', 'validation', 'test'):
+            label_folder = os.path.join(self.dataset_name, 'labels', split)
+            if not os.path.isdir(label_folder):
+                continue
+            for name in os.listdir(label_folder):
+                match = re.fullmatch(r'image(\d+)\.txt', name)
+                if match is not None:
+                    next_number = max(next_number, int(match.group(1)) + 1)
+        return next_number
 
     def create_folder_structure(self):
         """
@@ -122,8 +282,19 @@ class DatasetManager:
                 f.write(str(self.class_description.class_names))
                 f.write('\n')
 
-    def save_image(self, image: np.ndarray, bounding_boxes: List[BoundingBox]):
-        """Save the image to file."""
+    def save_image(self,
+                   image: np.ndarray,
+                   bounding_boxes: Union[BoxSet, List[BoundingBox]],
+                   source_path: Optional[str] = None
+                   ):
+        """
+        Queue the image and its labels to be saved by the background writer.
+
+        Args:
+            image: The decoded image, used for the label coordinates and encoded if there is no source file.
+            bounding_boxes: The bounding boxes in image coordinates.
+            source_path: The unmodified file the image was decoded from.
+        """
         # Deside where to save the image with a random number
         random_number = np.random.rand()
         random_number *= self.train_split + self.validation_split + self.test_split
@@ -135,82 +306,355 @@ class DatasetManager:
         else:
             folder = 'test'
 
-        image_path = os.path.join(self.dataset_name, 'images', folder, f'image{self.image_number}.jpg')
-        # Save the image
-        cv2.imwrite(image_path, image)
-
-        # Save the bounding boxes under labels
-        label_path = os.path.join(self.dataset_name, 'labels', folder, f'image{self.image_number}.txt')
+        if not isinstance(bounding_boxes, BoxSet):
+            bounding_boxes = BoxSet.from_boxes(bounding_boxes)
+        label_text = bounding_boxes.clip(image.shape[1], image.shape[0]).to_yolo_text(image.shape[1], image.shape[0])
+        class_ids, counts = np.unique(bounding_boxes.class_ids, return_counts=True)
+
+        passthrough = self.passthrough and source_path is not None
+        extension = os.path.splitext(source_path)[1].lower() if passthrough else '.jpg'
+        sample_id, image_path, label_path = self.store.add_sample(
+            folder,
+            dict(zip(class_ids.tolist(), counts.tolist())),
+            lambda sample_id: (
+                os.path.join(self.dataset_name, 'images', folder, f'image{sample_id}{extension}'),
+                os.path.join(self.dataset_name, 'labels', folder, f'image{sample_id}.txt'),
+            )
+        )
+
+        if passthrough:
+            staged_image_path = temporary_path(image_path)
+            source_file = None
+            try:
+                # Linking is a metadata operation, so it is done right away while the source is still in place
+                os.link(source_path, staged_image_path)
+            except OSError:
+                # Across filesystems the data is cloned or copied by the writer, from the open file as the source is moved to the trash next
+                source_file = open(source_path, 'rb')
+            job = WriteJob(image_path, label_path, None, label_text, staged_image_path, sample_id, source_file)
+        else:
+            job = WriteJob(image_path, label_path, image, label_text, sample_id=sample_id)
+        self.writer.submit(job)
+        # Removed samples can no longer be restored once a new image has been saved
+        self.journal.clear()
+        self.store.purge_removed()
 
         self.last_image_paths.append(image_path)
         self.last_lable_paths.append(label_path)
-        with open(label_path, 'w') as f:
-            for bounding_box in bounding_boxes:
-                x_center, y_center, width, height, class_id = bounding_box.to_yolo_format(image.shape[1], image.shape[0])
-                f.write(f'{class_id} {x_center} {y_center} {width} {height}\n')
-        self.image_number += 1
-
-    def remove_last_image(self):
-        """Remove the last image from the dataset."""
+        self.last_jobs.append(job)
+        self.last_sample_ids.append(sample_id)
+
+    def remove_last_image(self) -> bool:
+        """Remove the last image from the dataset, return False if there was no image to remove."""
         if len(self.last_image_paths) == 0 or len(self.last_lable_paths) == 0:
             print('No images to remove')
-            return
-        self.image_number -= 1
+            return False
         image_path = self.last_image_paths.pop()
         label_path = self.last_lable_paths.pop()
-        os.remove(image_path)
-        os.remove(label_path)
+        job = self.last_jobs.pop()
+        sample_id = self.last_sample_ids.pop()
+        self.store.set_removed(sample_id, True)
+        if job is not None and self.writer.cancel(job):
+            # Nothing was written, the empty entry keeps the removals in step with the images that were gone back to
+            self.journal.stage([])
+            return True
+        if job is not None:
+            job.done.wait()
+        self.journal.stage([path for path in (image_path, label_path) if os.path.exists(path)])
+        return True
+
+    def restore_last_image(self) -> bool:
+        """Restore the last removed image, return False if there was no image to restore."""
+        paths = self.journal.peek()
+        if paths is None:
+            print('No images to restore')
+            return False
+        if len(paths) < 2:
+            # The entry stays, restoring the entries below it would pair them with the wrong images
+            print('The last removed image was never written and cannot be restored')
+            return False
+        image_path, label_path = self.journal.restore()
+        # The journal outlives the session, so the id is taken from the file name
+        sample_id = int(re.fullmatch(r'image(\d+)\.txt', os.path.basename(label_path)).group(1))
+        self.store.set_removed(sample_id, False)
+        self.last_image_paths.append(image_path)
+        self.last_lable_paths.append(label_path)
+        self.last_jobs.append(None)
+        self.last_sample_ids.append(sample_id)
+        return True
+
+    def split_counts(self) -> dict:
+        """Return the number of saved images per split."""
+        return self.store.split_counts()
+
+    def class_counts(self) -> List[int]:
+        """Return the number of saved boxes per class."""
+        return self.store.class_counts(self.class_description.n_classes)
+
+    def _on_written(self, job: WriteJob):
+        self.store.set_source_hash(job.sample_id, job.digest)
+
+    def flush(self):
+        """Wait until all queued images have been written."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Write the remaining images and stop the background writer."""
+        if self.writer is not None:
+            self.writer.close()
+        if self.store is not None:
+            self.store.close()
 
 
 class ImageManager:
-    """Class to manage unlabelled images."""
+    """
+    Class to manage unlabelled images.
+
+    With a claim manager the folder is shared with other workers, and only the images claimed by
+    this worker are labelled. They are claimed in batches as the labelling goes on.
+    """
 
-    def __init__(self, folder_path: str):
+    def __init__(self,
+                 folder_path: str,
+                 prefetch_count: int = 3,
+                 cache_size: int = 1024 * 1024 * 1024,
+                 n_workers: int = 2,
+                 undo_depth: int = 100,
+                 use_manifest: bool = True,
+                 claims: Optional[ClaimManager] = None,
+                 claim_batch: int = 16
+                 ):
         self.allowed_extensions = ['.jpg', '.jpeg', '.png']
         self.folder_path = folder_path
-        self.image_paths = self.load_images(folder_path)
+        self.manifest_path = os.path.join(folder_path, '.label', 'manifest.sqlite') if use_manifest else None
         self.current_image_index = 0
-
-        self.cache = ('', None)
-        self.removed_images = []
+        self.claims = claims
+        self.claim_batch = claim_batch
+        # Batches are claimed on this thread while the images claimed before are labelled
+        self._claimer: Optional[threading.Thread] = None
+
+        # Images are added while the folder is scanned, labelling can start once the first one is found
+        self.image_paths = []
+        self.scanner = ImageScanner(folder_path, self.allowed_extensions, self.manifest_path)
+        if claims is None:
+            self.scanner.start(self.image_paths.append)
+            self.scanner.wait_for_first()
+        else:
+            # Found images are only candidates, another worker may claim them first
+            claims.reclaim_stale()
+            self.candidates = []
+            self.candidate_index = 0
+            self.image_paths.extend(claims.claimed_paths())
+            self.scanner.start(self.candidates.append)
+            self.scanner.wait_for_first()
+            self.claim_more()
+            if len(self.image_paths) == 0:
+                self.wait_for_claims()
+
+        # The current image is kept apart so repeated lookups during a frame skip the cache bookkeeping
+        self.current = ('', None)
+        # Size of the current image from its header, so it is known before the image is decoded
+        self.current_size = ('', (0, 0))
+        # Smaller images decode quickly enough that a preview would only compete with the full decode
+        self.preview_min_pixels = 8 * 1000 * 1000
+        self.prefetch_count = prefetch_count
+        self.cache = ImageCache(cache_size)
+        self.prefetcher = ImagePrefetcher(self.cache, cv2.imread, n_workers)
+        # Labelled images are moved here instead of being deleted, so they can be recovered
+        trash_dir = os.path.join(claims.claim_dir if claims is not None else folder_path, '.trash')
+        self.journal = UndoJournal(trash_dir, undo_depth)
+        # Set once every image is labelled, the last image then stays on screen until it is gone back to
+        self.finished = False
 
     def load_images(self, folder_path: str):
         """Load all images from the image folder recursively."""
-        image_paths = []
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if os.path.splitext(file)[1].lower() in self.allowed_extensions:
-                    image_paths.append(os.path.join(root, file))
-        return image_paths
+        return ImageScanner(folder_path, self.allowed_extensions, self.manifest_path).scan()
 
     def load_image(self) -> np.ndarray:
         """Load the current image from file."""
         image_path = self.image_paths[self.current_image_index]
-        if image_path == self.cache[0]:
-            return self.cache[1]
-        image = cv2.imread(image_path)
-        self.cache = (image_path, image)
+        if image_path == self.current[0]:
+            return self.current[1]
+        image = self.cache.get(image_path)
+        if image is None:
+            image = self.prefetcher.wait(image_path)
+        if image is None:
+            image = cv2.imread(image_path)
+            self.cache.put(image_path, image)
+        self.current = (image_path, image)
+        self.prefetch()
         return image
 
+    def load_preview(self, scale: float) -> Optional[np.ndarray]:
+        """
+        Get a quick low resolution version of the current image while the full image is decoded.
+
+        The EXIF thumbnail is used if the file has one with the same aspect ratio, otherwise the image
+        is decoded at a reduced resolution that is sharp enough for the display scale. The full
+        resolution image is decoded by the prefetcher at the same time. Returns None when the full
+        image is already decoded, is small or is not a JPEG, where a reduced decode is not faster.
+        """
+        image_path = self.current_image_path()
+        if self.full_image_ready() or os.path.splitext(image_path)[1].lower() not in ('.jpg', '.jpeg'):
+            return None
+        width, height = self.current_image_size()
+        if width * height < self.preview_min_pixels:
+            return None
+        self.prefetch()
+        thumbnail = read_exif_thumbnail(image_path)
+        if thumbnail is not None:
+            if abs(thumbnail.shape[1] / thumbnail.shape[0] - width / height) < 0.02 * width / height:
+                return thumbnail
+        reduction = 1 / scale if scale > 0 else 8
+        if reduction >= 8:
+            flags = cv2.IMREAD_REDUCED_COLOR_8
+        elif reduction >= 4:
+            flags = cv2.IMREAD_REDUCED_COLOR_4
+        else:
+            flags = cv2.IMREAD_REDUCED_COLOR_2
+        return cv2.imread(image_path, flags)
+
+    def full_image_ready(self) -> bool:
+        """Return True if the current image is decoded at full resolution."""
+        image_path = self.current_image_path()
+        return image_path == self.current[0] or image_path in self.cache
+
+    def current_image_size(self) -> Tuple[int, int]:
+        """Return the width and height of the current image, read from the file header if it is not decoded yet."""
+        image_path = self.current_image_path()
+        if image_path == self.current[0]:
+            return self.current[1].shape[1], self.current[1].shape[0]
+        if image_path != self.current_size[0]:
+            size = read_image_size(image_path)
+            if size is None:
+                image = self.load_image()
+                size = image.shape[1], image.shape[0]
+            self.current_size = (image_path, size)
+        return self.current_size[1]
+
+    def read_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Return any image from the cache, decoding and caching it if needed, safe to call from other threads."""
+        image = self.cache.peek(image_path)
+        if image is None:
+            image = self.prefetcher.wait(image_path)
+        if image is None:
+            image = cv2.imread(image_path)
+            self.cache.put(image_path, image)
+        return image
+
+    def upcoming_image_paths(self, count: int) -> List[str]:
+        """Return the paths of the current image and the images following it."""
+        start = self.current_image_index
+        return self.image_paths[start:start + count]
+
+    def current_image_path(self) -> str:
+        """Return the path of the current image."""
+        return self.image_paths[self.current_image_index]
+
+    def current_source_path(self) -> Optional[str]:
+        """Return the file the current image is decoded from."""
+        return self.current_image_path()
+
+    def prefetch(self):
+        """Start decoding the current image and the images following it."""
+        self.prefetcher.prefetch(self.upcoming_image_paths(self.prefetch_count + 1))
+
+    def cache_stats(self) -> dict:
+        """Return the hit and miss counters of the image cache."""
+        return self.cache.stats()
+
+    def close(self):
+        """Stop the prefetch workers and give unlabelled claimed images back."""
+        self.prefetcher.close()
+        if self.claims is not None:
+            self.wait_for_claims()
+            # The image on screen after the last one is labelled is not given back
+            start = self.current_image_index + 1 if self.finished else self.current_image_index
+            self.claims.release(self.image_paths[start:])
+            del self.image_paths[start:]
+            self.claims.close()
+
+    def claim_more(self):
+        """Start claiming another batch of images from the shared folder when few claimed images are left."""
+        if self.claims is None or len(self.image_paths) - self.current_image_index > self.claim_batch // 2:
+            return
+        if self._claimer is not None and self._claimer.is_alive():
+            return
+        self._claimer = threading.Thread(target=self._claim_batch, name='claimer', daemon=True)
+        self._claimer.start()
+
+    def wait_for_claims(self):
+        """Wait until the batch that is being claimed has been added to the images."""
+        if self._claimer is not None:
+            self._claimer.join()
+
+    def _claim_batch(self):
+        try:
+            claimed = self.claims.claim(self._unclaimed_candidates(), self.claim_batch)
+            if len(claimed) == 0 and self.scanner.done.is_set():
+                # Every image the scan found is taken, look again for released and new images
+                self.claims.reclaim_stale()
+                self.candidates = self.load_images(self.folder_path)
+                self.candidate_index = 0
+                claimed = self.claims.claim(self._unclaimed_candidates(), self.claim_batch)
+        except OSError as error:
+            print(f'Could not claim images: {error}')
+            return
+        # Appending is atomic, the labelling thread only changes the list at the current image
+        self.image_paths.extend(claimed)
+
+    def _unclaimed_candidates(self) -> Iterator[str]:
+        while self.candidate_index < len(self.candidates):
+            self.candidate_index += 1
+            yield self.candidates[self.candidate_index - 1]
+
+    def all_labelled(self) -> bool:
+        """Return True once the last image has been labelled or if there are no images."""
+        return self.finished or len(self.image_paths) == 0
+
+    def can_go_back(self) -> bool:
+        """Return True if there is a labelled image to go back to, once finished that is the image on screen."""
+        return len(self.journal) > 0
+
+    def has_next_image(self) -> bool:
+        """Return True if an image follows the current one, waiting for the scan or the claims when the list runs out."""
+        if self.current_image_index + 1 >= len(self.image_paths):
+            if self.claims is None:
+                self.scanner.done.wait()
+            else:
+                self.claim_more()
+                self.wait_for_claims()
+        return self.current_image_index + 1 < len(self.image_paths)
+
     def next_image(self):
         """Load the next image."""
-        removed_path, removed_image = self.image_paths[self.current_image_index], self.load_image()
-        self.removed_images.append((removed_path, removed_image))
-        os.remove(removed_path)
+        removed_path = self.image_paths[self.current_image_index]
+        self.journal.stage([removed_path])
+        if not self.has_next_image():
+            # The decoded image stays on screen, the file is already staged so it is not labelled again
+            self.finished = True
+            print('No more images')
+            return
         self.image_paths.pop(self.current_image_index)
-        self.cache = ('', None)
+        self.cache.discard(removed_path)
+        self.current = ('', None)
+        self.claim_more()
+        self.prefetch()
 
     def previous_image(self):
         """Load the previous image."""
-        if len(self.removed_images) == 0:
+        recovered_paths = self.journal.restore()
+        if not recovered_paths:
             print('No images to recover')
             return
-        recovered_path, recovered_image = self.removed_images.pop()
-        # Save the recovered image
-        cv2.imwrite(recovered_path, recovered_image)
+        if self.finished:
+            # The last image is still on screen and in the list, it only has to be labelled again
+            self.finished = False
+            return
 
         # Insert the recovered image back to the list
-        self.image_paths.insert(self.current_image_index, recovered_path)
+        self.image_paths.insert(self.current_image_index, recovered_paths[0])
 
 
 if __name__ == '__main__':
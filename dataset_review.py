@@ -0,0 +1,417 @@
+import io
+import os
+import re
+from typing import List, Optional, Tuple
+
+import cv2
+
+from dataset_manager import BoundingBox, BoxSet
+
+from dataset_tools import find_samples, run_parallel
+
+from image_cache import ImageCache, ImagePrefetcher
+
+from image_writer import temporary_path
+
+from session_store import SessionStore
+
+import numpy as np
+
+
+# Label files are parsed in chunks of this many files per task of the process pool
+LABEL_CHUNK_SIZE = 2048
+REVIEW_SORTS = ['path', 'boxes', 'size', 'class']
+
+
+def parse_label_files(label_paths: List[str]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """
+    Parse YOLO label files in bulk.
+
+    The files are joined into one text that numpy parses in a single call. Files with a line that
+    does not hold five numbers count as having no boxes and are reported.
+
+    Returns:
+        The number of rows of every file, an (N, 5) array with the rows of all files and the problems found.
+    """
+    counts = np.zeros(len(label_paths), dtype=np.int64)
+    texts = []
+    problems = []
+    for index, label_path in enumerate(label_paths):
+        try:
+            with open(label_path, 'rb') as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+        except OSError as error:
+            problems.append(f'{label_path}: could not be read: {error}')
+            continue
+        n_values = len(text.split())
+        if n_values % 5 != 0:
+            problems.append(f'{label_path}: {n_values} values is not a multiple of 5')
+            continue
+        if n_values > 0:
+            counts[index] = n_values // 5
+            texts.append((index, text))
+    if len(texts) == 0:
+        return counts, np.zeros((0, 5)), problems
+    try:
+        values = np.loadtxt(io.BytesIO(b'\n'.join(text for _, text in texts)), dtype=np.float64, ndmin=2)
+        if values.shape[1] == 5:
+            return counts, values, problems
+    except ValueError:
+        pass
+    # A file has a value that is not a number or rows of other lengths, parse them line by line to find it
+    rows = []
+    for index, text in texts:
+        lines = [(number, line.split()) for number, line in enumerate(text.splitlines(), 1) if line.strip()]
+        # Checked per line, the values of misaligned rows could otherwise still add up to a multiple of 5
+        wrong_lines = [number for number, fields in lines if len(fields) != 5]
+        if len(wrong_lines) > 0:
+            problems.append(f'{label_paths[index]}: line {wrong_lines[0]} does not have 5 values')
+            counts[index] = 0
+            continue
+        try:
+            rows.append(np.array([fields for _, fields in lines], dtype=np.float64))
+        except ValueError as error:
+            problems.append(f'{label_paths[index]}: could not be parsed: {error}')
+            counts[index] = 0
+    return counts, np.concatenate(rows) if len(rows) > 0 else np.zeros((0, 5)), problems
+
+
+class LabelTable:
+    """
+    Class to hold all labels of a dataset in columnar arrays.
+
+    The boxes of image `i` are rows `offsets[i]` to `offsets[i + 1]` of `class_ids` and `boxes`,
+    the latter in normalized YOLO center, width and height. The arrays are cached in a binary
+    sidecar together with the size and mtime of every label file, so on later loads only changed
+    label files are parsed again.
+    """
+
+    sidecar_version = 1
+
+    def __init__(self, dataset_dir: str, workers: Optional[int] = None):
+        self.dataset_dir = dataset_dir
+        self.sidecar_path = os.path.join(dataset_dir, '.label', 'labels.npz')
+        self.splits = []
+        self.image_paths = []
+        self.label_paths = []
+        for split, image_path, label_path in find_samples(dataset_dir):
+            if image_path is None:
+                continue
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            self.splits.append(split)
+            self.image_paths.append(image_path)
+            # Images without a label file have no boxes, a file is created when they get some
+            self.label_paths.append(label_path or os.path.join(dataset_dir, 'labels', split, stem + '.txt'))
+        # Label paths are all joined to the dataset folder, so cutting off its prefix is much faster than os.path.relpath
+        prefix_length = len(os.path.join(dataset_dir, ''))
+        self.relative_paths = [label_path[prefix_length:] for label_path in self.label_paths]
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.class_ids = np.zeros(0, dtype=np.int32)
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.load(workers)
+
+    def load(self, workers: Optional[int] = None) -> List[str]:
+        """Fill the arrays from the sidecar and the label files changed since it was written, return the problems found."""
+        stats = np.zeros((len(self.label_paths), 2), dtype=np.int64)
+        for index, label_path in enumerate(self.label_paths):
+            try:
+                stat = os.stat(label_path)
+                stats[index] = stat.st_size, stat.st_mtime_ns
+            except FileNotFoundError:
+                stats[index] = -1, 0
+
+        # Every image takes its rows from one source: the cached arrays or the newly parsed ones after them
+        starts = np.zeros(len(self.label_paths), dtype=np.int64)
+        counts = np.zeros(len(self.label_paths), dtype=np.int64)
+        source_class_ids, source_boxes = [np.zeros(0, dtype=np.int32)], [np.zeros((0, 4), dtype=np.float32)]
+        stale = list(range(len(self.label_paths)))
+        cache = self.load_sidecar()
+        if cache is not None:
+            cached_index = {path: index for index, path in enumerate(cache['paths'].tolist())}
+            cached = np.array([cached_index.get(path, -1) for path in self.relative_paths], dtype=np.int64)
+            fresh = cached >= 0
+            fresh[fresh] = np.all(cache['stats'][cached[fresh]] == stats[fresh], axis=1)
+            starts[fresh] = cache['offsets'][cached[fresh]]
+            counts[fresh] = cache['offsets'][cached[fresh] + 1] - starts[fresh]
+            stale = np.flatnonzero(~fresh).tolist()
+            source_class_ids.append(cache['class_ids'])
+            source_boxes.append(cache['boxes'])
+
+        problems = []
+        if len(stale) > 0:
+            print(f'Parsing {len(stale)} label files')
+            chunks = [[self.label_paths[index] for index in stale[start:start + LABEL_CHUNK_SIZE]] for start in range(0, len(stale), LABEL_CHUNK_SIZE)]
+            parsed_start = sum(len(class_ids) for class_ids in source_class_ids)
+            chunk_start = 0
+            for chunk_counts, values, chunk_problems in run_parallel(parse_label_files, chunks, workers, 'chunks'):
+                chunk_indices = stale[chunk_start:chunk_start + len(chunk_counts)]
+                counts[chunk_indices] = chunk_counts
+                starts[chunk_indices] = parsed_start + np.concatenate([[0], np.cumsum(chunk_counts)[:-1]])
+                parsed_start += len(values)
+                chunk_start += len(chunk_counts)
+                source_class_ids.append(values[:, 0].astype(np.int32))
+                source_boxes.append(values[:, 1:].astype(np.float32))
+                problems.extend(chunk_problems)
+            for problem in problems:
+                print(problem)
+
+        # Gather the rows of every image in order: image i takes rows starts[i] to starts[i] + counts[i] of the sources
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        rows = np.arange(self.offsets[-1]) + np.repeat(starts - self.offsets[:-1], counts)
+        self.class_ids = np.concatenate(source_class_ids)[rows]
+        self.boxes = np.concatenate(source_boxes)[rows]
+        self.stats = stats
+        if len(stale) > 0 or cache is None:
+            self.save_sidecar()
+        return problems
+
+    def load_sidecar(self) -> Optional[dict]:
+        """Load the cached arrays, None if there is no usable sidecar."""
+        if not os.path.exists(self.sidecar_path):
+            return None
+        try:
+            with np.load(self.sidecar_path) as sidecar:
+                if int(sidecar['version']) != self.sidecar_version:
+                    return None
+                return {key: sidecar[key] for key in ('paths', 'stats', 'offsets', 'class_ids', 'boxes')}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_sidecar(self):
+        """Write the arrays through a temporary file."""
+        os.makedirs(os.path.dirname(self.sidecar_path), exist_ok=True)
+        tmp_path = temporary_path(self.sidecar_path)
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=self.sidecar_version,
+                paths=np.array(self.relative_paths, dtype=str),
+                stats=self.stats,
+                offsets=self.offsets,
+                class_ids=self.class_ids,
+                boxes=self.boxes,
+            )
+        os.replace(tmp_path, self.sidecar_path)
+
+    def box_counts(self) -> np.ndarray:
+        """Return the number of boxes of every image."""
+        return np.diff(self.offsets)
+
+    def class_counts(self, n_classes: int) -> List[int]:
+        """Return the number of boxes per class."""
+        valid = (self.class_ids >= 0) & (self.class_ids < n_classes)
+        return np.bincount(self.class_ids[valid], minlength=n_classes).tolist()
+
+    def unknown_class_ids(self, n_classes: int) -> List[int]:
+        """Return the class ids of boxes that are not one of the first `n_classes` classes."""
+        return np.unique(self.class_ids[(self.class_ids < 0) | (self.class_ids >= n_classes)]).tolist()
+
+    def labels(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the class ids and the normalized boxes of an image."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.class_ids[start:end], self.boxes[start:end]
+
+    def select(self,
+               class_id: Optional[int] = None,
+               min_boxes: Optional[int] = None,
+               max_boxes: Optional[int] = None,
+               smaller_than: Optional[float] = None,
+               sort: str = 'path'
+               ) -> np.ndarray:
+        """
+        Return the indices of the images to review.
+
+        Args:
+            class_id: Only images with a box of this class.
+            min_boxes: Only images with at least this many boxes.
+            max_boxes: Only images with at most this many boxes.
+            smaller_than: Only images with a box whose side, the square root of its normalized area, is below this.
+            sort: 'path', 'boxes' for the most boxes first, 'size' for the smallest box first or 'class' for the most boxes of class_id first.
+        """
+        counts = self.box_counts()
+        image_of_box = np.repeat(np.arange(len(counts)), counts)
+        mask = np.ones(len(counts), dtype=bool)
+        if class_id is not None:
+            class_counts = np.bincount(image_of_box[self.class_ids == class_id], minlength=len(counts))
+            mask &= class_counts > 0
+        if min_boxes is not None:
+            mask &= counts >= min_boxes
+        if max_boxes is not None:
+            mask &= counts <= max_boxes
+        smallest = np.full(len(counts), np.inf)
+        if smaller_than is not None or sort == 'size':
+            np.minimum.at(smallest, image_of_box, np.sqrt(np.abs(self.boxes[:, 2] * self.boxes[:, 3])))
+        if smaller_than is not None:
+            mask &= smallest < smaller_than
+
+        indices = np.flatnonzero(mask)
+        if sort == 'boxes':
+            return indices[np.argsort(-counts[indices], kind='stable')]
+        if sort == 'size':
+            return indices[np.argsort(smallest[indices], kind='stable')]
+        if sort == 'class' and class_id is not None:
+            return indices[np.argsort(-class_counts[indices], kind='stable')]
+        return indices
+
+    def set_labels(self, index: int, class_ids: np.ndarray, boxes: np.ndarray):
+        """Replace the labels of an image and write its label file in place."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        self.class_ids = np.concatenate([self.class_ids[:start], class_ids.astype(np.int32), self.class_ids[end:]])
+        self.boxes = np.concatenate([self.boxes[:start], boxes.astype(np.float32), self.boxes[end:]])
+        self.offsets[index + 1:] += len(class_ids) - (end - start)
+
+        label_path = self.label_paths[index]
+        rows = np.column_stack([class_ids, boxes])
+        text = ''.join(f'{int(row[0])} {row[1]:.6f} {row[2]:.6f} {row[3]:.6f} {row[4]:.6f}\n' for row in rows)
+        os.makedirs(os.path.dirname(label_path), exist_ok=True)
+        tmp_path = temporary_path(label_path)
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, label_path)
+        stat = os.stat(label_path)
+        self.stats[index] = stat.st_size, stat.st_mtime_ns
+
+
+class ReviewManager:
+    """
+    Class to go through the images of an existing dataset with their boxes, in place of ImageManager.
+
+    The images are shown in the order of a LabelTable selection. Nothing is removed, Next and
+    Previous only move through the selection, and edited labels are written back in place.
+    """
+
+    def __init__(self,
+                 table: LabelTable,
+                 indices: np.ndarray,
+                 prefetch_count: int = 3,
+                 cache_size: int = 1024 * 1024 * 1024,
+                 n_workers: int = 2,
+                 store: Optional[SessionStore] = None
+                 ):
+        self.table = table
+        self.indices = indices.tolist()
+        self.image_paths = [table.image_paths[index] for index in self.indices]
+        self.current_image_index = 0
+        self.store = store
+        self.edited = 0
+        print(f'Reviewing {len(self.image_paths)} of {len(table.image_paths)} images')
+
+        self.current = ('', None)
+        self.prefetch_count = prefetch_count
+        self.cache = ImageCache(cache_size)
+        self.prefetcher = ImagePrefetcher(self.cache, cv2.imread, n_workers)
+
+    def load_image(self) -> np.ndarray:
+        """Load the current image from file."""
+        image_path = self.current_image_path()
+        if image_path == self.current[0]:
+            return self.current[1]
+        image = self.read_image(image_path)
+        self.current = (image_path, image)
+        self.prefetch()
+        return image
+
+    def load_preview(self, scale: float) -> Optional[np.ndarray]:
+        """Dataset images are decoded in full right away."""
+        return None
+
+    def full_image_ready(self) -> bool:
+        """Return True, the current image is decoded on demand."""
+        return True
+
+    def current_image_size(self) -> Tuple[int, int]:
+        """Return the width and height of the current image."""
+        image = self.load_image()
+        return image.shape[1], image.shape[0]
+
+    def read_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Return any image from the cache, decoding and caching it if needed, safe to call from other threads."""
+        image = self.cache.peek(image_path)
+        if image is None:
+            image = self.prefetcher.wait(image_path)
+        if image is None:
+            image = cv2.imread(image_path)
+            self.cache.put(image_path, image)
+        return image
+
+    def upcoming_image_paths(self, count: int) -> List[str]:
+        """Return the paths of the current image and the images following it."""
+        start = self.current_image_index
+        return self.image_paths[start:start + count]
+
+    def current_image_path(self) -> str:
+        """Return the path of the current image."""
+        return self.image_paths[self.current_image_index]
+
+    def current_source_path(self) -> Optional[str]:
+        """Return the file the current image is decoded from."""
+        return self.current_image_path()
+
+    def current_boxes(self) -> List[BoundingBox]:
+        """Return the saved boxes of the current image in image coordinates."""
+        class_ids, boxes = self.table.labels(self.indices[self.current_image_index])
+        width, height = self.current_image_size()
+        return list(BoxSet.from_yolo(np.column_stack([class_ids, boxes]), width, height))
+
+    def save_boxes(self, boxes: BoxSet):
+        """Write the boxes of the current image back to its label file if they changed."""
+        index = self.indices[self.current_image_index]
+        width, height = self.current_image_size()
+        boxes = boxes.clip(width, height)
+        new_boxes = boxes.to_yolo(width, height)
+        old_class_ids, old_boxes = self.table.labels(index)
+        # The saved boxes went through float32 and six decimals, so unchanged boxes only match approximately
+        if np.array_equal(old_class_ids, boxes.class_ids) and np.allclose(old_boxes, new_boxes, atol=1e-5):
+            return
+        self.table.set_labels(index, boxes.class_ids, new_boxes)
+        self.edited += 1
+        match = re.fullmatch(r'image(\d+)', os.path.splitext(os.path.basename(self.table.image_paths[index]))[0])
+        if self.store is not None and match is not None:
+            class_ids, counts = np.unique(boxes.class_ids, return_counts=True)
+            self.store.set_class_counts(int(match.group(1)), dict(zip(class_ids.tolist(), counts.tolist())))
+
+    def class_counts(self, n_classes: int) -> List[int]:
+        """Return the number of saved boxes per class."""
+        return self.table.class_counts(n_classes)
+
+    def prefetch(self):
+        """Start decoding the current image and the images following it."""
+        self.prefetcher.prefetch(self.upcoming_image_paths(self.prefetch_count + 1))
+
+    def cache_stats(self) -> dict:
+        """Return the hit and miss counters of the image cache."""
+        return self.cache.stats()
+
+    def close(self):
+        """Stop the prefetch workers and update the sidecar with the edited labels."""
+        self.prefetcher.close()
+        if self.edited > 0:
+            self.table.save_sidecar()
+            print(f'{self.edited} label files changed')
+
+    def next_image(self):
+        """Move to the next image of the selection."""
+        if self.current_image_index + 1 >= len(self.image_paths):
+            print('No more images')
+            return
+        self.current_image_index += 1
+        self.current = ('', None)
+        self.prefetch()
+
+    def all_labelled(self) -> bool:
+        """Return False, edits are saved in place so the last image can be saved again."""
+        return False
+
+    def can_go_back(self) -> bool:
+        """Return True if the current image is not the first of the selection."""
+        return self.current_image_index > 0
+
+    def previous_image(self):
+        """Move back to the previous image of the selection."""
+        if self.current_image_index == 0:
+            print('No images to go back to')
+            return
+        self.current_image_index -= 1
+        self.current = ('', None)
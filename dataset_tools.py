@@ -0,0 +1,324 @@
+import ast
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+
+from dataset_manager import BoxSet, ClassDescription, DatasetManager
+
+from image_writer import file_digest, link_or_copy
+
+import numpy as np
+
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+SPLITS = ['train', 'validation', 'test']
+
+
+class ProgressReporter:
+    """Class to print how many items have been processed and at what rate."""
+
+    def __init__(self, total: int, unit: str = 'images', interval: float = 1.0):
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.last_report = 0.0
+
+    def update(self, count: int = 1):
+        """Count processed items and print the progress at most once per interval."""
+        self.done += count
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            print(f'\r{self.done}/{self.total} {self.unit}, {self.rate():.1f} {self.unit}/s', end='', flush=True)
+
+    def rate(self) -> float:
+        """Return the number of items processed per second."""
+        elapsed = time.perf_counter() - self.start_time
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def finish(self):
+        """End the progress line."""
+        print(f'\r{self.done}/{self.total} {self.unit} in {time.perf_counter() - self.start_time:.1f}s, {self.rate():.1f} {self.unit}/s')
+
+
+def read_yolo_labels(label_path: str) -> np.ndarray:
+    """
+    Read a YOLO label file into an (N, 5) array of class, x center, y center, width and height.
+
+    Raises:
+        ValueError: If the file does not contain rows of five numbers.
+    """
+    with open(label_path) as f:
+        values = f.read().split()
+    if len(values) % 5 != 0:
+        raise ValueError(f'{len(values)} values is not a multiple of 5')
+    return np.array(values, dtype=np.float64).reshape(-1, 5)
+
+
+def read_class_count(dataset_dir: str) -> Optional[int]:
+    """Read the number of classes from data.yaml, or None if it is not given."""
+    yaml_path = os.path.join(dataset_dir, 'data.yaml')
+    if not os.path.exists(yaml_path):
+        return None
+    with open(yaml_path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key.strip() == 'nc':
+                return int(value)
+    return None
+
+
+def read_class_names(dataset_dir: str) -> Optional[List[str]]:
+    """Read the class names from data.yaml, or None if they are not given."""
+    yaml_path = os.path.join(dataset_dir, 'data.yaml')
+    if not os.path.exists(yaml_path):
+        return None
+    with open(yaml_path) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key.strip() == 'names':
+                return list(ast.literal_eval(value.strip()))
+    return None
+
+
+def find_samples(dataset_dir: str) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """Pair the images and labels of every split, return (split, image path, label path) tuples."""
+    samples = []
+    for split in SPLITS:
+        image_folder = os.path.join(dataset_dir, 'images', split)
+        label_folder = os.path.join(dataset_dir, 'labels', split)
+        images: Dict[str, str] = {}
+        labels: Dict[str, str] = {}
+        if os.path.isdir(image_folder):
+            for entry in os.scandir(image_folder):
+                stem, extension = os.path.splitext(entry.name)
+                if extension.lower() in IMAGE_EXTENSIONS and not entry.name.startswith('.'):
+                    images[stem] = entry.path
+        if os.path.isdir(label_folder):
+            for entry in os.scandir(label_folder):
+                stem, extension = os.path.splitext(entry.name)
+                if extension == '.txt' and not entry.name.startswith('.'):
+                    labels[stem] = entry.path
+        for stem in sorted(images.keys() | labels.keys()):
+            samples.append((split, images.get(stem), labels.get(stem)))
+    return samples
+
+
+def validate_labels(label_path: str, n_classes: Optional[int], tolerance: float = 1e-6) -> List[str]:
+    """Return a description of every problem in a label file."""
+    try:
+        labels = read_yolo_labels(label_path)
+    except (OSError, ValueError) as error:
+        return [f'{label_path}: could not be parsed: {error}']
+
+    problems = []
+    class_ids, x_center, y_center, width, height = labels.T
+    checks = [
+        (class_ids != np.round(class_ids), 'class id is not an integer'),
+        (class_ids < 0, 'class id is negative'),
+        ((width <= 0) | (height <= 0), 'box is degenerate'),
+        ((x_center - width / 2 < -tolerance) | (x_center + width / 2 > 1 + tolerance), 'box is outside the image horizontally'),
+        ((y_center - height / 2 < -tolerance) | (y_center + height / 2 > 1 + tolerance), 'box is outside the image vertically'),
+    ]
+    if n_classes is not None:
+        checks.append((class_ids >= n_classes, f'class id is not below {n_classes}'))
+    for invalid, message in checks:
+        for row in np.flatnonzero(invalid):
+            problems.append(f'{label_path}:{row + 1}: {message}')
+    return problems
+
+
+def _validate_sample(sample: tuple) -> List[str]:
+    split, image_path, label_path, n_classes = sample
+    if label_path is None:
+        return [f'{image_path}: has no label file']
+    problems = validate_labels(label_path, n_classes)
+    if image_path is None:
+        problems.append(f'{label_path}: has no image')
+    return problems
+
+
+def letterbox(image: np.ndarray, size: Tuple[int, int], fill: int = 114) -> Tuple[np.ndarray, float, int, int]:
+    """
+    Resize an image to fit the size while keeping its aspect ratio and pad the rest.
+
+    Returns:
+        The letterboxed image, the resize ratio and the left and top padding.
+    """
+    target_width, target_height = size
+    height, width = image.shape[:2]
+    ratio = min(target_width / width, target_height / height)
+    new_width = max(1, round(width * ratio))
+    new_height = max(1, round(height * ratio))
+    interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+
+    pad_left = (target_width - new_width) // 2
+    pad_top = (target_height - new_height) // 2
+    output = np.full((target_height, target_width) + image.shape[2:], fill, dtype=image.dtype)
+    output[pad_top:pad_top + new_height, pad_left:pad_left + new_width] = resized
+    return output, ratio, pad_left, pad_top
+
+
+def _build_sample(sample: tuple) -> Optional[str]:
+    split, image_path, label_path, output_dir, size, stretch = sample
+    image = cv2.imread(image_path)
+    if image is None:
+        return f'{image_path}: could not be read'
+    try:
+        labels = read_yolo_labels(label_path) if label_path is not None else np.zeros((0, 5))
+    except (OSError, ValueError) as error:
+        return f'{label_path}: could not be parsed: {error}'
+    height, width = image.shape[:2]
+    boxes = BoxSet.from_yolo(labels, width, height)
+
+    if stretch:
+        output = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        boxes.coordinates *= [size[0] / width, size[1] / height, size[0] / width, size[1] / height]
+    else:
+        output, ratio, pad_left, pad_top = letterbox(image, size)
+        boxes.coordinates = boxes.coordinates * ratio + [pad_left, pad_top, pad_left, pad_top]
+
+    name = os.path.splitext(os.path.basename(image_path))[0]
+    cv2.imwrite(os.path.join(output_dir, 'images', split, name + os.path.splitext(image_path)[1]), output)
+    boxes.clip(*size).write_yolo(os.path.join(output_dir, 'labels', split, name + '.txt'), *size)
+    return None
+
+
+def _init_worker():
+    # Each process handles one image at a time, OpenCV threads would only compete with the other processes
+    cv2.setNumThreads(1)
+
+
+def imap_parallel(function, items: list, workers: Optional[int], unit: str = 'images') -> Iterator:
+    """Run a function over the items on a process pool, yield the results in order as they are ready and report the progress."""
+    progress = ProgressReporter(len(items), unit)
+    chunk_size = max(1, min(64, len(items) // ((workers or os.cpu_count() or 1) * 8)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        for result in executor.map(function, items, chunksize=chunk_size):
+            yield result
+            progress.update()
+    progress.finish()
+
+
+def run_parallel(function, items: list, workers: Optional[int], unit: str = 'images') -> list:
+    """Run a function over the items on a process pool and report the progress."""
+    return list(imap_parallel(function, items, workers, unit))
+
+
+def validate_dataset(args) -> int:
+    """Check every label file of a dataset, return the number of problems found."""
+    n_classes = args.n_classes if args.n_classes is not None else read_class_count(args.dataset_dir)
+    samples = [sample + (n_classes,) for sample in find_samples(args.dataset_dir)]
+
+    problems = [problem for result in run_parallel(_validate_sample, samples, args.workers) for problem in result]
+    for problem in problems[:args.max_problems]:
+        print(problem)
+    if len(problems) > args.max_problems:
+        print(f'... and {len(problems) - args.max_problems} more')
+    print(f'{len(problems)} problems in {len(samples)} samples')
+    return len(problems)
+
+
+def build_dataset(args) -> int:
+    """Write a copy of a dataset with the images resized to the training resolution, return the number of failures."""
+    size = tuple(args.size)
+    samples = find_samples(args.dataset_dir)
+    for split in {split for split, _, _ in samples}:
+        os.makedirs(os.path.join(args.output_dir, 'images', split), exist_ok=True)
+        os.makedirs(os.path.join(args.output_dir, 'labels', split), exist_ok=True)
+
+    yaml_path = os.path.join(args.dataset_dir, 'data.yaml')
+    if os.path.exists(yaml_path):
+        with open(yaml_path) as f, open(os.path.join(args.output_dir, 'data.yaml'), 'w') as output:
+            for line in f:
+                output.write(f'path: {args.output_dir}\n' if line.startswith('path:') else line)
+
+    items = [
+        (split, image_path, label_path, args.output_dir, size, args.stretch)
+        for split, image_path, label_path in samples if image_path is not None
+    ]
+    failures = [failure for failure in run_parallel(_build_sample, items, args.workers) if failure is not None]
+    for failure in failures:
+        print(failure)
+    return len(failures)
+
+
+def merge_datasets(args) -> int:
+    """
+    Combine the datasets written by the workers of a sharded session, return the number of problems.
+
+    Every sample gets a new id in the output dataset. Samples whose image was merged before are
+    skipped, so merging again after more labelling only adds the new samples.
+    """
+    workers_dir = os.path.join(args.dataset_dir, 'workers')
+    output_dir = args.output_dir or args.dataset_dir
+    worker_dirs = []
+    if os.path.isdir(workers_dir):
+        worker_dirs = sorted(entry.path for entry in os.scandir(workers_dir) if entry.is_dir())
+    if len(worker_dirs) == 0:
+        print(f'No worker datasets in {workers_dir}')
+        return 0
+
+    class_names = read_class_names(worker_dirs[0]) or []
+    worker_samples = [find_samples(worker_dir) for worker_dir in worker_dirs]
+    # The test split is listed in data.yaml once any worker has labelled test samples
+    include_test = os.path.isdir(os.path.join(output_dir, 'images', 'test')) or any(
+        split == 'test' for samples in worker_samples for split, _, _ in samples
+    )
+    dataset_manager = DatasetManager(output_dir, ClassDescription(class_names), include_test=include_test)
+    dataset_manager.create_folder_structure()
+    problems = 0
+    merged = 0
+    skipped = 0
+    for worker_dir, samples in zip(worker_dirs, worker_samples):
+        worker_names = read_class_names(worker_dir) or []
+        if worker_names != class_names:
+            print(f'{worker_dir}: classes {worker_names} differ from {class_names}, skipped')
+            problems += 1
+            continue
+        print(f'Merging {len(samples)} samples from {worker_dir}')
+        progress = ProgressReporter(len(samples), 'samples')
+        for split, image_path, label_path in samples:
+            progress.update()
+            if image_path is None or label_path is None:
+                print(f'{image_path or label_path}: has no {"label" if label_path is None else "image"}, skipped')
+                problems += 1
+                continue
+            digest = file_digest(image_path)
+            if dataset_manager.store.find_by_hash(digest) is not None:
+                skipped += 1
+                continue
+            try:
+                class_ids = read_yolo_labels(label_path)[:, 0].astype(np.int64)
+            except (OSError, ValueError) as error:
+                print(f'{label_path}: could not be parsed: {error}, skipped')
+                problems += 1
+                continue
+            extension = os.path.splitext(image_path)[1].lower()
+            ids, counts = np.unique(class_ids, return_counts=True)
+            sample_id, new_image_path, new_label_path = dataset_manager.store.add_sample(
+                split,
+                dict(zip(ids.tolist(), counts.tolist())),
+                lambda sample_id: (
+                    os.path.join(output_dir, 'images', split, f'image{sample_id}{extension}'),
+                    os.path.join(output_dir, 'labels', split, f'image{sample_id}.txt'),
+                )
+            )
+            os.makedirs(os.path.dirname(new_image_path), exist_ok=True)
+            os.makedirs(os.path.dirname(new_label_path), exist_ok=True)
+            link_or_copy(image_path, new_image_path)
+            # Labels are edited in place, for example when reviewing, so the merged dataset gets its own copy
+            shutil.copyfile(label_path, new_label_path)
+            dataset_manager.store.set_source_hash(sample_id, digest)
+            merged += 1
+        progress.finish()
+    dataset_manager.close()
+    print(f'{merged} samples merged into {output_dir}, {skipped} were merged before')
+    return problems
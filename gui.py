@@ -1,6 +1,20 @@
-from typing import List, Tuple
+import time
+from collections import OrderedDict
+from typing import Tuple
 
-from dataset_manager import BoundingBox, DatasetManager, ImageManager
+from box_index import BoxIndex
+
+from box_tracker import BoxPropagator
+
+from class_search import ClassIndex
+
+from dataset_manager import BoundingBox, BoxSet, DatasetManager, ImageManager
+
+from image_pyramid import ImagePyramid
+
+from metrics import Metrics
+
+from prelabel import PrelabelWorker
 
 import numpy as np
 
@@ -45,10 +59,104 @@ class ColorManager:
         return selected_color
 
 
+class TextCache:
+    """Class to cache fonts and rendered text surfaces."""
+
+    def __init__(self, max_surfaces: int = 1024):
+        """Initialize the caches."""
+        self.max_surfaces = max_surfaces
+        self.fonts = {}
+        self.surfaces = OrderedDict()
+
+    def font(self, size: int = 24) -> pg.font.Font:
+        """Get the default font in the given size, creating it the first time."""
+        font = self.fonts.get(size)
+        if font is None:
+            font = pg.font.SysFont(None, size)
+            self.fonts[size] = font
+        return font
+
+    def render(self, text: str, color: Tuple[int, int, int], size: int = 24) -> pg.Surface:
+        """Get the rendered text, evicting the least recently used surface when the cache is full."""
+        key = (text, tuple(color), size)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.font(size).render(text, True, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_surfaces:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+class TileCache:
+    """
+    Class to cache pygame surfaces of an image pyramid.
+
+    Every level is converted to a display surface once, tiles are subsurfaces of it and only the
+    tiles scaled to the screen are kept in a least recently used cache.
+    """
+
+    def __init__(self, tile_size: int = 256, max_tiles: int = 512):
+        """Initialize the cache."""
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.level_surfaces = {}
+        self.tiles = OrderedDict()
+
+    def clear(self):
+        """Remove all surfaces."""
+        self.level_surfaces.clear()
+        self.tiles.clear()
+
+    def level_surface(self, pyramid: ImagePyramid, level: int) -> pg.Surface:
+        """Get a pyramid level as a surface, converting it the first time."""
+        surface = self.level_surfaces.get(level)
+        if surface is None:
+            image = pyramid.levels[level]
+            surface = pg.image.frombuffer(image, (image.shape[1], image.shape[0]), 'RGB')
+            if pg.display.get_surface() is not None:
+                surface = surface.convert()
+            self.level_surfaces[level] = surface
+        return surface
+
+    def get(self, pyramid: ImagePyramid, level: int, tile_x: int, tile_y: int, size: Tuple[int, int]) -> pg.Surface:
+        """Get a tile of a pyramid level scaled to the given size."""
+        key = (level, tile_x, tile_y, size)
+        surface = self.tiles.get(key)
+        if surface is not None:
+            self.tiles.move_to_end(key)
+            return surface
+
+        level_surface = self.level_surface(pyramid, level)
+        tile_rect = pg.Rect(tile_x * self.tile_size, tile_y * self.tile_size, self.tile_size, self.tile_size)
+        tile_rect = tile_rect.clip(level_surface.get_rect())
+        surface = pg.transform.scale(level_surface.subsurface(tile_rect), size)
+        self.tiles[key] = surface
+        if len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return surface
+
+
 class ImageLabeler:
     """Class for handeling the gui for labeling images."""
 
-    def __init__(self, image_manager: ImageManager, dataset_manager: DatasetManager, screen_size=(800, 800), default_scale=1.0):
+    def __init__(self,
+                 image_manager: ImageManager,
+                 dataset_manager: DatasetManager,
+                 screen_size=(800, 800),
+                 default_scale=1.0,
+                 max_fps=60,
+                 idle_timeout=250,
+                 prelabel_worker: PrelabelWorker = None,
+                 prelabel_ahead=4,
+                 metrics: Metrics = None,
+                 show_metrics=False,
+                 box_propagator: BoxPropagator = None,
+                 progressive=True,
+                 review=False
+                 ):
         """Initialize the image labeler."""
         pg.init()
         self.menu_height = 200
@@ -59,7 +167,7 @@ class ImageLabeler:
         self.image_manager = image_manager
         self.dataset_manager = dataset_manager
 
-        self.bounding_boxes: List[BoundingBox] = []
+        self.bounding_boxes = BoxIndex()
         self.drawing = False
         self.start_pos = None
         self.current_box = None
@@ -74,11 +182,129 @@ class ImageLabeler:
         # Button setup
         self.buttons = self.dataset_manager.class_description.class_names
         self.current_class = 0
+        # Only the rows of the class list that are on screen are drawn, rows are found from the position by arithmetic
+        self.search_height = 40
+        self.row_height = 60
+        self.button_height = 50
+        self.class_index = ClassIndex(self.buttons)
+        self.searching = False
+        self.search_text = ''
+        self.visible_classes = list(range(len(self.buttons)))
         self.color_manager = ColorManager()
-        self.class_counts = [0 for _ in range(len(self.buttons))]
+        self.text_cache = TextCache()
+        self.tile_cache = TileCache()
+        self.pyramid = None
+        # New images are shown from a reduced resolution preview until the full image is decoded
+        self.progressive = progressive
+        self.preview_poll = 20
+        # Reused destination for scaling the visible part of the image when zoomed in
+        self.scale_target = None
+        # When reviewing, the image manager holds the saved boxes of existing samples and writes edits back in place
+        self.review = review
+        if review:
+            self.class_counts = self.image_manager.class_counts(len(self.buttons))
+        else:
+            self.class_counts = self.dataset_manager.class_counts()
         self.menu_scroll_offset = 0
 
         self.remove_boxes = False
+        # Images gone back to since the last save, only these can be redone, the undo history of earlier sessions is not
+        self.undone_count = 0
+
+        # Rendering only happens when the canvas or the menu has changed
+        self.clock = pg.time.Clock()
+        self.max_fps = max_fps
+        self.idle_timeout = idle_timeout
+        self.canvas_rect = pg.Rect(0, 0, self.screen_size[0] - self.menu_width, self.screen_size[1])
+        self.menu_rect = pg.Rect(self.screen_size[0] - self.menu_width, 0, self.menu_width, self.screen_size[1])
+        self.dirty_canvas = True
+        self.dirty_menu = True
+
+        # Model proposals are added to the boxes when they are ready for the current image
+        self.prelabel_worker = prelabel_worker
+        self.prelabel_ahead = prelabel_ahead
+        self.pending_proposals = None
+        self.request_proposals()
+
+        # Boxes of the previous image are tracked into the next one when a propagator is given
+        self.box_propagator = box_propagator
+
+        # The overlay is toggled with F3 and refreshed at most every overlay_interval seconds
+        self.metrics = metrics
+        self.show_metrics = show_metrics and metrics is not None
+        self.overlay_interval = 0.5
+        self.last_overlay = 0.0
+        self.load_saved_boxes()
+
+    def request_proposals(self):
+        """Ask the pre-labelling worker for proposals for the current image and the images after it."""
+        if self.prelabel_worker is None:
+            return
+        self.prelabel_worker.schedule(self.image_manager.upcoming_image_paths(self.prelabel_ahead + 1))
+        self.pending_proposals = self.image_manager.current_image_path()
+        self.add_proposals()
+
+    def add_proposals(self):
+        """Add the proposals for the current image once they are ready."""
+        if self.pending_proposals is None:
+            return
+        proposals = self.prelabel_worker.get(self.pending_proposals)
+        if proposals is None:
+            return
+        self.pending_proposals = None
+        self.add_boxes(proposals)
+
+    def request_propagation(self, previous_image, previous_boxes: BoxSet):
+        """Start tracking the boxes of the image that was just saved into the current image."""
+        if self.box_propagator is None or len(previous_boxes) == 0:
+            return
+        self.box_propagator.submit(previous_image, self.image_manager.current_image_path(), previous_boxes)
+
+    def add_propagated_boxes(self):
+        """Add the boxes tracked from the previous image once they are ready."""
+        if self.box_propagator is None:
+            return
+        boxes = self.box_propagator.get(self.image_manager.current_image_path())
+        if boxes is not None:
+            self.add_boxes(boxes)
+
+    def add_boxes(self, boxes, max_overlap: float = 0.7):
+        """Add boxes that do not duplicate a box of the same class already on the image."""
+        added = False
+        for box in boxes:
+            duplicate = False
+            for other in self.bounding_boxes.query_rect(box.x_min, box.y_min, box.x_max, box.y_max):
+                if other.class_id != box.class_id:
+                    continue
+                width = min(box.x_max, other.x_max) - max(box.x_min, other.x_min)
+                height = min(box.y_max, other.y_max) - max(box.y_min, other.y_min)
+                intersection = max(0.0, width) * max(0.0, height)
+                union = box.area() + other.area() - intersection
+                if union > 0 and intersection / union > max_overlap:
+                    duplicate = True
+                    break
+            if not duplicate:
+                self.bounding_boxes.add(box)
+                self.class_counts[box.class_id] += 1
+                added = True
+        if added:
+            self.mark_dirty(canvas=True, menu=True)
+
+    def mark_dirty(self, canvas=True, menu=False):
+        """Mark parts of the screen to be redrawn."""
+        self.dirty_canvas = self.dirty_canvas or canvas
+        self.dirty_menu = self.dirty_menu or menu
+
+    def get_events(self) -> list:
+        """Return pending events, waiting for one when there is nothing to redraw."""
+        if self.dirty_canvas or self.dirty_menu:
+            return pg.event.get()
+        # Check often for the full resolution image while a preview is shown
+        timeout = self.preview_poll if self.pyramid is not None and self.pyramid.preview else self.idle_timeout
+        event = pg.event.wait(timeout)
+        if event.type == pg.NOEVENT:
+            return []
+        return [event] + pg.event.get()
 
     def apply_transform(self, pos: Tuple[int, int]) -> Tuple[float, float]:
         """
@@ -95,23 +321,48 @@ class ImageLabeler:
     def initialize_image_pos(self):
         """Initialize the scale and offset of the image."""
         self.scale = self.default_scale
-        image = self.image_manager.load_image()
+        width, height = self.image_manager.current_image_size()
         self.offset = [
-            (self.screen_size[0] - self.menu_width) / 2 - image.shape[1] * self.scale / 2,
-            (self.screen_size[1] - self.menu_height) / 2 - image.shape[0] * self.scale / 2,
+            (self.screen_size[0] - self.menu_width) / 2 - width * self.scale / 2,
+            (self.screen_size[1] - self.menu_height) / 2 - height * self.scale / 2,
         ]
 
     def event(self):
         """Handle events."""
-        self.mouse_pos = pg.mouse.get_pos()
+        self.handle_events(self.get_events())
 
-        for event in pg.event.get():
+    def handle_events(self, events: list):
+        """Handle the given events."""
+        self.mouse_pos = pg.mouse.get_pos()
+        if self.pyramid is not None and self.pyramid.preview and self.image_manager.full_image_ready():
+            self.mark_dirty()
+        self.add_proposals()
+        self.add_propagated_boxes()
+
+        for event in events:
+            if event.type in (pg.VIDEOEXPOSE, pg.WINDOWEXPOSED):
+                self.mark_dirty(canvas=True, menu=True)
             if event.type == pg.QUIT:
                 self.running = False
+                self.dataset_manager.flush()
+            # Keys go to the search field while it is active, shift still toggles removing since its release is handled below
+            if self.searching and (event.type == pg.TEXTINPUT or event.type == pg.KEYDOWN and event.key != pg.K_LSHIFT):
+                self.handle_search_key(event)
+                continue
             if event.type == pg.KEYDOWN:
+                if event.key == pg.K_f and event.mod & pg.KMOD_CTRL:
+                    self.start_search()
+                    continue
                 # check for shift key
                 if event.key == pg.K_LSHIFT:
                     self.remove_boxes = not self.remove_boxes
+                if event.key == pg.K_y and event.mod & pg.KMOD_CTRL:
+                    self.redo()
+                if event.key == pg.K_a:
+                    self.accept_boxes()
+                if event.key == pg.K_F3 and self.metrics is not None:
+                    self.show_metrics = not self.show_metrics
+                    self.mark_dirty()
             if event.type == pg.KEYUP:
                 if event.key == pg.K_LSHIFT:
                     self.remove_boxes = not self.remove_boxes
@@ -122,19 +373,17 @@ class ImageLabeler:
                         self.check_button_click(self.mouse_pos)
                     self.check_navigation_click(self.mouse_pos)
                 if event.type == pg.MOUSEWHEEL:
-                    self.menu_scroll_offset -= event.y * 20
-                    self.menu_scroll_offset = min(self.menu_scroll_offset, len(self.buttons) * 60 - self.screen_size[1] + 70)
-                    self.menu_scroll_offset = max(0, self.menu_scroll_offset)
+                    self.scroll_menu(-event.y * 20)
                 continue
 
             if event.type == pg.MOUSEBUTTONDOWN:
                 if event.button == 1:
                     if self.remove_boxes:
-                        for box in self.bounding_boxes:
-                            if self.is_point_inside(box, self.apply_transform(event.pos)):
-                                self.bounding_boxes.remove(box)
-                                self.class_counts[box.class_id] -= 1
-                                break
+                        box = self.bounding_boxes.query_point(self.apply_transform(event.pos))
+                        if box is not None:
+                            self.bounding_boxes.remove(box)
+                            self.class_counts[box.class_id] -= 1
+                            self.mark_dirty(canvas=True, menu=True)
                     else:
                         self.drawing = True
                         self.start_pos = self.apply_transform(event.pos)
@@ -155,10 +404,12 @@ class ImageLabeler:
                     self.drawing = False
                     self.start_pos = None
                     self.current_box = None
+                    self.mark_dirty()
                     # Only add boxes with an area greater than 1 pixel
                     if box.area() > 1:
-                        self.bounding_boxes.append(box)
+                        self.bounding_boxes.add(box)
                         self.class_counts[self.current_class] += 1
+                        self.mark_dirty(canvas=True, menu=True)
                 elif event.button == 3:
                     self.moving = False
                     self.last_mouse_pos = None
@@ -172,12 +423,14 @@ class ImageLabeler:
                     x, y = min(x1, x2), min(y1, y2)
                     width, height = abs(x2 - x1), abs(y2 - y1)
                     self.current_box = (x, y, width, height)
+                    self.mark_dirty()
 
                 if self.moving and self.last_mouse_pos:
                     dx, dy = event.pos[0] - self.last_mouse_pos[0], event.pos[1] - self.last_mouse_pos[1]
                     self.offset[0] += dx
                     self.offset[1] += dy
                     self.last_mouse_pos = event.pos
+                    self.mark_dirty()
 
             if event.type == pg.MOUSEWHEEL:
                 if self.mouse_pos[0] <= self.screen_size[0] - self.menu_width:
@@ -190,6 +443,7 @@ class ImageLabeler:
 
                     self.offset[0] = mouse_x - pre_zoom_mouse_pos[0] * self.scale
                     self.offset[1] = mouse_y - pre_zoom_mouse_pos[1] * self.scale
+                    self.mark_dirty()
 
     def is_point_inside(self, box: BoundingBox, pos: Tuple[float, float]) -> bool:
         """Check if a point is inside a bounding box."""
@@ -198,17 +452,51 @@ class ImageLabeler:
 
     def check_button_click(self, pos):
         """Check if a button was clicked."""
-        button_height = 50
-        for i, label in enumerate(self.buttons):
-            y_offset = 10 + i * (button_height + 10) - self.menu_scroll_offset
-            button_rect = pg.Rect(
-                self.screen_size[0] - self.menu_width + 10,
-                y_offset,
-                self.menu_width - 20,
-                button_height
-            )
-            if button_rect.collidepoint(pos):
-                self.current_class = i
+        x, y = pos
+        if y < self.search_height:
+            self.start_search()
+            return
+        if not self.screen_size[0] - self.menu_width + 10 <= x < self.screen_size[0] - 10:
+            return
+        row, row_y = divmod(y - self.search_height - 10 + self.menu_scroll_offset, self.row_height)
+        if 0 <= row < len(self.visible_classes) and row_y < self.button_height:
+            self.current_class = self.visible_classes[row]
+            self.mark_dirty(canvas=False, menu=True)
+
+    def scroll_menu(self, distance: int):
+        """Scroll the class list, keeping its last row above the navigation buttons."""
+        list_height = self.screen_size[1] - 70 - self.search_height
+        max_offset = len(self.visible_classes) * self.row_height + 10 - list_height
+        self.menu_scroll_offset = max(0, min(self.menu_scroll_offset + distance, max_offset))
+        self.mark_dirty(canvas=False, menu=True)
+
+    def start_search(self):
+        """Start typing a filter for the class list."""
+        self.searching = True
+        pg.key.start_text_input()
+        self.mark_dirty(canvas=False, menu=True)
+
+    def set_search_text(self, text: str):
+        """Filter the class list and scroll back to its top."""
+        self.search_text = text
+        self.visible_classes = self.class_index.search(text)
+        self.menu_scroll_offset = 0
+        self.mark_dirty(canvas=False, menu=True)
+
+    def handle_search_key(self, event):
+        """Edit the filter while searching, Enter picks the first match and Escape clears the filter."""
+        if event.type == pg.TEXTINPUT:
+            self.set_search_text(self.search_text + event.text)
+        elif event.key == pg.K_BACKSPACE:
+            self.set_search_text(self.search_text[:-1])
+        elif event.key in (pg.K_RETURN, pg.K_KP_ENTER, pg.K_ESCAPE):
+            if event.key == pg.K_ESCAPE:
+                self.set_search_text('')
+            elif len(self.visible_classes) > 0:
+                self.current_class = self.visible_classes[0]
+            self.searching = False
+            pg.key.stop_text_input()
+            self.mark_dirty(canvas=False, menu=True)
 
     def check_navigation_click(self, pos):
         """Check if a navigation button was clicked."""
@@ -218,33 +506,90 @@ class ImageLabeler:
         next_button_rect = pg.Rect(self.screen_size[0] - button_width - 10, self.screen_size[1] - button_height - 10, button_width, button_height)
 
         if prev_button_rect.collidepoint(pos):
-            self.dataset_manager.remove_last_image()
-            self.image_manager.previous_image()
+            # Keep the image folder and the dataset in step, a sample is only removed if its image can be brought back
+            if not self.image_manager.can_go_back():
+                print('No images to go back to')
+            elif self.review or self.dataset_manager.remove_last_image():
+                if self.review:
+                    # Edits are saved when going back as when going on, the class counts already include them
+                    self.image_manager.save_boxes(BoxSet.from_boxes(self.bounding_boxes))
+                else:
+                    self.undone_count += 1
+                if self.box_propagator is not None:
+                    self.box_propagator.cancel()
+                self.image_manager.previous_image()
+                self.load_saved_boxes()
+                self.request_proposals()
+                self.mark_dirty(canvas=True, menu=True)
 
         elif next_button_rect.collidepoint(pos):
-            self.dataset_manager.save_image(self.image_manager.load_image(), self.bounding_boxes)
-            self.bounding_boxes = []
+            # Saving the last image again would add it to the dataset twice
+            if self.image_manager.all_labelled():
+                print('All images are labelled')
+                return
+            image = self.image_manager.load_image()
+            boxes = BoxSet.from_boxes(self.bounding_boxes)
+            if self.review:
+                self.image_manager.save_boxes(boxes)
+            else:
+                self.dataset_manager.save_image(image, boxes, self.image_manager.current_source_path())
+                # Saving clears the removed samples, so there is nothing left to redo
+                self.undone_count = 0
+            self.bounding_boxes.clear()
             self.image_manager.next_image()
             self.initialize_image_pos()
+            self.load_saved_boxes()
+            self.request_proposals()
+            self.request_propagation(image, boxes)
+            self.mark_dirty(canvas=True, menu=True)
+
+    def load_saved_boxes(self):
+        """Show the saved boxes of the current image when reviewing a dataset."""
+        if not self.review:
+            return
+        self.bounding_boxes.clear()
+        for box in self.image_manager.current_boxes():
+            self.bounding_boxes.add(box)
+
+    def accept_boxes(self):
+        """Mark every box on the image as reviewed."""
+        for box in self.bounding_boxes:
+            box.review = False
+        self.mark_dirty()
+
+    def redo(self):
+        """Restore the last removed image to the dataset and move on to the next image."""
+        # Reviewing never removes images, so there is nothing to redo
+        if self.review or self.undone_count == 0:
+            print('No images to restore')
+            return
+        # The image gone back to is the current one, it is moved on only if its sample is restored
+        if self.dataset_manager.restore_last_image():
+            self.undone_count -= 1
+            self.bounding_boxes.clear()
+            self.image_manager.next_image()
+            self.initialize_image_pos()
+            self.request_proposals()
+            self.mark_dirty(canvas=True, menu=True)
 
     def is_mouse_on_image(self, pos: Tuple[int, int]) -> bool:
         """Return True if the mouse is on the image."""
-        image = self.image_manager.load_image()
+        width, height = self.image_manager.current_image_size()
         left_bound = self.offset[0]
-        right_bound = self.offset[0] + image.shape[1] * self.scale
+        right_bound = self.offset[0] + width * self.scale
         upper_bound = self.offset[1]
-        lower_bound = self.offset[1] + image.shape[0] * self.scale
+        lower_bound = self.offset[1] + height * self.scale
         left_right = left_bound <= pos[0] <= right_bound
         upper_lower = upper_bound <= pos[1] <= lower_bound
         return left_right and upper_lower
 
     def clamp_to_image_bounds(self, pos: Tuple[float, float]) -> Tuple[float, float]:
         """Clamp the position to the image bounds."""
-        image = self.image_manager.load_image()
+        width, height = self.image_manager.current_image_size()
 
         return (
-            max(0, min(image.shape[1], pos[0])),
-            max(0, min(image.shape[0], pos[1]))
+            max(0, min(width, pos[0])),
+            max(0, min(height, pos[1]))
         )
 
     def draw_bounding_box(self, box: BoundingBox, color: Tuple[int, int, int] = (0, 0, 0)):
@@ -255,41 +600,41 @@ class ImageLabeler:
             int((box.x_max - box.x_min) * self.scale),
             int((box.y_max - box.y_min) * self.scale),
         )
-        pg.draw.rect(self.screen, color, rect, 2)
+        # Boxes waiting for review get a thin outline and a question mark
+        pg.draw.rect(self.screen, color, rect, 1 if box.review else 2)
 
         # Draw class name
-        font = pg.font.SysFont(None, 24)
-        text_surface = font.render(self.buttons[box.class_id], True, color)
+        label = self.buttons[box.class_id] + ' ?' if box.review else self.buttons[box.class_id]
+        text_surface = self.text_cache.render(label, color)
         text_rect = text_surface.get_rect(center=(rect[0] + rect[2] // 2, rect[1] + rect[3] // 2))
         self.screen.blit(text_surface, text_rect)
 
 
     def draw(self):
+        """Redraw the parts of the screen that have changed."""
+        dirty_rects = []
+        if self.dirty_canvas:
+            self.draw_canvas()
+            dirty_rects.append(self.canvas_rect)
+        if self.dirty_menu:
+            self.draw_menu()
+            dirty_rects.append(self.menu_rect)
+        if len(dirty_rects) > 0:
+            pg.display.update(dirty_rects)
+        self.dirty_canvas = False
+        self.dirty_menu = False
+
+    def draw_canvas(self):
         """Draw the image and bounding boxes."""
+        self.screen.set_clip(self.canvas_rect)
         self.screen.fill((255, 255, 255))
 
-        image = self.image_manager.load_image()  # Assuming NumPy array (H, W, 3)
-        img_height, img_width = image.shape[:2]
-        # Calculate visible area in the image's coordinate system
-        left = max(0, int((0 - self.offset[0]) / self.scale))
-        top = max(0, int((0 - self.offset[1]) / self.scale))
-        right = min(img_width, int((self.screen_size[0] - self.offset[0]) / self.scale + 1))
-        bottom = min(img_height, int((self.screen_size[1] - self.offset[1]) / self.scale + 1))
-        # Crop the visible region of the image
-        visible_image = image[top:bottom, left:right]
-        # Convert cropped image to Pygame surface
-        if visible_image.size > 0:  # Ensure there's something to draw
-            visible_surface = pg.surfarray.make_surface(visible_image.transpose((1, 0, 2)))
-            visible_surface = pg.transform.scale(
-                visible_surface,
-                (int((right - left) * self.scale), int((bottom - top) * self.scale))
-            )
-            # Draw the cropped and scaled image at the correct offset
-            self.screen.blit(visible_surface, (
-                self.offset[0] + left * self.scale,
-                self.offset[1] + top * self.scale
-            ))
-        for box in self.bounding_boxes:
+        self.draw_image()
+
+        # Only draw the boxes overlapping the canvas
+        x_min, y_min = self.apply_transform(self.canvas_rect.topleft)
+        x_max, y_max = self.apply_transform(self.canvas_rect.bottomright)
+        for box in self.bounding_boxes.query_rect(x_min, y_min, x_max, y_max):
             color = self.color_manager.index_to_color(box.class_id)
             self.draw_bounding_box(box, color)
 
@@ -301,31 +646,120 @@ class ImageLabeler:
                 int(self.current_box[3] * self.scale),
             )
             pg.draw.rect(self.screen, (0, 255, 0), rect, 2)
+        if self.show_metrics:
+            self.draw_metrics()
+        self.screen.set_clip(None)
 
+    def get_pyramid(self) -> ImagePyramid:
+        """
+        Get the pyramid of the current image, starting a new one when the image has changed.
+
+        A new image is first shown from a reduced resolution preview when that is faster, and the
+        preview is replaced once the full resolution image has been decoded.
+        """
+        image_path = self.image_manager.current_image_path()
+        new_image = self.pyramid is None or self.pyramid.key != image_path
+        if new_image or (self.pyramid.preview and self.image_manager.full_image_ready()):
+            preview = self.image_manager.load_preview(self.scale) if new_image and self.progressive else None
+            if preview is not None:
+                self.pyramid = ImagePyramid(
+                    image_path, preview, self.tile_cache.tile_size, full_size=self.image_manager.current_image_size()
+                )
+            else:
+                self.pyramid = ImagePyramid(image_path, self.image_manager.load_image(), self.tile_cache.tile_size)
+            self.tile_cache.clear()
+            self.scale_target = None
+        return self.pyramid
+
+    def draw_image(self):
+        """Draw the visible part of the image from the pyramid level that matches the scale."""
+        pyramid = self.get_pyramid()
+        level = pyramid.level_for_scale(self.scale)
+        image = pyramid.levels[level]
+        img_height, img_width = image.shape[:2]
+        factor_x, factor_y = pyramid.level_factor(level)
+        # Screen pixels per level pixel
+        scale_x = self.scale * factor_x
+        scale_y = self.scale * factor_y
+
+        # Calculate visible area in the level's coordinate system
+        left = max(0, int((0 - self.offset[0]) / scale_x))
+        top = max(0, int((0 - self.offset[1]) / scale_y))
+        right = min(img_width, int((self.canvas_rect.width - self.offset[0]) / scale_x + 1))
+        bottom = min(img_height, int((self.canvas_rect.height - self.offset[1]) / scale_y + 1))
+        if right <= left or bottom <= top:
+            return
+
+        if scale_x > 1 or scale_y > 1:
+            # Zoomed in past full resolution, the visible crop is smaller than the screen
+            level_surface = self.tile_cache.level_surface(pyramid, level)
+            visible_surface = level_surface.subsurface((left, top, right - left, bottom - top))
+            size = (int((right - left) * scale_x), int((bottom - top) * scale_y))
+            target = self.get_scale_target(size, level_surface)
+            pg.transform.scale(visible_surface, size, target)
+            self.screen.blit(target, (
+                self.offset[0] + left * scale_x,
+                self.offset[1] + top * scale_y
+            ))
+            return
+
+        # Zoomed out, composite the visible tiles so the cost depends on the screen size
+        tile_size = self.tile_cache.tile_size
+        for tile_y in range(top // tile_size, (bottom - 1) // tile_size + 1):
+            y0 = round(self.offset[1] + tile_y * tile_size * scale_y)
+            y1 = round(self.offset[1] + min((tile_y + 1) * tile_size, img_height) * scale_y)
+            for tile_x in range(left // tile_size, (right - 1) // tile_size + 1):
+                x0 = round(self.offset[0] + tile_x * tile_size * scale_x)
+                x1 = round(self.offset[0] + min((tile_x + 1) * tile_size, img_width) * scale_x)
+                if x1 <= x0 or y1 <= y0:
+                    continue
+                surface = self.tile_cache.get(pyramid, level, tile_x, tile_y, (x1 - x0, y1 - y0))
+                self.screen.blit(surface, (x0, y0))
+
+    def get_scale_target(self, size: Tuple[int, int], source: pg.Surface) -> pg.Surface:
+        """Get a surface of the given size backed by a buffer that is only reallocated when it is too small."""
+        if self.scale_target is None or self.scale_target.get_width() < size[0] or self.scale_target.get_height() < size[1]:
+            buffer_size = (max(size[0], self.canvas_rect.width), max(size[1], self.canvas_rect.height))
+            self.scale_target = pg.Surface(buffer_size, 0, source)
+        return self.scale_target.subsurface((0, 0, size[0], size[1]))
+
+    def draw_menu(self):
+        """Draw the class buttons and the navigation buttons."""
+        self.screen.set_clip(self.menu_rect)
         pg.draw.rect(
             self.screen, (180, 180, 180),
             (self.screen_size[0] - self.menu_width, 0, self.menu_width, self.screen_size[1])
         )
 
-        button_height = 50
-        for i, label in enumerate(self.buttons):
-            y_offset = 10 + i * (button_height + 10) - self.menu_scroll_offset
+        list_top = self.search_height + 10
+        first_row = max(0, (self.menu_scroll_offset - 10) // self.row_height)
+        last_row = min(len(self.visible_classes), (self.menu_scroll_offset + self.screen_size[1] - 70 - list_top) // self.row_height + 1)
+        for row in range(first_row, last_row):
+            i = self.visible_classes[row]
             button_rect = pg.Rect(
                 self.screen_size[0] - self.menu_width + 10,
-                y_offset,
+                list_top + row * self.row_height - self.menu_scroll_offset,
                 self.menu_width - 20,
-                button_height
+                self.button_height
             )
-            if button_rect.bottom < 0 or button_rect.top > self.screen_size[1] - 70:
-                continue
             color = (100, 200, 100) if self.current_class == i else (150, 150, 150)
             pg.draw.rect(self.screen, color, button_rect)
 
-            font = pg.font.SysFont(None, 24)
-            text_surface = font.render(f'{i} {label} ({self.class_counts[i]})', True, (0, 0, 0))
+            text_surface = self.text_cache.render(f'{i} {self.buttons[i]} ({self.class_counts[i]})', (0, 0, 0))
             text_rect = text_surface.get_rect(center=button_rect.center)
             self.screen.blit(text_surface, text_rect)
 
+        # The search field is drawn over rows scrolled past the top
+        search_rect = pg.Rect(self.screen_size[0] - self.menu_width, 0, self.menu_width, self.search_height)
+        pg.draw.rect(self.screen, (180, 180, 180), search_rect)
+        pg.draw.rect(self.screen, (230, 230, 230) if self.searching else (200, 200, 200), search_rect.inflate(-20, -10))
+        if self.searching or self.search_text:
+            search_label = f'{self.search_text}{"|" if self.searching else ""} ({len(self.visible_classes)})'
+            search_surface = self.text_cache.render(search_label, (0, 0, 0))
+        else:
+            search_surface = self.text_cache.render('Search (Ctrl+F)', (110, 110, 110))
+        self.screen.blit(search_surface, search_surface.get_rect(midleft=(search_rect.left + 15, search_rect.centery)))
+
         button_width = 100
         button_height = 50
 
@@ -337,17 +771,37 @@ class ImageLabeler:
         pg.draw.rect(self.screen, (150, 150, 250), prev_button_rect)
         pg.draw.rect(self.screen, (150, 150, 250), next_button_rect)
 
-        prev_text = pg.font.SysFont(None, 24).render('Previous', True, (0, 0, 0))
-        next_text = pg.font.SysFont(None, 24).render('Next', True, (0, 0, 0))
+        prev_text = self.text_cache.render('Previous', (0, 0, 0))
+        next_text = self.text_cache.render('Next', (0, 0, 0))
 
         self.screen.blit(prev_text, prev_text.get_rect(center=prev_button_rect.center))
         self.screen.blit(next_text, next_text.get_rect(center=next_button_rect.center))
-
-        pg.display.flip()
+        self.screen.set_clip(None)
+
+    def draw_metrics(self):
+        """Draw the metrics overlay in the top left corner of the canvas."""
+        self.last_overlay = time.perf_counter()
+        lines = self.metrics.overlay_lines()
+        surfaces = [self.text_cache.font(18).render(line, True, (255, 255, 255)) for line in lines]
+        width = max((surface.get_width() for surface in surfaces), default=0)
+        background = pg.Surface((width + 10, len(surfaces) * 18 + 10), pg.SRCALPHA)
+        background.fill((0, 0, 0, 160))
+        self.screen.blit(background, (0, 0))
+        for index, surface in enumerate(surfaces):
+            self.screen.blit(surface, (5, 5 + index * 18))
 
     def loop(self):
         """Preforms the main loop."""
         while self.running:
             self.event()
-            self.draw()
+            if self.show_metrics and time.perf_counter() - self.last_overlay >= self.overlay_interval:
+                self.mark_dirty()
+            # Only frames that change something are drawn, so the draw latencies are real frames
+            if self.dirty_canvas or self.dirty_menu:
+                self.draw()
+            if self.metrics is not None:
+                self.metrics.maybe_dump()
+            self.clock.tick(self.max_fps)
+        if self.metrics is not None:
+            self.metrics.dump()
         pg.quit()
@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+
+class ImageCache:
+    """Class to keep decoded images in a least recently used cache bounded by size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._images: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._images
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._images)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached image, or None if it is not cached."""
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def peek(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached image without touching the counters or the eviction order."""
+        with self._lock:
+            return self._images.get(key)
+
+    def put(self, key: str, image: Optional[np.ndarray]):
+        """Insert an image and evict the least recently used images until the cache fits."""
+        if image is None or image.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_image = self._images.pop(key, None)
+            if old_image is not None:
+                self.current_bytes -= old_image.nbytes
+            self._images[key] = image
+            self.current_bytes += image.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def discard(self, key: str):
+        """Remove an image from the cache if it is present."""
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self.current_bytes -= image.nbytes
+
+    def stats(self) -> dict:
+        """Return the hit and miss counters together with the memory usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'images': len(self._images),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class ImagePrefetcher:
+    """Class to decode images ahead of time on a thread pool."""
+
+    def __init__(self, cache: ImageCache, decode: Callable[[str], Optional[np.ndarray]], n_workers: int = 2):
+        self.cache = cache
+        self.decode = decode
+        self.executor = ThreadPoolExecutor(max_workers=max(1, n_workers), thread_name_prefix='prefetch')
+
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, paths: Iterable[str]):
+        """Schedule decoding of the paths that are neither cached nor already being decoded."""
+        for path in paths:
+            with self._lock:
+                if path in self._pending or path in self.cache:
+                    continue
+                self._pending[path] = self.executor.submit(self._decode, path)
+
+    def wait(self, path: str) -> Optional[np.ndarray]:
+        """Wait for a scheduled decode to finish, return None if the path was never decoded."""
+        with self._lock:
+            future = self._pending.get(path)
+        if future is None:
+            # The decode may have finished between the cache lookup and now
+            return self.cache.peek(path)
+        return future.result()
+
+    def pending(self) -> int:
+        """Return the number of scheduled decodes that have not finished."""
+        with self._lock:
+            return len(self._pending)
+
+    def close(self):
+        """Cancel scheduled decodes and stop the worker threads."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _decode(self, path: str) -> Optional[np.ndarray]:
+        try:
+            image = self.decode(path)
+            self.cache.put(path, image)
+            return image
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
@@ -0,0 +1,254 @@
+import itertools
+import json
+import math
+import os
+import shutil
+from typing import List, Optional, Tuple
+
+import cv2
+
+from dataset_tools import IMAGE_EXTENSIONS, run_parallel
+
+from image_scanner import ImageScanner
+
+import numpy as np
+
+
+def dhash(image: np.ndarray, hash_size: int = 8) -> int:
+    """Compute the difference hash of an image: one bit per pair of horizontally adjacent pixels of a tiny grayscale copy."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def hash_file(path: str) -> Optional[int]:
+    """Compute the difference hash of an image file, None if it cannot be read."""
+    # The hash only needs a tiny image, JPEG files can be decoded at an eighth of their size
+    flags = cv2.IMREAD_REDUCED_GRAYSCALE_8 if path.lower().endswith(('.jpg', '.jpeg')) else cv2.IMREAD_GRAYSCALE
+    image = cv2.imread(path, flags)
+    return None if image is None else dhash(image)
+
+
+def hamming_distances(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Return the number of differing bits between every hash and a value."""
+    return np.bitwise_count(hashes ^ np.uint64(value))
+
+
+class HashIndex:
+    """
+    Class to hold the perceptual hashes of image files in a uint64 array.
+
+    The hashes are cached in a file together with the size and mtime of every image, so on later
+    runs only new and changed files are hashed again.
+    """
+
+    def __init__(self, cache_path: Optional[str] = None):
+        self.cache_path = cache_path
+        self.paths: List[str] = []
+        self.hashes = np.zeros(0, dtype=np.uint64)
+
+    def update(self, paths: List[str], workers: Optional[int] = None) -> List[str]:
+        """Hash the images, reusing cached hashes of unchanged files, return the paths that could not be read."""
+        cached = self.load_cache()
+        stats = [os.stat(path) for path in paths]
+        hashes = np.zeros(len(paths), dtype=np.uint64)
+        readable = np.ones(len(paths), dtype=bool)
+        missing = []
+        for index, (path, stat) in enumerate(zip(paths, stats)):
+            entry = cached.get(path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                hashes[index] = entry[2]
+            else:
+                missing.append(index)
+
+        print(f'{len(paths) - len(missing)} hashes cached, hashing {len(missing)} images')
+        unreadable = []
+        if len(missing) > 0:
+            for index, value in zip(missing, run_parallel(hash_file, [paths[index] for index in missing], workers)):
+                if value is None:
+                    readable[index] = False
+                    unreadable.append(paths[index])
+                else:
+                    hashes[index] = value
+
+        self.paths = [path for path, ok in zip(paths, readable) if ok]
+        self.hashes = hashes[readable]
+        self.save_cache(
+            np.array([stat.st_size for stat, ok in zip(stats, readable) if ok], dtype=np.int64),
+            np.array([stat.st_mtime for stat, ok in zip(stats, readable) if ok], dtype=np.float64)
+        )
+        return unreadable
+
+    def load_cache(self) -> dict:
+        """Load the cached size, mtime and hash of every path, or nothing if there is no usable cache."""
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with np.load(self.cache_path) as cache:
+                return {
+                    path: (size, mtime, value)
+                    for path, size, mtime, value in zip(
+                        cache['paths'].tolist(), cache['sizes'].tolist(), cache['mtimes'].tolist(), cache['hashes']
+                    )
+                }
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save_cache(self, sizes: np.ndarray, mtimes: np.ndarray):
+        """Write the hashes through a temporary file."""
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, paths=np.array(self.paths, dtype=str), sizes=sizes, mtimes=mtimes, hashes=self.hashes)
+        os.replace(tmp_path, self.cache_path)
+
+    def find_duplicates(self, threshold: int) -> List[List[int]]:
+        """
+        Group images whose hashes differ in at most `threshold` bits.
+
+        Images are visited in order and join the group of the closest earlier image that started a
+        group, or start a group of their own. Only the pairs of similar images found by
+        `similar_pairs` are looked at, so the cost grows with the number of such pairs.
+
+        Returns:
+            The groups with more than one image as lists of indices, the first index is the image to keep.
+        """
+        n = len(self.hashes)
+        if n < 2:
+            return []
+        n_bands, cost = self.band_count(n, threshold)
+        # A popcount against every group is about 40 times cheaper than a lookup or a match in a band
+        if cost > n * n / 40:
+            # With a large threshold most pairs are similar, comparing every image to the groups so far is cheaper
+            return self.scan_keepers(threshold)
+        earlier, later, distances = self.similar_pairs(threshold, n_bands)
+        # The earlier images of every image, the closest first and the oldest first among equally close ones
+        order = np.lexsort((earlier, distances, later))
+        keepers = list(range(n))
+        assigned = -1
+        for index, other in zip(later[order].tolist(), earlier[order].tolist()):
+            if index != assigned and keepers[other] == other:
+                keepers[index] = other
+                assigned = index
+
+        keepers = np.array(keepers)
+        members = np.flatnonzero(keepers != np.arange(n))
+        if len(members) == 0:
+            return []
+        members = members[np.argsort(keepers[members], kind='stable')]
+        group_keepers, starts = np.unique(keepers[members], return_index=True)
+        return [[keeper] + group.tolist() for keeper, group in zip(group_keepers.tolist(), np.split(members, starts[1:]))]
+
+    def scan_keepers(self, threshold: int) -> List[List[int]]:
+        """Group the images like find_duplicates by comparing every image to the first image of every group so far."""
+        keepers = np.zeros(len(self.hashes), dtype=np.uint64)
+        groups: List[List[int]] = []
+        for index, value in enumerate(self.hashes):
+            if len(groups) > 0:
+                distances = hamming_distances(keepers[:len(groups)], value)
+                closest = int(distances.argmin())
+                if distances[closest] <= threshold:
+                    groups[closest].append(index)
+                    continue
+            keepers[len(groups)] = value
+            groups.append([index])
+        return [group for group in groups if len(group) > 1]
+
+    def similar_pairs(self, threshold: int, n_bands: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Find every pair of hashes that differ in at most `threshold` bits.
+
+        The 64 bits are split into bands. Two hashes within the threshold differ in at most
+        `threshold // n_bands` bits in at least one band, by the pigeonhole principle. Each band is
+        sorted once, and for every hash the hashes whose band is that close are looked up with the
+        band value with up to that many bits flipped. The candidates are checked with a popcount of
+        the whole hash. Every step works on all hashes at once.
+
+        Returns:
+            The indices of the earlier and of the later image of every pair, and their distances.
+        """
+        n = len(self.hashes)
+        radius = threshold // n_bands
+        pairs = []
+        shift = 0
+        for band in range(n_bands):
+            width = 64 // n_bands + (1 if band < 64 % n_bands else 0)
+            values = ((self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)).astype(np.int64) if width < 64 else self.hashes
+            shift += width
+            order = np.argsort(values, kind='stable')
+            sorted_values = values[order]
+            # Narrow bands are looked up in a table of where every band value starts in the sorted band
+            table = np.searchsorted(sorted_values, np.arange((1 << width) + 1)) if width <= 22 else None
+            for flips in range(min(radius, width) + 1):
+                for bits in itertools.combinations(range(width), flips):
+                    mask = sum(1 << bit for bit in bits)
+                    # Two hashes that differ by the mask would find each other, only the one without its highest bit looks
+                    sources = np.arange(n) if mask == 0 else np.flatnonzero(values & (1 << (mask.bit_length() - 1)) == 0)
+                    queries = values[sources] ^ values.dtype.type(mask)
+                    if table is not None:
+                        starts = table[queries]
+                        counts = table[queries + 1] - starts
+                    else:
+                        starts = np.searchsorted(sorted_values, queries, 'left')
+                        counts = np.searchsorted(sorted_values, queries, 'right') - starts
+                    found = np.flatnonzero(counts)
+                    counts = counts[found]
+                    # Every match as its position in the sorted band, counting up from the start of its range
+                    positions = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts - starts[found], counts)
+                    first = np.repeat(sources[found], counts)
+                    second = order[positions]
+                    if mask == 0:
+                        keep = second < first
+                        later, earlier = first[keep], second[keep]
+                    else:
+                        later, earlier = np.maximum(first, second), np.minimum(first, second)
+                    distances = np.bitwise_count(self.hashes[later] ^ self.hashes[earlier])
+                    keep = distances <= threshold
+                    pairs.append(later[keep] * n + earlier[keep])
+        # A pair that is close in several bands is found once per band
+        pairs = np.unique(np.concatenate(pairs))
+        later, earlier = pairs // n, pairs % n
+        return earlier, later, np.bitwise_count(self.hashes[later] ^ self.hashes[earlier])
+
+    @staticmethod
+    def band_count(n: int, threshold: int) -> Tuple[int, float]:
+        """Choose the number of bands with the least expected work, the lookups plus the matches of unrelated hashes, return it and the work."""
+        best_count, best_cost = 1, math.inf
+        for n_bands in range(1, min(threshold + 1, 64) + 1):
+            width = 64 // n_bands
+            lookups = sum(math.comb(width, flips) for flips in range(min(threshold // n_bands, width) + 1))
+            cost = n_bands * lookups * (n + n * n / 2 ** width)
+            if cost < best_cost:
+                best_count, best_cost = n_bands, cost
+        return best_count, best_cost
+
+
+def dedup_images(args) -> int:
+    """Find near-duplicate images, report them and optionally move them aside, return the number of unreadable images."""
+    paths = sorted(ImageScanner(args.image_dir, IMAGE_EXTENSIONS).scan())
+    index = HashIndex(os.path.join(args.image_dir, '.label', 'hashes.npz'))
+    unreadable = index.update(paths, args.workers)
+    for path in unreadable:
+        print(f'{path}: could not be read')
+
+    groups = index.find_duplicates(args.threshold)
+    duplicates = sum(len(group) - 1 for group in groups)
+    print(f'{duplicates} near duplicates in {len(groups)} groups among {len(index.paths)} images')
+    if args.groups_file is not None:
+        with open(args.groups_file, 'w') as f:
+            json.dump([[index.paths[i] for i in group] for group in groups], f, indent=2)
+        print(f'Groups written to {args.groups_file}')
+
+    if args.move:
+        # Hidden folders are skipped by the scan, so moved duplicates are not labelled
+        duplicates_dir = os.path.join(args.image_dir, '.duplicates')
+        for group in groups:
+            for i in group[1:]:
+                destination = os.path.join(duplicates_dir, os.path.relpath(index.paths[i], args.image_dir))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.move(index.paths[i], destination)
+        print(f'Moved {duplicates} images to {duplicates_dir}')
+    return len(unreadable)
@@ -0,0 +1,138 @@
+import struct
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+import cv2
+
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Start of frame markers carry the image size, the other markers in C0-CF are tables
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | {0x01, 0xD8}
+
+
+def read_image_size(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Read the width and height of a JPEG or PNG file from its header without decoding it.
+
+    The size is given as OpenCV decodes the file, so JPEG files with an EXIF orientation that
+    rotates by 90 degrees have width and height swapped.
+
+    Returns:
+        The width and height, or None if the format is not recognized.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+            if head.startswith(PNG_SIGNATURE) and head[12:16] == b'IHDR':
+                width, height = struct.unpack('>II', head[16:24])
+                return width, height
+            if not head.startswith(b'\xff\xd8'):
+                return None
+            f.seek(2)
+            orientation = 1
+            for code, length in _jpeg_segments(f):
+                if code == 0xE1:
+                    orientation = _parse_exif(f.read(length))[0] or orientation
+                elif code in JPEG_SOF_MARKERS:
+                    _, height, width = struct.unpack('>BHH', f.read(5))
+                    return (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+                else:
+                    f.seek(length, 1)
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
+
+
+def read_exif_thumbnail(path: str) -> Optional[np.ndarray]:
+    """Decode the thumbnail embedded in the EXIF data of a JPEG file, turned like OpenCV turns the image."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            for code, length in _jpeg_segments(f):
+                if code == 0xE1:
+                    orientation, thumbnail = _parse_exif(f.read(length))
+                    if thumbnail is not None:
+                        image = cv2.imdecode(np.frombuffer(thumbnail, dtype=np.uint8), cv2.IMREAD_COLOR)
+                        return None if image is None else apply_orientation(image, orientation or 1)
+                if code in JPEG_SOF_MARKERS:
+                    return None
+                f.seek(length, 1)
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
+
+
+def apply_orientation(image: np.ndarray, orientation: int) -> np.ndarray:
+    """Turn and mirror an image according to an EXIF orientation value."""
+    if orientation == 2:
+        return cv2.flip(image, 1)
+    if orientation == 3:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(image, 0)
+    if orientation == 5:
+        return cv2.transpose(image)
+    if orientation == 6:
+        return cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(image), -1)
+    if orientation == 8:
+        return cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return image
+
+
+def _jpeg_segments(f: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """Yield the marker and payload length of the segments before the image data, with the file at the payload."""
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return
+        code = marker[1]
+        # Markers may be preceded by any number of fill bytes
+        while code == 0xFF:
+            code = f.read(1)[0]
+        if code in JPEG_STANDALONE_MARKERS:
+            continue
+        if code in (0xD9, 0xDA):
+            # End of image or start of scan
+            return
+        length = struct.unpack('>H', f.read(2))[0]
+        position = f.tell()
+        yield code, length - 2
+        # The consumer may have read part of the payload
+        f.seek(position + length - 2)
+
+
+def _parse_exif(data: bytes) -> Tuple[Optional[int], Optional[bytes]]:
+    """Return the orientation and the thumbnail of an APP1 segment, None for what it does not have."""
+    if not data.startswith(b'Exif\x00\x00'):
+        return None, None
+    tiff = data[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return None, None
+
+    def read_ifd(offset: int) -> Tuple[dict, int]:
+        count = struct.unpack(endian + 'H', tiff[offset:offset + 2])[0]
+        entries = {}
+        for index in range(count):
+            entry = tiff[offset + 2 + index * 12:offset + 14 + index * 12]
+            tag, value_type = struct.unpack(endian + 'HH', entry[:4])
+            # Short values are stored in the first two bytes of the value field, long values in all four
+            entries[tag] = struct.unpack(endian + ('H' if value_type == 3 else 'I'), entry[8:10] if value_type == 3 else entry[8:12])[0]
+        next_offset = struct.unpack(endian + 'I', tiff[offset + 2 + count * 12:offset + 6 + count * 12])[0]
+        return entries, next_offset
+
+    ifd0, ifd1_offset = read_ifd(struct.unpack(endian + 'I', tiff[4:8])[0])
+    orientation = ifd0.get(0x0112)
+    thumbnail = None
+    if ifd1_offset != 0:
+        ifd1, _ = read_ifd(ifd1_offset)
+        start, length = ifd1.get(0x0201), ifd1.get(0x0202)
+        if start is not None and length is not None and start + length <= len(tiff):
+            thumbnail = tiff[start:start + length]
+    return orientation, thumbnail
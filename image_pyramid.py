@@ -0,0 +1,62 @@
+import math
+import threading
+from typing import Optional, Tuple
+
+import cv2
+
+import numpy as np
+
+
+class ImagePyramid:
+    """
+    Class to hold an image at successively halved resolutions.
+
+    Level 0 is the full resolution image, the smaller levels are built on a background thread and can
+    be used as soon as they appear in `levels`. The levels are stored as contiguous RGB arrays, ready
+    to be wrapped in a pygame surface.
+
+    A pyramid can also be built from a preview decoded at reduced resolution, then level 0 is the
+    preview and `full_size` is the size of the image it stands in for.
+    """
+
+    def __init__(self,
+                 key: str,
+                 image: np.ndarray,
+                 min_size: int = 256,
+                 background: bool = True,
+                 full_size: Optional[Tuple[int, int]] = None
+                 ):
+        self.key = key
+        self.min_size = min_size
+        self.levels = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB)]
+        self.full_size = full_size or (image.shape[1], image.shape[0])
+        self.preview = full_size is not None and self.full_size != (image.shape[1], image.shape[0])
+        self.ready = threading.Event()
+
+        if background:
+            threading.Thread(target=self._build, name='pyramid', daemon=True).start()
+        else:
+            self._build()
+
+    def _build(self):
+        level = self.levels[0]
+        while max(level.shape[:2]) > self.min_size:
+            height, width = level.shape[:2]
+            level = cv2.resize(level, ((width + 1) // 2, (height + 1) // 2), interpolation=cv2.INTER_AREA)
+            self.levels.append(level)
+        self.ready.set()
+
+    def level_for_scale(self, scale: float) -> int:
+        """Return the smallest available level that still has at least one pixel per screen pixel."""
+        # Screen pixels per level 0 pixel
+        scale *= self.full_size[0] / self.levels[0].shape[1]
+        if scale >= 1:
+            return 0
+        level = int(math.floor(math.log2(1 / scale)))
+        return min(level, len(self.levels) - 1)
+
+    def level_factor(self, level: int) -> tuple:
+        """Return the number of full resolution pixels per level pixel in x and y."""
+        width, height = self.full_size
+        level_height, level_width = self.levels[level].shape[:2]
+        return width / level_width, height / level_height
@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, List, Optional
+
+
+class ImageScanner:
+    """
+    Class to find images in a folder tree with os.scandir.
+
+    The result is remembered in a manifest, an SQLite table with a row for every folder with its
+    mtime, its subfolders and its images (name, size and mtime). On later scans a folder whose
+    mtime has not changed is taken from its row without listing it again. Rows are read as the scan
+    reaches their folder, so images are found right away, and only the rows of changed folders are
+    written.
+    """
+
+    manifest_version = 2
+
+    def __init__(self, folder_path: str, allowed_extensions: List[str], manifest_path: Optional[str] = None):
+        self.folder_path = folder_path
+        self.allowed_extensions = allowed_extensions
+        self.manifest_path = manifest_path
+
+        self.found = 0
+        self.listed_folders = 0
+        self.cached_folders = 0
+        self.first_found = threading.Event()
+        self.done = threading.Event()
+        self._thread = None
+
+    def start(self, callback: Callable[[str], None]):
+        """Scan on a background thread, calling the callback with every image path as it is found."""
+        self._thread = threading.Thread(target=self.scan, args=(callback,), name='scanner', daemon=True)
+        self._thread.start()
+
+    def wait_for_first(self, timeout: Optional[float] = None):
+        """Wait until the first image has been found or the scan is done."""
+        self.first_found.wait(timeout)
+
+    def scan(self, callback: Optional[Callable[[str], None]] = None) -> List[str]:
+        """Scan the folder tree, return the image paths and update the manifest."""
+        connection = self.open_manifest()
+        changed = {}
+        removed = []
+        image_paths = []
+
+        stack = [self.folder_path]
+        try:
+            while len(stack) > 0:
+                folder = stack.pop()
+                key = os.path.relpath(folder, self.folder_path)
+                old_entry = self.load_entry(connection, key)
+                entry = self._scan_folder(folder, old_entry)
+                if entry is None:
+                    continue
+                if entry is not old_entry:
+                    changed[key] = entry
+                    if old_entry is not None:
+                        # The rows of deleted subfolders would otherwise stay in the manifest
+                        removed.extend(os.path.normpath(os.path.join(key, name)) for name in set(old_entry['dirs']) - set(entry['dirs']))
+                stack.extend(os.path.join(folder, name) for name in reversed(entry['dirs']))
+                for name, _, _ in entry['files']:
+                    path = os.path.join(folder, name)
+                    image_paths.append(path)
+                    self.found += 1
+                    if callback is not None:
+                        callback(path)
+                    self.first_found.set()
+            self.save_manifest(connection, changed, removed)
+        finally:
+            if connection is not None:
+                connection.close()
+            self.first_found.set()
+            self.done.set()
+        return image_paths
+
+    def _scan_folder(self, folder: str, old_entry: Optional[dict]) -> Optional[dict]:
+        """Return the manifest entry of a folder, listing it only if it changed since the last scan."""
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return None
+        if old_entry is not None and old_entry['mtime'] == mtime:
+            self.cached_folders += 1
+            return old_entry
+
+        dirs = []
+        files = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    # Skip hidden entries such as the undo staging folder and the manifest
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif os.path.splitext(entry.name)[1].lower() in self.allowed_extensions:
+                        stat = entry.stat()
+                        files.append((entry.name, stat.st_size, stat.st_mtime))
+        except OSError as error:
+            print(f'Could not scan {folder}: {error}')
+            return None
+        self.listed_folders += 1
+        return {'mtime': mtime, 'dirs': dirs, 'files': files}
+
+    def open_manifest(self) -> Optional[sqlite3.Connection]:
+        """Open the manifest, or nothing if there is no usable manifest."""
+        if self.manifest_path is None:
+            return None
+        # Kept in its own folder, writing it there leaves the mtime of the scanned folders untouched
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        try:
+            connection = sqlite3.connect(self.manifest_path, timeout=30)
+            with connection:
+                if connection.execute('PRAGMA user_version').fetchone()[0] != self.manifest_version:
+                    connection.execute('DROP TABLE IF EXISTS folders')
+                    connection.execute(f'PRAGMA user_version = {self.manifest_version}')
+                connection.execute('CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime REAL, dirs TEXT, files TEXT)')
+        except sqlite3.Error as error:
+            print(f'Could not open the manifest {self.manifest_path}: {error}')
+            return None
+        return connection
+
+    @staticmethod
+    def load_entry(connection: Optional[sqlite3.Connection], key: str) -> Optional[dict]:
+        """Return the manifest entry of a folder, None if it has none."""
+        if connection is None:
+            return None
+        row = connection.execute('SELECT mtime, dirs, files FROM folders WHERE path = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return {'mtime': row[0], 'dirs': json.loads(row[1]), 'files': json.loads(row[2])}
+
+    def save_manifest(self, connection: Optional[sqlite3.Connection], changed: dict, removed: List[str]):
+        """Write the entries of the folders that changed and delete those of removed folders with everything below them."""
+        if connection is None or len(changed) == 0 and len(removed) == 0:
+            return
+        # Paths below a folder sort between the folder with a separator and the folder with the next character
+        after_separator = chr(ord(os.sep) + 1)
+        try:
+            with connection:
+                connection.executemany(
+                    'DELETE FROM folders WHERE path = ? OR (path > ? AND path < ?)',
+                    [(key, key + os.sep, key + after_separator) for key in removed]
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                    [(key, entry['mtime'], json.dumps(entry['dirs']), json.dumps(entry['files'])) for key, entry in changed.items()]
+                )
+        except sqlite3.Error as error:
+            print(f'Could not update the manifest {self.manifest_path}: {error}')
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import queue
+import shutil
+import threading
+from typing import BinaryIO, Callable, Optional
+
+import cv2
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request to clone a file on copy-on-write filesystems such as btrfs and xfs
+FICLONE = 0x40049409
+
+
+class WriteJob:
+    """Class to describe an image and label pair waiting to be written."""
+
+    def __init__(self,
+                 image_path: str,
+                 label_path: str,
+                 image: Optional[np.ndarray],
+                 label_text: str,
+                 staged_image_path: Optional[str] = None,
+                 sample_id: Optional[int] = None,
+                 source_file: Optional[BinaryIO] = None
+                 ):
+        self.image_path = image_path
+        self.label_path = label_path
+        self.image = image
+        self.label_text = label_text
+        # Image file already written by the caller, it only has to be renamed into place
+        self.staged_image_path = staged_image_path
+        self.sample_id = sample_id
+        # Open source file the writer clones or copies to the staged image path, the path may have moved by then
+        self.source_file = source_file
+
+        self.started = False
+        self.cancelled = False
+        self.error: Optional[Exception] = None
+        # Hash of the written image file
+        self.digest: Optional[str] = None
+        self.done = threading.Event()
+
+
+def temporary_path(path: str) -> str:
+    """Return a hidden temporary path next to the given path."""
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f'.{name}.tmp')
+
+
+def file_digest(path: str) -> str:
+    """Return the BLAKE2b hash of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reflink(source_path: str, destination_path: str):
+    """Clone a file without copying its data, raise OSError if the filesystem does not support it."""
+    if fcntl is None:
+        raise OSError('Reflinks are not supported on this platform')
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(destination_path)
+            raise
+
+
+def clone_or_copy(source: BinaryIO, destination_path: str) -> str:
+    """
+    Write an open file to the destination, cloned if the filesystem supports it and copied otherwise.
+
+    Returns:
+        The method that was used.
+    """
+    with open(destination_path, 'wb') as destination:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        source.seek(0)
+        shutil.copyfileobj(source, destination, 1024 * 1024)
+    return 'copy'
+
+
+def link_or_copy(source_path: str, destination_path: str) -> str:
+    """
+    Place a file at the destination without decoding it.
+
+    A hard link is tried first, then a reflink and finally a byte copy.
+
+    Returns:
+        The method that was used.
+    """
+    try:
+        os.link(source_path, destination_path)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        reflink(source_path, destination_path)
+        return 'reflink'
+    except OSError:
+        pass
+    shutil.copyfile(source_path, destination_path)
+    return 'copy'
+
+
+class AsyncWriter:
+    """Class to write images and labels on a background thread through a bounded queue."""
+
+    def __init__(self, max_queue_size: int = 8, on_written: Optional[Callable[[WriteJob], None]] = None):
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        # Called on the writer thread after a job has been written
+        self.on_written = on_written
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, job: WriteJob):
+        """Queue a job, blocking while the queue is full."""
+        self.queue.put(job)
+
+    def cancel(self, job: WriteJob) -> bool:
+        """Cancel a job that has not been started, return False if it is already being written."""
+        with self._lock:
+            if job.started:
+                return False
+            job.cancelled = True
+        job.done.set()
+        return True
+
+    def pending(self) -> int:
+        """Return the number of queued jobs."""
+        return self.queue.qsize()
+
+    def flush(self):
+        """Wait until every queued job has been written."""
+        self.queue.join()
+
+    def close(self):
+        """Write the remaining jobs and stop the background thread."""
+        if not self._thread.is_alive():
+            return
+        self.flush()
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            with self._lock:
+                skip = job.cancelled
+                job.started = True
+            try:
+                if skip:
+                    self.discard(job)
+                else:
+                    self.write(job)
+                    if self.on_written is not None:
+                        self.on_written(job)
+            except Exception as error:
+                # Any failure only loses this job, the thread has to keep running or flush and submit would block forever
+                job.error = error
+                print(f'Failed to save {job.image_path}: {type(error).__name__}: {error}')
+            finally:
+                job.image = None
+                if job.source_file is not None:
+                    job.source_file.close()
+                job.done.set()
+                self.queue.task_done()
+
+    @staticmethod
+    def discard(job: WriteJob):
+        """Remove the staged image of a cancelled job."""
+        if job.staged_image_path is not None and os.path.exists(job.staged_image_path):
+            os.remove(job.staged_image_path)
+
+    @staticmethod
+    def write(job: WriteJob):
+        """
+        Write the image and label of a job as one pair.
+
+        Both files are written to temporary files first and then renamed into place, the label last.
+        A sample with a label file therefore always has a complete image next to it.
+        """
+        image_tmp_path = job.staged_image_path or temporary_path(job.image_path)
+        label_tmp_path = temporary_path(job.label_path)
+        try:
+            if job.staged_image_path is None:
+                extension = os.path.splitext(job.image_path)[1]
+                success, encoded = cv2.imencode(extension, job.image)
+                if not success:
+                    raise OSError(f'Could not encode image as {extension}')
+                data = encoded.tobytes()
+                with open(image_tmp_path, 'wb') as f:
+                    f.write(data)
+                job.digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            else:
+                if job.source_file is not None:
+                    clone_or_copy(job.source_file, image_tmp_path)
+                job.digest = file_digest(image_tmp_path)
+            with open(label_tmp_path, 'w') as f:
+                f.write(job.label_text)
+            os.replace(image_tmp_path, job.image_path)
+            os.replace(label_tmp_path, job.label_path)
+        finally:
+            for path in (image_tmp_path, label_tmp_path):
+                if os.path.exists(path):
+                    os.remove(path)
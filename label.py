@@ -1,23 +1,152 @@
+import os
+
+from archive_source import ArchiveManager
+
+from box_tracker import BoxPropagator
+
 from dataset_manager import ClassDescription, DatasetManager, ImageManager
 
-import gui
+from dataset_review import LabelTable, ReviewManager
+
+from dataset_tools import read_class_names
+
+from metrics import Metrics
+
+from prelabel import Detector, PrelabelWorker
+
+from video_source import VideoManager
+
+from work_claims import ClaimManager, default_worker_id
+
+
+def instrument(metrics: Metrics, labeler, image_manager: ImageManager, dataset_manager: DatasetManager, prelabel_worker=None):
+    """Time the hot paths of a labelling session and register its cache and queue gauges."""
+    metrics.instrument(labeler, 'draw')
+    metrics.instrument(labeler, 'handle_events', 'event')
+    metrics.instrument(image_manager, 'load_image')
+    metrics.instrument(dataset_manager, 'save_image')
+
+    metrics.add_gauge('frame_rate', metrics.histograms['draw'].rate)
+    metrics.add_gauge('cache_hit_rate', lambda: image_manager.cache_stats()['hit_rate'])
+    metrics.add_gauge('cache_megabytes', lambda: image_manager.cache_stats()['bytes'] / 2 ** 20)
+    metrics.add_gauge('prefetch_queue', image_manager.prefetcher.pending)
+    if dataset_manager.writer is not None:
+        metrics.add_gauge('write_queue', dataset_manager.writer.pending)
+    if prelabel_worker is not None:
+        metrics.add_gauge('prelabel_queue', prelabel_worker.pending)
 
 
 def label_images(args):
+    # Imported here so the headless subcommands do not load pygame
+    import gui
+
     image_dir = args.image_dir
     dataset_dir = args.dataset_dir
     classes = args.classes
     screen_size = args.screen_size
     default_scale = args.default_scale
+    max_fps = args.max_fps
+    prefetch = args.prefetch
+    cache_size = args.cache_size * 1024 * 1024
+    write_queue = args.write_queue
+    passthrough = not args.reencode
+    undo_depth = args.undo_depth
+    use_manifest = not args.no_manifest
+
+    # In sharded mode every worker writes its own dataset, combined later with the merge subcommand
+    claims = None
+    if args.shard and not args.video and not args.archive and not args.review:
+        worker_id = args.worker_id or default_worker_id()
+        print(f'Labelling as worker {worker_id}')
+        claims = ClaimManager(image_dir, worker_id, args.claim_timeout)
+        dataset_dir = os.path.join(dataset_dir, 'workers', worker_id)
+
+    if args.review:
+        # The classes of a reviewed dataset are the ones it was labelled with
+        classes = read_class_names(dataset_dir) or classes
 
     class_descrition = ClassDescription(classes)
-    dataset_manager = DatasetManager(dataset_dir, class_descrition)
+    dataset_manager = DatasetManager(
+        dataset_dir, class_descrition, write_queue_size=write_queue, passthrough=passthrough, undo_depth=undo_depth,
+        read_only=args.review
+    )
+
+    if not args.review:
+        dataset_manager.create_folder_structure()
+    if args.review:
+        review_class = None
+        if args.review_class in classes:
+            review_class = classes.index(args.review_class)
+        elif args.review_class is not None:
+            if not args.review_class.isdigit() or int(args.review_class) >= len(classes):
+                print(f'Unknown class {args.review_class}, use a name or an id of: {", ".join(f"{i} {name}" for i, name in enumerate(classes))}')
+                dataset_manager.close()
+                return 1
+            review_class = int(args.review_class)
+        table = LabelTable(dataset_dir)
+        # Boxes are drawn and counted by their class, so every id needs a name
+        unknown_class_ids = table.unknown_class_ids(len(classes))
+        if len(unknown_class_ids) > 0:
+            print(f'{dataset_dir} has boxes of class ids {", ".join(map(str, unknown_class_ids))} but only {len(classes)} classes, add their names to data.yaml')
+            dataset_manager.close()
+            return 1
+        indices = table.select(review_class, args.min_boxes, args.max_boxes, args.smaller_than, args.sort)
+        if len(indices) == 0:
+            print(f'No samples in {dataset_dir} match the review filters')
+            dataset_manager.close()
+            return 1
+        image_manager = ReviewManager(table, indices, prefetch_count=prefetch, cache_size=cache_size, store=dataset_manager.store)
+    elif args.video:
+        image_manager = VideoManager(image_dir, stride=args.stride, prefetch_count=prefetch, buffer_frames=args.frame_buffer)
+    elif args.archive:
+        image_manager = ArchiveManager(image_dir, prefetch_count=prefetch, cache_size=cache_size)
+    else:
+        image_manager = ImageManager(
+            image_dir, prefetch_count=prefetch, cache_size=cache_size, undo_depth=undo_depth, use_manifest=use_manifest,
+            claims=claims, claim_batch=args.claim_batch
+        )
+    if image_manager.all_labelled():
+        print(f'Nothing left to label in {image_dir}')
+        image_manager.close()
+        dataset_manager.close()
+        return
+
+    prelabel_worker = None
+    box_propagator = None
+    try:
+        if args.model is not None:
+            detector = Detector(
+                args.model,
+                class_descrition.class_map(args.model_classes),
+                tuple(args.model_size),
+                args.score_threshold
+            )
+            prelabel_worker = PrelabelWorker(detector, image_manager.read_image, args.prelabel_batch)
+
+        box_propagator = BoxPropagator(image_manager.read_image, args.track_confidence) if args.propagate else None
 
-    dataset_manager.create_folder_structure()
-    image_manager = ImageManager(image_dir)
+        # Without any metrics option nothing is instrumented
+        metrics = None
+        if args.metrics or args.metrics_file is not None:
+            metrics = Metrics(args.metrics_file, args.metrics_interval)
 
-    my_gui = gui.ImageLabeler(image_manager, dataset_manager, screen_size, default_scale)
-    my_gui.loop()
+        my_gui = gui.ImageLabeler(
+            image_manager, dataset_manager, screen_size, default_scale, max_fps,
+            prelabel_worker=prelabel_worker, prelabel_ahead=args.prelabel_ahead,
+            metrics=metrics, show_metrics=args.metrics, box_propagator=box_propagator,
+            progressive=not args.no_progressive, review=args.review
+        )
+        if metrics is not None:
+            instrument(metrics, my_gui, image_manager, dataset_manager, prelabel_worker)
+        my_gui.loop()
+    finally:
+        # Saves still queued on the writer thread would be lost if an error ended the session without closing
+        if prelabel_worker is not None:
+            prelabel_worker.close()
+        if box_propagator is not None:
+            box_propagator.close()
+        image_manager.close()
+        dataset_manager.close()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,15 @@
 import argparse
+import sys
+
+from benchmark import BENCHMARKS, run_benchmarks
+
+from dataset_export import export_dataset
+
+from dataset_review import REVIEW_SORTS
+
+from dataset_tools import build_dataset, merge_datasets, validate_dataset
+
+from image_dedup import dedup_images
 
 from label import label_images
 
@@ -15,14 +26,93 @@ def main():
     label_parser.add_argument('--classes', default=['class0', 'class1'], type=str, nargs='+', help='Classes')
     label_parser.add_argument('--screen_size', default=[1200, 800], type=int, nargs=2, help='Screen size')
     label_parser.add_argument('--default_scale', default=1.0, type=float, help='Default scale')
+    label_parser.add_argument('--max_fps', default=60, type=int, help='Maximum frame rate')
+    label_parser.add_argument('--prefetch', default=3, type=int, help='Number of upcoming images to decode ahead')
+    label_parser.add_argument('--cache_size', default=1024, type=int, help='Size of the decoded image cache in MB')
+    label_parser.add_argument('--write_queue', default=8, type=int, help='Number of images waiting to be saved before saving blocks')
+    label_parser.add_argument('--no_manifest', action='store_true', help='Scan the image folder without reading or writing a manifest')
+    label_parser.add_argument('--undo_depth', default=100, type=int, help='Number of labelled images that can be undone')
+    label_parser.add_argument('--no_progressive', action='store_true', help='Wait for the full resolution image instead of showing a reduced preview first')
+    label_parser.add_argument('--reencode', action='store_true', help='Encode saved images as JPEG instead of copying the source files')
+    label_parser.add_argument('--shard', action='store_true', help='Share --image_dir with other labelling processes, each claiming its own images')
+    label_parser.add_argument('--worker_id', default=None, help='Id of this worker in sharded mode, reuse it to continue with earlier claims')
+    label_parser.add_argument('--claim_batch', default=16, type=int, help='Number of images claimed at a time in sharded mode')
+    label_parser.add_argument('--claim_timeout', default=600.0, type=float, help='Seconds without a heartbeat after which the claims of a worker are taken back')
+    label_parser.add_argument('--archive', action='store_true', help='Label images inside the zip and tar files in --image_dir, or inside the archive it points to')
+    label_parser.add_argument('--video', action='store_true', help='Label frames of the video files in --image_dir, or of the video file it points to')
+    label_parser.add_argument('--stride', default=1, type=int, help='Label every N-th frame of a video')
+    label_parser.add_argument('--frame_buffer', default=16, type=int, help='Number of decoded video frames kept for going back and forward')
+    label_parser.add_argument('--review', action='store_true', help='Go through the labelled images of --dataset_dir and edit their boxes in place')
+    label_parser.add_argument('--sort', default='path', choices=REVIEW_SORTS, help='Review order: by path, most boxes, smallest box or most boxes of --review_class first')
+    label_parser.add_argument('--review_class', default=None, help='Only review images with a box of this class, given by name or id')
+    label_parser.add_argument('--min_boxes', default=None, type=int, help='Only review images with at least this many boxes')
+    label_parser.add_argument('--max_boxes', default=None, type=int, help='Only review images with at most this many boxes')
+    label_parser.add_argument('--smaller_than', default=None, type=float, help='Only review images with a box whose side is below this fraction of the image')
+    label_parser.add_argument('--model', default=None, help='ONNX detector used to propose boxes')
+    label_parser.add_argument('--model_classes', default=None, type=str, nargs='+', help='Class names of the model, matched to --classes by name')
+    label_parser.add_argument('--model_size', default=[640, 640], type=int, nargs=2, help='Input width and height of the model')
+    label_parser.add_argument('--score_threshold', default=0.25, type=float, help='Minimum score of a proposed box')
+    label_parser.add_argument('--prelabel_ahead', default=4, type=int, help='Number of upcoming images to propose boxes for')
+    label_parser.add_argument('--prelabel_batch', default=4, type=int, help='Number of images per model run')
+    label_parser.add_argument('--propagate', action='store_true', help='Track the boxes of each labelled image into the next image')
+    label_parser.add_argument('--track_confidence', default=0.5, type=float, help='Tracked boxes below this confidence are flagged for review')
+    label_parser.add_argument('--metrics', action='store_true', help='Measure latencies and show them in an overlay, toggled with F3')
+    label_parser.add_argument('--metrics_file', default=None, help='File to write the metrics to, Prometheus text for .prom files and JSON otherwise')
+    label_parser.add_argument('--metrics_interval', default=10.0, type=float, help='Seconds between writes of the metrics file')
     # add function
     label_parser.set_defaults(func=label_images)
 
+    validate_parser = subparsers.add_parser('validate', help='Check the labels of a dataset')
+    validate_parser.add_argument('--dataset_dir', default='dataset', help='Directory with dataset')
+    validate_parser.add_argument('--n_classes', default=None, type=int, help='Number of classes, read from data.yaml by default')
+    validate_parser.add_argument('--workers', default=None, type=int, help='Number of processes, all cores by default')
+    validate_parser.add_argument('--max_problems', default=100, type=int, help='Maximum number of problems to print')
+    validate_parser.set_defaults(func=validate_dataset)
+
+    build_parser = subparsers.add_parser('build', help='Resize a dataset to the training resolution')
+    build_parser.add_argument('--dataset_dir', default='dataset', help='Directory with dataset')
+    build_parser.add_argument('--output_dir', required=True, help='Directory for the resized dataset')
+    build_parser.add_argument('--size', default=[640, 640], type=int, nargs=2, help='Target width and height')
+    build_parser.add_argument('--stretch', action='store_true', help='Stretch images to the size instead of letterboxing')
+    build_parser.add_argument('--workers', default=None, type=int, help='Number of processes, all cores by default')
+    build_parser.set_defaults(func=build_dataset)
+
+    merge_parser = subparsers.add_parser('merge', help='Combine the datasets of the workers of a sharded session')
+    merge_parser.add_argument('--dataset_dir', default='dataset', help='Directory with dataset, the worker datasets are in its workers folder')
+    merge_parser.add_argument('--output_dir', default=None, help='Directory for the merged dataset, --dataset_dir by default')
+    merge_parser.set_defaults(func=merge_datasets)
+
+    export_parser = subparsers.add_parser('export', help='Pack a dataset into tar shards or a COCO file')
+    export_parser.add_argument('--dataset_dir', default='dataset', help='Directory with dataset')
+    export_parser.add_argument('--output_dir', default='export', help='Directory for the shards and the COCO file')
+    export_parser.add_argument('--format', default=['webdataset'], choices=['webdataset', 'coco'], nargs='+', help='Formats to write')
+    export_parser.add_argument('--shard_size', default=1000, type=int, help='Number of samples per tar shard')
+    export_parser.add_argument('--workers', default=None, type=int, help='Number of processes, all cores by default')
+    export_parser.set_defaults(func=export_dataset)
+
+    dedup_parser = subparsers.add_parser('dedup', help='Find near-duplicate images before labelling')
+    dedup_parser.add_argument('--image_dir', default='images', help='Directory with images')
+    dedup_parser.add_argument('--threshold', default=6, type=int, help='Maximum number of differing hash bits for two images to count as duplicates')
+    dedup_parser.add_argument('--workers', default=None, type=int, help='Number of processes, all cores by default')
+    dedup_parser.add_argument('--groups_file', default=None, help='JSON file to write the groups of duplicates to')
+    dedup_parser.add_argument('--move', action='store_true', help='Move all but the first image of every group to the .duplicates folder')
+    dedup_parser.set_defaults(func=dedup_images)
+
+    bench_parser = subparsers.add_parser('bench', help='Benchmark rendering, scanning, decoding and saving')
+    bench_parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    bench_parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    bench_parser.add_argument('--tolerance', default=0.2, type=float, help='Allowed relative slowdown of a median before it counts as a regression')
+    bench_parser.add_argument('--repeat', default=20, type=int, help='Number of timed runs per benchmark')
+    bench_parser.add_argument('--only', default=None, choices=list(BENCHMARKS.keys()), nargs='+', help='Benchmarks to run, all by default')
+    bench_parser.add_argument('--quick', action='store_true', help='Use fewer and smaller inputs')
+    bench_parser.set_defaults(func=run_benchmarks)
+
     args = parser.parse_args()
     if args.command is None:
         parser.print_help()
     else:
-        args.func(args)
+        # Subcommands return the number of problems or failures
+        sys.exit(1 if args.func(args) else 0)
 
 
 if __name__ == '__main__':
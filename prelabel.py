@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+
+from dataset_manager import BoxSet
+
+from dataset_tools import letterbox
+
+import numpy as np
+
+
+class Detector:
+    """
+    Class to run an ONNX object detector on the CPU with OpenCV's dnn module.
+
+    Both the YOLOv8 output layout (batch, 4 + classes, boxes) and the YOLOv5 layout
+    (batch, boxes, 5 + classes) with an objectness score are understood.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 class_map: Dict[int, int],
+                 input_size: Tuple[int, int] = (640, 640),
+                 score_threshold: float = 0.25,
+                 nms_threshold: float = 0.45
+                 ):
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        # Model class index to labelling class index, model classes without a match are dropped
+        self.class_map = class_map
+        self.input_size = input_size
+        self.score_threshold = score_threshold
+        self.nms_threshold = nms_threshold
+        # Many exported models have a fixed batch size of one
+        self.batch_supported = True
+
+    def detect(self, images: List[np.ndarray]) -> List[BoxSet]:
+        """Detect objects in a batch of BGR images, return the boxes in image coordinates."""
+        letterboxed = [letterbox(image, self.input_size) for image in images]
+        inputs = [output for output, _, _, _ in letterboxed]
+        if self.batch_supported and len(inputs) > 1:
+            try:
+                outputs = self._forward(inputs)
+            except cv2.error:
+                self.batch_supported = False
+        if not self.batch_supported or len(inputs) == 1:
+            outputs = np.concatenate([self._forward([image]) for image in inputs])
+
+        results = []
+        for image, output, (_, ratio, pad_left, pad_top) in zip(images, outputs, letterboxed):
+            boxes = self._decode(output)
+            boxes.coordinates = (boxes.coordinates - [pad_left, pad_top, pad_left, pad_top]) / ratio
+            results.append(boxes.clip(image.shape[1], image.shape[0]))
+        return results
+
+    def _forward(self, images: List[np.ndarray]) -> np.ndarray:
+        blob = cv2.dnn.blobFromImages(images, scalefactor=1 / 255, size=self.input_size, swapRB=True)
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def _decode(self, output: np.ndarray) -> BoxSet:
+        """Turn the raw output for one image into boxes after score filtering and non-maximum suppression."""
+        if output.shape[0] < output.shape[1]:
+            # YOLOv8 puts the box attributes first
+            output = output.T
+            scores = output[:, 4:]
+        else:
+            scores = output[:, 5:] * output[:, 4:5]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+
+        keep = confidences >= self.score_threshold
+        keep &= np.isin(class_ids, list(self.class_map.keys()))
+        output, class_ids, confidences = output[keep], class_ids[keep], confidences[keep]
+        if len(output) == 0:
+            return BoxSet()
+
+        x_center, y_center, width, height = output[:, :4].T
+        corners = np.stack([x_center - width / 2, y_center - height / 2, x_center + width / 2, y_center + height / 2], axis=1)
+        # Shift every class to its own region so a single suppression pass never merges different classes
+        shifted = corners + (class_ids * (max(self.input_size) + 1))[:, None]
+        rects = np.column_stack([shifted[:, :2], width, height]).tolist()
+        indices = np.array(cv2.dnn.NMSBoxes(rects, confidences.tolist(), self.score_threshold, self.nms_threshold), dtype=int).reshape(-1)
+        mapped_ids = np.array([self.class_map[class_id] for class_id in class_ids[indices].tolist()], dtype=np.int64)
+        return BoxSet(corners[indices], mapped_ids)
+
+
+class PrelabelWorker:
+    """Class to detect objects in upcoming images on a background thread before they are shown."""
+
+    def __init__(self,
+                 detector: Detector,
+                 read_image: Callable[[str], Optional[np.ndarray]],
+                 batch_size: int = 4,
+                 max_results: int = 64
+                 ):
+        self.detector = detector
+        self.read_image = read_image
+        self.batch_size = batch_size
+        self.max_results = max_results
+
+        self.results: OrderedDict = OrderedDict()
+        self._queue: List[str] = []
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='prelabel', daemon=True)
+        self._thread.start()
+
+    def schedule(self, paths: List[str]):
+        """Replace the queued paths with the given paths that have no proposals yet, in order."""
+        with self._condition:
+            self._queue = [path for path in paths if path not in self.results]
+            self._condition.notify()
+
+    def get(self, path: str) -> Optional[BoxSet]:
+        """Return the proposals for an image, or None if they are not ready."""
+        with self._condition:
+            return self.results.get(path)
+
+    def pending(self) -> int:
+        """Return the number of queued images."""
+        with self._condition:
+            return len(self._queue)
+
+    def close(self):
+        """Stop the background thread."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and len(self._queue) == 0:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                batch = self._queue[:self.batch_size]
+                self._queue = self._queue[self.batch_size:]
+
+            images = []
+            paths = []
+            for path in batch:
+                image = self.read_image(path)
+                if image is not None:
+                    images.append(image)
+                    paths.append(path)
+            if len(images) == 0:
+                continue
+            try:
+                proposals = self.detector.detect(images)
+            except cv2.error as error:
+                print(f'Pre-labelling failed: {error}')
+                proposals = [BoxSet() for _ in images]
+
+            with self._condition:
+                for path, boxes in zip(paths, proposals):
+                    self.results[path] = boxes
+                while len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class SessionStore:
+    """
+    Class to index the saved samples of a dataset in an SQLite database.
+
+    Sample ids come from an AUTOINCREMENT key, so they are allocated atomically and never reused,
+    also across sessions and processes sharing the database. Removed samples are only marked as
+    removed until they are purged, so they can be restored with the same id.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # The writer thread records hashes through the same connection
+        self._lock = threading.Lock()
+
+        with self._lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode commits then only append to the log, which is synced at checkpoints, so saving never waits for an fsync
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('PRAGMA foreign_keys=ON')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS samples (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    split TEXT NOT NULL,
+                    image_path TEXT,
+                    label_path TEXT,
+                    source_hash TEXT,
+                    box_count INTEGER NOT NULL,
+                    removed INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS sample_classes (
+                    sample_id INTEGER NOT NULL REFERENCES samples(id) ON DELETE CASCADE,
+                    class_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (sample_id, class_id)
+                );
+                CREATE INDEX IF NOT EXISTS samples_split ON samples(split, removed);
+                CREATE INDEX IF NOT EXISTS sample_classes_class ON sample_classes(class_id);
+            ''')
+
+    def reserve_ids(self, next_id: int):
+        """Make sure new samples get ids of at least next_id, used for datasets created before the index."""
+        with self._lock, self.connection:
+            row = self.connection.execute("SELECT seq FROM sqlite_sequence WHERE name = 'samples'").fetchone()
+            if row is None:
+                self.connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('samples', ?)", (next_id - 1,))
+            elif row[0] < next_id - 1:
+                self.connection.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'samples'", (next_id - 1,))
+
+    def add_sample(self, split: str, class_counts: Dict[int, int], paths) -> tuple:
+        """
+        Allocate an id for a new sample and record it.
+
+        Args:
+            split: The split the sample is saved in.
+            class_counts: The number of boxes per class id.
+            paths: Function from the sample id to the image and label paths.
+        Returns:
+            The id, the image path and the label path.
+        """
+        with self._lock, self.connection:
+            box_count = sum(class_counts.values())
+            cursor = self.connection.execute(
+                'INSERT INTO samples (split, box_count, created) VALUES (?, ?, ?)', (split, box_count, time.time())
+            )
+            sample_id = cursor.lastrowid
+            image_path, label_path = paths(sample_id)
+            self.connection.execute(
+                'UPDATE samples SET image_path = ?, label_path = ? WHERE id = ?', (image_path, label_path, sample_id)
+            )
+            self.connection.executemany(
+                'INSERT INTO sample_classes (sample_id, class_id, count) VALUES (?, ?, ?)',
+                [(sample_id, class_id, count) for class_id, count in class_counts.items()]
+            )
+        return sample_id, image_path, label_path
+
+    def set_class_counts(self, sample_id: int, class_counts: Dict[int, int]):
+        """Replace the box counts of a sample whose labels were edited, samples that are not indexed are ignored."""
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                'UPDATE samples SET box_count = ? WHERE id = ?', (sum(class_counts.values()), sample_id)
+            )
+            if cursor.rowcount == 0:
+                return
+            self.connection.execute('DELETE FROM sample_classes WHERE sample_id = ?', (sample_id,))
+            self.connection.executemany(
+                'INSERT INTO sample_classes (sample_id, class_id, count) VALUES (?, ?, ?)',
+                [(sample_id, class_id, count) for class_id, count in class_counts.items()]
+            )
+
+    def set_removed(self, sample_id: int, removed: bool):
+        """Mark a sample as removed or restore it."""
+        with self._lock, self.connection:
+            self.connection.execute('UPDATE samples SET removed = ? WHERE id = ?', (int(removed), sample_id))
+
+    def purge_removed(self):
+        """Delete every sample marked as removed."""
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM samples WHERE removed = 1')
+
+    def set_source_hash(self, sample_id: int, source_hash: str):
+        """Record the hash of the image file of a sample."""
+        with self._lock, self.connection:
+            self.connection.execute('UPDATE samples SET source_hash = ? WHERE id = ?', (source_hash, sample_id))
+
+    def find_by_hash(self, source_hash: str) -> Optional[int]:
+        """Return the id of a sample with the given image hash, or None."""
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT id FROM samples WHERE source_hash = ? AND removed = 0', (source_hash,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def split_counts(self) -> Dict[str, int]:
+        """Return the number of samples per split."""
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT split, COUNT(*) FROM samples WHERE removed = 0 GROUP BY split'
+            ).fetchall()
+        return dict(rows)
+
+    def class_counts(self, n_classes: int) -> List[int]:
+        """Return the number of boxes per class over all samples."""
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT class_id, SUM(count) FROM sample_classes '
+                'JOIN samples ON samples.id = sample_classes.sample_id '
+                'WHERE removed = 0 GROUP BY class_id'
+            ).fetchall()
+        counts = [0] * n_classes
+        for class_id, count in rows:
+            if 0 <= class_id < n_classes:
+                counts[class_id] = count
+        return counts
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,112 @@
+import json
+import os
+from collections import deque
+from typing import List, Optional
+
+
+class UndoJournal:
+    """
+    Class to move files into a staging directory so their removal can be undone.
+
+    Every operation is appended to a log in the staging directory, so files staged in an earlier
+    session are still known after a restart. Only the newest `depth` entries are kept, older staged
+    files are deleted for good.
+    """
+
+    log_name = 'journal.log'
+
+    def __init__(self, staging_dir: str, depth: int = 100):
+        self.staging_dir = staging_dir
+        self.depth = depth
+        self.log_path = os.path.join(staging_dir, self.log_name)
+
+        # Each entry is a pair of entry id and a list of (original path, staged path) pairs
+        self.entries: deque = deque()
+        self.next_id = 0
+
+        os.makedirs(staging_dir, exist_ok=True)
+        self._replay()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stage(self, paths: List[str]):
+        """Move the files into the staging directory as one entry."""
+        entry_id = self.next_id
+        self.next_id += 1
+        files = []
+        for i, path in enumerate(paths):
+            staged_path = os.path.join(self.staging_dir, f'{entry_id}_{i}_{os.path.basename(path)}')
+            os.replace(path, staged_path)
+            files.append((path, staged_path))
+        self.entries.append((entry_id, files))
+        self._log('stage', entry_id, files)
+
+        while len(self.entries) > self.depth:
+            self._purge(self.entries.popleft())
+
+    def peek(self) -> Optional[List[str]]:
+        """Return the original paths of the newest entry without restoring it, None if there is no entry."""
+        if len(self.entries) == 0:
+            return None
+        return [path for path, _ in self.entries[-1][1]]
+
+    def restore(self) -> Optional[List[str]]:
+        """Move the files of the newest entry back, return their paths or None if there is nothing to restore."""
+        if len(self.entries) == 0:
+            return None
+        entry_id, files = self.entries.pop()
+        for path, staged_path in files:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            os.replace(staged_path, path)
+        self._log('restore', entry_id)
+        return [path for path, _ in files]
+
+    def clear(self):
+        """Delete every staged file."""
+        while len(self.entries) > 0:
+            self._purge(self.entries.popleft())
+
+    def _purge(self, entry: tuple):
+        entry_id, files = entry
+        for _, staged_path in files:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        self._log('purge', entry_id)
+
+    def _log(self, operation: str, entry_id: int, files: Optional[list] = None):
+        record = {'op': operation, 'id': entry_id}
+        if files is not None:
+            record['files'] = files
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def _replay(self):
+        """Rebuild the entries from the log and rewrite it with only the entries that are still staged."""
+        if not os.path.exists(self.log_path):
+            return
+        entries = {}
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash
+                    continue
+                self.next_id = max(self.next_id, record['id'] + 1)
+                if record['op'] == 'stage':
+                    entries[record['id']] = [tuple(pair) for pair in record['files']]
+                else:
+                    entries.pop(record['id'], None)
+
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry_id in sorted(entries):
+                files = entries[entry_id]
+                if all(os.path.exists(staged_path) for _, staged_path in files):
+                    self.entries.append((entry_id, files))
+                    f.write(json.dumps({'op': 'stage', 'id': entry_id, 'files': files}) + '\n')
+        os.replace(tmp_path, self.log_path)
+
+        while len(self.entries) > self.depth:
+            self._purge(self.entries.popleft())
@@ -0,0 +1,302 @@
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+
+from image_cache import ImageCache, ImagePrefetcher
+
+from image_scanner import ImageScanner
+
+import numpy as np
+
+
+VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mov', '.mkv']
+
+
+def frame_key(video_path: str, frame_index: int) -> str:
+    """Return the key of a video frame, used where images are identified by their path."""
+    return f'{video_path}#{frame_index}'
+
+
+def parse_frame_key(key: str) -> Tuple[str, int]:
+    """Split a frame key into the video path and the frame index."""
+    video_path, _, frame_index = key.rpartition('#')
+    return video_path, int(frame_index)
+
+
+class VideoReader:
+    """
+    Class to decode frames of video files with cv2.VideoCapture.
+
+    One capture is kept open and read sequentially. Frames a short distance ahead are reached by
+    grabbing the frames in between without converting them, larger jumps and jumps back seek.
+    """
+
+    def __init__(self, seek_threshold: int = 64):
+        self.seek_threshold = seek_threshold
+        self.capture = None
+        self.video_path = None
+        # Index of the frame the next read returns
+        self.position = 0
+        self._lock = threading.Lock()
+
+    def frame_count(self, video_path: str) -> int:
+        """Return the number of frames reported by the container."""
+        capture = cv2.VideoCapture(video_path)
+        try:
+            return int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        finally:
+            capture.release()
+
+    def frame_size(self, video_path: str) -> Tuple[int, int]:
+        """Return the width and height of the frames."""
+        capture = cv2.VideoCapture(video_path)
+        try:
+            return int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        finally:
+            capture.release()
+
+    def read(self, key: str) -> Optional[np.ndarray]:
+        """Decode the frame with the given key, None if it does not exist. Safe to call from other threads."""
+        video_path, frame_index = parse_frame_key(key)
+        with self._lock:
+            if self.video_path != video_path:
+                self.release()
+                self.capture = cv2.VideoCapture(video_path)
+                self.video_path = video_path
+                self.position = 0
+            skip = frame_index - self.position
+            if skip < 0 or skip > self.seek_threshold:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            else:
+                for _ in range(skip):
+                    if not self.capture.grab():
+                        # The position is unknown now, the next read opens the file again
+                        self.release()
+                        return None
+            self.position = frame_index + 1
+            success, frame = self.capture.read()
+            return frame if success else None
+
+    def release(self):
+        """Close the open video file."""
+        if self.capture is not None:
+            self.capture.release()
+        self.capture = None
+        self.video_path = None
+
+
+class VideoManager:
+    """
+    Class to manage unlabelled frames of video files, in place of ImageManager.
+
+    Every `stride`-th frame is labelled. The position in each video is stored in a progress file
+    instead of removing labelled frames, and nothing besides that file is written. Recently decoded
+    frames are kept in a small buffer, so going back and the next few frames need no decoding.
+    """
+
+    def __init__(self,
+                 folder_path: str,
+                 stride: int = 1,
+                 prefetch_count: int = 3,
+                 buffer_frames: int = 16
+                 ):
+        self.allowed_extensions = VIDEO_EXTENSIONS
+        self.folder_path = folder_path
+        self.stride = max(1, stride)
+        self.prefetch_count = prefetch_count
+
+        if os.path.isfile(folder_path):
+            self.root_folder = os.path.dirname(folder_path)
+            self.video_paths = [folder_path]
+        else:
+            self.root_folder = folder_path
+            self.video_paths = sorted(ImageScanner(folder_path, self.allowed_extensions).scan())
+        self.progress_path = os.path.join(self.root_folder, '.label', 'video_progress.json')
+
+        self.reader = VideoReader()
+        self.frame_counts = [self.reader.frame_count(path) for path in self.video_paths]
+        # The position is the video index and the frame index of the current frame, it starts in the first unfinished video
+        self.progress = self.load_progress()
+        self.video_index = 0
+        self.frame_index = 0
+        for video_index, video_path in enumerate(self.video_paths):
+            self.video_index, self.frame_index = video_index, self.progress.get(self.relative_path(video_path), 0)
+            if self.frame_index < self.frame_counts[video_index]:
+                break
+
+        self.current = ('', None)
+        frame_bytes = 1920 * 1080 * 3
+        if len(self.video_paths) > 0:
+            width, height = self.reader.frame_size(self.video_paths[0])
+            frame_bytes = max(1, width * height * 3)
+        self.cache = ImageCache(frame_bytes * max(buffer_frames, prefetch_count + 2))
+        # A single worker keeps decoding sequential
+        self.prefetcher = ImagePrefetcher(self.cache, self.reader.read, n_workers=1)
+
+        # Set once every frame is labelled, the last frame then stays on screen until it is gone back to
+        position = self.decodable_position(0)
+        self.finished = position is None
+        if position is not None:
+            self.video_index, self.frame_index = position
+
+    def relative_path(self, video_path: str) -> str:
+        """Return the path of a video as stored in the progress file."""
+        return os.path.relpath(video_path, self.root_folder)
+
+    def load_progress(self) -> dict:
+        """Load the next frame index of every video, or nothing if there is no progress file."""
+        if not os.path.exists(self.progress_path):
+            return {}
+        try:
+            with open(self.progress_path) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def save_progress(self):
+        """Write the progress through a temporary file."""
+        os.makedirs(os.path.dirname(self.progress_path), exist_ok=True)
+        tmp_path = self.progress_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.progress, f, indent=2)
+        os.replace(tmp_path, self.progress_path)
+
+    def move(self, video_index: int, frame_index: int):
+        """Go to a position and record it, videos that were passed are finished and a video that was left backwards is not started."""
+        for index in range(self.video_index, video_index):
+            self.progress[self.relative_path(self.video_paths[index])] = self.frame_counts[index]
+        if video_index < self.video_index:
+            self.progress[self.relative_path(self.video_paths[self.video_index])] = 0
+        self.video_index, self.frame_index = video_index, frame_index
+        self.progress[self.relative_path(self.video_paths[video_index])] = frame_index
+        self.save_progress()
+        self.current = ('', None)
+
+    def positions(self, count: int) -> List[Tuple[int, int]]:
+        """Return the current position and the positions following it."""
+        positions = []
+        video_index, frame_index = self.video_index, self.frame_index
+        while len(positions) < count and video_index < len(self.video_paths):
+            if frame_index < self.frame_counts[video_index]:
+                positions.append((video_index, frame_index))
+                frame_index += self.stride
+            else:
+                video_index, frame_index = video_index + 1, 0
+        return positions
+
+    def decodable_position(self, step: int) -> Optional[Tuple[int, int]]:
+        """Return the position `step` frames after the current one, skipping frames that cannot be decoded, None if there is none."""
+        while True:
+            positions = self.positions(step + 1)
+            if len(positions) <= step:
+                return None
+            video_index, frame_index = positions[step]
+            if self.read_image(frame_key(self.video_paths[video_index], frame_index)) is not None:
+                return positions[step]
+            # The container reported more frames than could be decoded
+            self.frame_counts[video_index] = frame_index
+
+    def load_image(self) -> np.ndarray:
+        """Load the current frame, moving on to the next video when a video ends early."""
+        key = self.current_image_path()
+        if key == self.current[0]:
+            return self.current[1]
+        image = self.read_image(key)
+        if image is None:
+            position = self.decodable_position(0)
+            if position is None:
+                raise ValueError(f'{key}: could not be decoded and no frames follow it')
+            self.move(*position)
+            key = self.current_image_path()
+            image = self.read_image(key)
+        self.current = (key, image)
+        self.prefetch()
+        return image
+
+    def load_preview(self, scale: float) -> Optional[np.ndarray]:
+        """Frames are small enough to be decoded in full right away."""
+        return None
+
+    def full_image_ready(self) -> bool:
+        """Return True, the current frame is decoded on demand."""
+        return True
+
+    def current_image_size(self) -> Tuple[int, int]:
+        """Return the width and height of the current frame."""
+        image = self.load_image()
+        return image.shape[1], image.shape[0]
+
+    def read_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Return any frame from the buffer, decoding it if needed, safe to call from other threads."""
+        image = self.cache.get(image_path)
+        if image is None:
+            image = self.prefetcher.wait(image_path)
+        if image is None:
+            image = self.reader.read(image_path)
+            self.cache.put(image_path, image)
+        return image
+
+    def upcoming_image_paths(self, count: int) -> List[str]:
+        """Return the keys of the current frame and the frames following it."""
+        return [frame_key(self.video_paths[video_index], frame_index) for video_index, frame_index in self.positions(count)]
+
+    def current_image_path(self) -> str:
+        """Return the key of the current frame."""
+        return frame_key(self.video_paths[self.video_index], self.frame_index)
+
+    def current_source_path(self) -> Optional[str]:
+        """Frames have no file of their own, so saved frames are always encoded."""
+        return None
+
+    def prefetch(self):
+        """Start decoding the current frame and the frames following it."""
+        self.prefetcher.prefetch(self.upcoming_image_paths(self.prefetch_count + 1))
+
+    def cache_stats(self) -> dict:
+        """Return the hit and miss counters of the frame buffer."""
+        return self.cache.stats()
+
+    def close(self):
+        """Stop the prefetch worker and close the video."""
+        self.prefetcher.close()
+        self.reader.release()
+
+    def all_labelled(self) -> bool:
+        """Return True once the last frame has been labelled."""
+        return self.finished
+
+    def next_image(self):
+        """Move to the next frame and remember the position."""
+        position = self.decodable_position(1)
+        if position is None:
+            # The last frame stays on screen, the videos are recorded as finished so it is not labelled again
+            for index in range(self.video_index, len(self.video_paths)):
+                self.progress[self.relative_path(self.video_paths[index])] = self.frame_counts[index]
+            self.save_progress()
+            self.finished = True
+            print('No more frames')
+            return
+        self.move(*position)
+        self.prefetch()
+
+    def can_go_back(self) -> bool:
+        """Return True if there is a frame before the current one."""
+        return self.finished or self.frame_index >= self.stride or self.video_index > 0
+
+    def previous_image(self):
+        """Move back to the previous frame and remember the position."""
+        if self.finished:
+            # The last frame is still on screen, it only has to be labelled again
+            self.finished = False
+            self.progress[self.relative_path(self.video_paths[self.video_index])] = self.frame_index
+            self.save_progress()
+        elif self.frame_index >= self.stride:
+            self.move(self.video_index, self.frame_index - self.stride)
+        elif self.video_index > 0:
+            last_frame = self.frame_counts[self.video_index - 1] - 1
+            self.move(self.video_index - 1, last_frame - last_frame % self.stride)
+        else:
+            print('No frames to go back to')
@@ -0,0 +1,124 @@
+import os
+import re
+import socket
+import threading
+from typing import Iterable, List
+from urllib.parse import quote, unquote
+
+
+def default_worker_id() -> str:
+    """Return an id that is unique for this process on this machine."""
+    return re.sub(r'[^A-Za-z0-9_-]', '_', f'{socket.gethostname()}-{os.getpid()}')
+
+
+class ClaimManager:
+    """
+    Class to share the images of one folder between several labelling processes.
+
+    A worker claims an image by renaming it into its own claim folder, `.claims/<worker id>`. A
+    rename is atomic on local file systems and NFS, so exactly one worker gets every image. Each
+    worker touches a heartbeat file in its claim folder regularly. The claims of a worker whose
+    heartbeat is older than `stale_timeout` are taken back by renaming its claim folder, which again
+    only one worker can do, and moving the images back to where they came from.
+    """
+
+    heartbeat_name = '.heartbeat'
+
+    def __init__(self, image_dir: str, worker_id: str, stale_timeout: float = 600.0):
+        self.image_dir = image_dir
+        self.worker_id = worker_id
+        self.stale_timeout = stale_timeout
+        self.claims_root = os.path.join(image_dir, '.claims')
+        self.claim_dir = os.path.join(self.claims_root, worker_id)
+        self.heartbeat_path = os.path.join(self.claim_dir, self.heartbeat_name)
+        os.makedirs(self.claim_dir, exist_ok=True)
+        self.heartbeat()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name='heartbeat', daemon=True)
+        self._thread.start()
+
+    def heartbeat(self) -> float:
+        """Mark this worker as alive, return the file system time of the heartbeat."""
+        with open(self.heartbeat_path, 'a'):
+            pass
+        os.utime(self.heartbeat_path)
+        return os.stat(self.heartbeat_path).st_mtime
+
+    def claimed_path(self, image_path: str) -> str:
+        """Return where an image of the shared folder is moved to when it is claimed."""
+        return os.path.join(self.claim_dir, quote(os.path.relpath(image_path, self.image_dir), safe=''))
+
+    def original_path(self, claimed_path: str) -> str:
+        """Return where a claimed image came from."""
+        return os.path.join(self.image_dir, unquote(os.path.basename(claimed_path)))
+
+    def claimed_paths(self) -> List[str]:
+        """Return the images this worker already holds, for example from an earlier session with the same id."""
+        with os.scandir(self.claim_dir) as entries:
+            return sorted(entry.path for entry in entries if entry.is_file() and not entry.name.startswith('.'))
+
+    def claim(self, candidates: Iterable[str], count: int) -> List[str]:
+        """Claim up to count of the candidate images, skipping the ones another worker got first."""
+        claimed = []
+        for image_path in candidates:
+            if len(claimed) >= count:
+                break
+            claimed_path = self.claimed_path(image_path)
+            try:
+                os.rename(image_path, claimed_path)
+            except FileNotFoundError:
+                continue
+            claimed.append(claimed_path)
+        return claimed
+
+    def release(self, claimed_paths: Iterable[str]):
+        """Give claimed images back to the shared folder."""
+        for claimed_path in claimed_paths:
+            original_path = self.original_path(claimed_path)
+            os.makedirs(os.path.dirname(original_path), exist_ok=True)
+            try:
+                os.rename(claimed_path, original_path)
+            except FileNotFoundError:
+                continue
+
+    def reclaim_stale(self) -> int:
+        """Return the images of workers that stopped sending heartbeats to the shared folder, return how many."""
+        # Compare against the file system clock, machines sharing a folder over NFS may disagree on the time
+        now = self.heartbeat()
+        released = 0
+        with os.scandir(self.claims_root) as entries:
+            folders = [entry for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+        for folder in folders:
+            if folder.name == self.worker_id:
+                continue
+            try:
+                last_beat = os.stat(os.path.join(folder.path, self.heartbeat_name)).st_mtime
+            except FileNotFoundError:
+                last_beat = folder.stat().st_mtime
+            if now - last_beat < self.stale_timeout:
+                continue
+            stale_dir = os.path.join(self.claims_root, f'.stale-{folder.name}-{int(now)}')
+            try:
+                os.rename(folder.path, stale_dir)
+            except OSError:
+                # Another worker reclaimed it first
+                continue
+            # Hidden entries are the heartbeat and the undo staging folder of labelled images
+            with os.scandir(stale_dir) as stale_entries:
+                stale_paths = [entry.path for entry in stale_entries if entry.is_file() and not entry.name.startswith('.')]
+            self.release(stale_paths)
+            released += len(stale_paths)
+        return released
+
+    def close(self):
+        """Stop sending heartbeats."""
+        self._stop.set()
+        self._thread.join()
+
+    def _beat(self):
+        while not self._stop.wait(self.stale_timeout / 4):
+            try:
+                self.heartbeat()
+            except OSError as error:
+                print(f'Could not write heartbeat: {error}')